@@ -1,9 +1,19 @@
-import idaapi
-import ida_idp
-import ida_fixup
-
-import StringIO
+import os
 import struct
+import time
+
+# IDA modules are imported by load_file and move_segm only, so the parser
+# can be used in a plain Python process, too
+idaapi = None
+ida_idp = None
+ida_fixup = None
+
+
+def _import_ida():
+    global idaapi, ida_idp, ida_fixup
+    import idaapi
+    import ida_idp
+    import ida_fixup
 
 HUNK_UNIT = 999
 HUNK_NAME = 1000
@@ -83,8 +93,15 @@ TYPE_LOADSEG = 1
 TYPE_UNIT = 2
 TYPE_LIB = 3
 
+type_names = [
+    "UNKNOWN", "LOADSEG", "UNIT", "LIB"
+]
+
 HUNK_TYPE_MASK = 0xffff
 
+# version of the parsed layout, bump when parsing results change
+PARSER_VERSION = 3
+
 SEGMENT_TYPE_CODE = 0
 SEGMENT_TYPE_DATA = 1
 SEGMENT_TYPE_BSS = 2
@@ -110,6 +127,25 @@ loadseg_valid_extra_hunks = [
     HUNK_NAME
 ]
 
+hunk_reloc_types = [
+    HUNK_ABSRELOC32,
+    HUNK_RELOC32SHORT,
+    HUNK_RELRELOC32,
+    HUNK_RELRELOC16,
+    HUNK_RELRELOC8,
+    HUNK_ABSRELOC16,
+    HUNK_DREL32,
+    HUNK_DREL16,
+    HUNK_DREL8
+]
+
+unit_valid_extra_hunks = hunk_reloc_types + [
+    HUNK_DEBUG,
+    HUNK_SYMBOL,
+    HUNK_NAME,
+    HUNK_EXT
+]
+
 
 class HunkParseError(Exception):
     def __init__(self, msg):
@@ -119,6 +155,115 @@ class HunkParseError(Exception):
         return self.msg
 
 
+class _Phase:
+    """context of one timed phase"""
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.profile.add_time(self.name, time.time() - self.start)
+        return False
+
+
+class _NullPhase:
+    """phase context used while profiling is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+class LoadProfile:
+    """optional per-phase wall time, call counts and counters of the load
+       pipeline. while disabled, phases and counters are no-ops.
+
+       target is None, "1" to report to the given output (e.g. the IDA
+       output window) or the path of a file the JSON reports are appended to
+    """
+
+    def __init__(self, target=None):
+        self.target = None
+        self.enabled = False
+        self.phases = {}
+        self.counters = {}
+        self._null_phase = _NullPhase()
+        self.enable(target)
+
+    def enable(self, target="1"):
+        if target in (None, "", "0"):
+            self.target = None
+            self.enabled = False
+        else:
+            self.target = target
+            self.enabled = True
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+
+    def phase(self, name):
+        """return a context manager timing a phase"""
+        if not self.enabled:
+            return self._null_phase
+        return _Phase(self, name)
+
+    def timed(self, name):
+        """decorator timing each call of a function as phase"""
+        def decorate(func):
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Phase(self, name):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorate
+
+    def add_time(self, name, seconds):
+        entry = self.phases.get(name)
+        if entry is None:
+            self.phases[name] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        phases = {}
+        for name, (calls, seconds) in self.phases.items():
+            phases[name] = {"calls": calls, "seconds": round(seconds, 6)}
+        return {"phases": phases, "counters": dict(self.counters)}
+
+    def emit(self, write):
+        """write the JSON report to the target file or via write()"""
+        if not self.enabled:
+            return
+        import json
+        data = json.dumps(self.report(), sort_keys=True)
+        if self.target == "1":
+            write(data + "\n")
+        else:
+            with open(self.target, "a") as f:
+                f.write(data + "\n")
+
+
+# set AMIGA_HUNK_PROFILE to 1 or a report file to enable profiling
+profile = LoadProfile(os.environ.get("AMIGA_HUNK_PROFILE"))
+
+
 class HunkBlock:
     """Base class for all hunk block types"""
 
@@ -127,6 +272,8 @@ class HunkBlock:
 
     blk_id = 0xdeadbeef
     sub_offset = None  # used inside LIB
+    raw_id = None  # block id as read including memory flags
+    file_offset = None  # file offset of the block id as read
 
     @staticmethod
     def _read_long(f):
@@ -168,26 +315,34 @@ class HunkBlock:
         else:
             return size, data[:endpos]
 
-    @staticmethod
-    def _write_long(f, v):
-        data = struct.pack(">I", v)
-        f.write(data)
+    def get_size(self):
+        """return the encoded size of the block without its id"""
+        return 0
+
+    def write_into(self, buf, pos):
+        """store the block at pos of a zero filled buffer, return the end"""
+        return pos
+
+    def write(self, f):
+        buf = bytearray(self.get_size())
+        self.write_into(buf, 0)
+        f.write(buf)
 
     @staticmethod
-    def _write_word(f, v):
-        data = struct.pack(">H", v)
-        f.write(data)
+    def _name_size(s):
+        return 4 + int((len(s) + 3) / 4) * 4
 
-    def _write_name(self, f, s, tag=None):
+    @staticmethod
+    def _put_name(buf, pos, s, tag=None):
         n = len(s)
         num_longs = int((n + 3) / 4)
-        b = bytearray(num_longs * 4)
-        if n > 0:
-            b[0:n] = s
         if tag is not None:
-            num_longs |= tag << 24
-        self._write_long(f, num_longs)
-        f.write(b)
+            struct.pack_into(">I", buf, pos, num_longs | (tag << 24))
+        else:
+            struct.pack_into(">I", buf, pos, num_longs)
+        pos += 4
+        buf[pos:pos + n] = s
+        return pos + num_longs * 4
 
 
 class HunkHeaderBlock(HunkBlock):
@@ -202,8 +357,11 @@ class HunkHeaderBlock(HunkBlock):
         self.first_hunk = 0
         self.last_hunk = 0
         self.hunk_table = []
+        # memory flags (upper two bits of the size) and extra attributes
+        self.hunk_flags = []
+        self.hunk_mem_attrs = {}
 
-    def setup(self, hunk_sizes):
+    def setup(self, hunk_sizes, hunk_flags=None):
         # easy setup for given number of hunks
         n = len(hunk_sizes)
         if n == 0:
@@ -212,6 +370,10 @@ class HunkHeaderBlock(HunkBlock):
         self.first_hunk = 0
         self.last_hunk = n - 1
         self.hunk_table = hunk_sizes
+        if hunk_flags is None:
+            self.hunk_flags = [0] * n
+        else:
+            self.hunk_flags = hunk_flags
 
     def parse(self, f):
         # parse resident library names (AOS 1.x only)
@@ -239,19 +401,35 @@ class HunkHeaderBlock(HunkBlock):
             # note that the upper bits are the target memory type. We only have FAST,
             # so let's forget about them for a moment.
             self.hunk_table.append(hunk_size & 0x3fffffff)
+            # keep them to write them back, both bits set: attributes follow
+            flags = hunk_size >> 30
+            self.hunk_flags.append(flags)
+            if flags == 3:
+                self.hunk_mem_attrs[a] = self._read_long(f)
 
-    def write(self, f):
+    def get_size(self):
+        size = sum(self._name_size(reslib) for reslib in self.reslib_names) + 16
+        size += 4 * len(self.hunk_table)
+        return size + 4 * self.hunk_flags[:len(self.hunk_table)].count(3)
+
+    def write_into(self, buf, pos):
         # write residents
         for reslib in self.reslib_names:
-            self._write_name(f, reslib)
-        self._write_long(f, 0)
-        # table size and hunk range
-        self._write_long(f, self.table_size)
-        self._write_long(f, self.first_hunk)
-        self._write_long(f, self.last_hunk)
+            pos = self._put_name(buf, pos, reslib)
+        # table size and hunk range after the 0 long ending the names
+        struct.pack_into(">III", buf, pos + 4, self.table_size, self.first_hunk, self.last_hunk)
+        pos += 16
         # sizes
-        for hunk_size in self.hunk_table:
-            self._write_long(f, hunk_size)
+        for a, hunk_size in enumerate(self.hunk_table):
+            flags = 0
+            if a < len(self.hunk_flags):
+                flags = self.hunk_flags[a]
+            struct.pack_into(">I", buf, pos, hunk_size | (flags << 30))
+            pos += 4
+            if flags == 3:
+                struct.pack_into(">I", buf, pos, self.hunk_mem_attrs.get(a, 0))
+                pos += 4
+        return pos
 
 
 class HunkSegmentBlock(HunkBlock):
@@ -263,21 +441,38 @@ class HunkSegmentBlock(HunkBlock):
             self.blk_id = blk_id
         self.data = data
         self.data_offset = data_offset
+        self.data_size = len(data) if data is not None else 0
         self.size_longs = size_longs
 
-    def parse(self, f):
+    def parse(self, f, skip_data=False):
         size = self._read_long(f)
         self.size_longs = size
         if self.blk_id != HUNK_BSS:
             size *= 4
             self.data_offset = f.tell()
-            self.data = f.read(size)
-
-    def write(self, f):
-        self._write_long(f, self.size_longs)
+            if skip_data:
+                # leave the payload in the file, users map it via data_offset
+                self.data_size = size
+                f.seek(self.data_offset + size, 0)
+            else:
+                self.data = f.read(size)
+                self.data_size = len(self.data)
 
+    def get_size(self):
+        if self.data is None:
+            return 4
+        return 4 + len(self.data)
+
+    def write_into(self, buf, pos):
+        if self.data is None and self.data_size > 0:
+            raise HunkParseError("can't write a segment read with skip_data")
+        struct.pack_into(">I", buf, pos, self.size_longs)
+        pos += 4
         if self.data is not None:
-            f.write(self.data)
+            end = pos + len(self.data)
+            buf[pos:end] = self.data
+            pos = end
+        return pos
 
 
 class HunkRelocLongBlock(HunkBlock):
@@ -299,20 +494,24 @@ class HunkRelocLongBlock(HunkBlock):
             if num == 0:
                 break
             hunk_num = self._read_long(f)
-            offsets = []
-            for i in xrange(num):
-                off = self._read_long(f)
-                offsets.append(off)
+            # read the whole offset table at once
+            size = num * 4
+            data = f.read(size)
+            if len(data) != size:
+                raise HunkParseError("read_long failed")
+            offsets = list(struct.unpack(">%dI" % num, data))
             self.relocs.append((hunk_num, offsets))
 
-    def write(self, f):
-        for reloc in self.relocs:
-            hunk_num, offsets = reloc
-            self._write_long(f, len(offsets))
-            self._write_long(f, hunk_num)
-            for off in offsets:
-                self._write_long(f, off)
-        self._write_long(f, 0)
+    def get_size(self):
+        return 4 + sum(8 + 4 * len(offsets) for hunk_num, offsets in self.relocs)
+
+    def write_into(self, buf, pos):
+        for hunk_num, offsets in self.relocs:
+            num = len(offsets)
+            struct.pack_into(">II%dI" % num, buf, pos, num, hunk_num, *offsets)
+            pos += 8 + num * 4
+        # the 0 long ending the table is already in the buffer
+        return pos + 4
 
 
 class HunkRelocWordBlock(HunkBlock):
@@ -337,30 +536,30 @@ class HunkRelocWordBlock(HunkBlock):
                 break
             hunk_num = self._read_word(f)
             num_words += num_offs + 1
-            offsets = []
-            for i in xrange(num_offs):
-                off = self._read_word(f)
-                offsets.append(off)
+            # read the whole offset table at once
+            size = num_offs * 2
+            data = f.read(size)
+            if len(data) != size:
+                raise HunkParseError("read_word failed")
+            offsets = list(struct.unpack(">%dH" % num_offs, data))
             self.relocs.append((hunk_num, offsets))
         # pad to long
         if num_words % 2 == 1:
             self._read_word(f)
 
-    def write(self, f):
-        num_words = 0
+    def get_size(self):
+        # words of the tables and the end word, padded to long
+        num_words = 1 + sum(2 + len(offsets) for hunk_num, offsets in self.relocs)
+        return (num_words + 1) / 2 * 4
+
+    def write_into(self, buf, pos):
+        end = pos + self.get_size()
         for hunk_num, offsets in self.relocs:
             num_offs = len(offsets)
-            self._write_word(f, num_offs)
-            self._write_word(f, hunk_num)
-            for i in xrange(num_offs):
-                self._write_word(f, offsets[i])
-            num_words += 2 + num_offs
-        # end
-        self._write_word(f, 0)
-        num_words += 1
-        # padding?
-        if num_words % 2 == 1:
-            self._write_word(f, 0)
+            struct.pack_into(">HH%dH" % num_offs, buf, pos, num_offs, hunk_num, *offsets)
+            pos += 4 + num_offs * 2
+        # end word and padding are zero
+        return end
 
 
 class HunkEndBlock(HunkBlock):
@@ -370,9 +569,6 @@ class HunkEndBlock(HunkBlock):
     def parse(self, f):
         pass
 
-    def write(self, f):
-        pass
-
 
 class HunkOverlayBlock(HunkBlock):
     """HUNK_OVERLAY"""
@@ -388,9 +584,82 @@ class HunkOverlayBlock(HunkBlock):
         self.data_offset = f.tell()
         self.data = f.read(num_longs * 4)
 
-    def write(self, f):
-        self._write_long(f, int(self.data / 4))
-        f.write(self.data)
+    def get_size(self):
+        return 4 + len(self.data)
+
+    def write_into(self, buf, pos):
+        struct.pack_into(">I", buf, pos, len(self.data) / 4)
+        end = pos + 4 + len(self.data)
+        buf[pos + 4:end] = self.data
+        return end
+
+    def get_entries(self):
+        """decode the overlay table. the first long gives the index of the
+           first entry (max level + 2), each entry has 8 longs"""
+        n = len(self.data) / 4
+        if n == 0:
+            return []
+        longs = struct.unpack(">%dI" % n, self.data[:n * 4])
+        start = longs[0]
+        if start < 1 or start > n:
+            raise HunkParseError("invalid overlay table")
+        entries = []
+        for i in xrange(start, n - 7, 8):
+            entries.append(HunkOverlayEntry(*longs[i:i + 8]))
+        return entries
+
+
+class HunkOverlayEntry:
+    """an entry of the overlay table: one symbol of an overlay node"""
+
+    def __init__(self, seek_offset, dummy1, dummy2, level, ordinate, first_hunk, sym_hunk, sym_offset):
+        self.seek_offset = seek_offset
+        self.level = level
+        self.ordinate = ordinate
+        self.first_hunk = first_hunk
+        self.sym_hunk = sym_hunk
+        self.sym_offset = sym_offset
+
+
+class HunkOverlayNode:
+    """an overlay node: the hunks starting at a file offset"""
+
+    def __init__(self, offset, level, ordinate, first_hunk):
+        self.offset = offset
+        self.level = level
+        self.ordinate = ordinate
+        self.first_hunk = first_hunk
+        self.symbols = []  # (hunk, offset)
+        self.segments = None  # once loaded
+
+
+def get_overlay_parents(nodes, node):
+    """return the parent nodes of an overlay node from the root down.
+       the tree is stored depth first, so the parent on each level is the
+       last node of that level before the node"""
+    parents = []
+    for level in xrange(node.level):
+        parent = None
+        for n in nodes:
+            if n.offset >= node.offset:
+                break
+            if n.level == level:
+                parent = n
+        if parent is not None:
+            parents.append(parent)
+    return parents
+
+
+def get_overlay_nodes(entries):
+    """group overlay table entries by node and sort by file offset"""
+    nodes = {}
+    for e in entries:
+        node = nodes.get(e.seek_offset)
+        if node is None:
+            node = HunkOverlayNode(e.seek_offset, e.level, e.ordinate, e.first_hunk)
+            nodes[e.seek_offset] = node
+        node.symbols.append((e.sym_hunk, e.sym_offset))
+    return [nodes[off] for off in sorted(nodes)]
 
 
 class HunkBreakBlock(HunkBlock):
@@ -400,9 +669,6 @@ class HunkBreakBlock(HunkBlock):
     def parse(self, f):
         pass
 
-    def write(self, f):
-        pass
-
 
 class HunkDebugBlock(HunkBlock):
     """HUNK_DEBUG"""
@@ -417,10 +683,15 @@ class HunkDebugBlock(HunkBlock):
         num_bytes = num_longs * 4
         self.debug_data = f.read(num_bytes)
 
-    def write(self, f):
+    def get_size(self):
+        return 4 + len(self.debug_data)
+
+    def write_into(self, buf, pos):
         num_longs = int(len(self.debug_data) / 4)
-        self._write_long(f, num_longs)
-        f.write(self.debug_data)
+        struct.pack_into(">I", buf, pos, num_longs)
+        end = pos + 4 + len(self.debug_data)
+        buf[pos + 4:end] = self.debug_data
+        return end
 
 
 class HunkSymbolBlock(HunkBlock):
@@ -442,11 +713,15 @@ class HunkSymbolBlock(HunkBlock):
             off = self._read_long(f)
             self.symbols.append((n, off))
 
-    def write(self, f):
+    def get_size(self):
+        return 4 + sum(self._name_size(sym) + 4 for sym, off in self.symbols)
+
+    def write_into(self, buf, pos):
         for sym, off in self.symbols:
-            self._write_name(f, sym)
-            self._write_long(f, off)
-        self._write_long(f, 0)
+            pos = self._put_name(buf, pos, sym)
+            struct.pack_into(">I", buf, pos, off)
+            pos += 4
+        return pos + 4
 
 
 class HunkUnitBlock(HunkBlock):
@@ -460,8 +735,11 @@ class HunkUnitBlock(HunkBlock):
     def parse(self, f):
         _, self.name = self._read_name(f)
 
-    def write(self, f):
-        self._write_name(f, self.name)
+    def get_size(self):
+        return self._name_size(self.name)
+
+    def write_into(self, buf, pos):
+        return self._put_name(buf, pos, self.name)
 
 
 class HunkNameBlock(HunkBlock):
@@ -475,8 +753,11 @@ class HunkNameBlock(HunkBlock):
     def parse(self, f):
         _, self.name = self._read_name(f)
 
-    def write(self, f):
-        self._write_name(f, self.name)
+    def get_size(self):
+        return self._name_size(self.name)
+
+    def write_into(self, buf, pos):
+        return self._put_name(buf, pos, self.name)
 
 
 class HunkExtEntry:
@@ -510,39 +791,54 @@ class HunkExtBlock(HunkBlock):
             bss_size = None
             offsets = None
             value = None
-            # ABSCOMMON -> bss size
-            if ext_type == EXT_ABSCOMMON:
+            # ABSCOMMON/RELCOMMON -> bss size, then references
+            if ext_type == EXT_ABSCOMMON or ext_type == EXT_RELCOMMON:
                 bss_size = self._read_long(f)
             # is a reference
-            elif ext_type >= 0x80:
+            if ext_type >= 0x80:
                 num_refs = self._read_long(f)
-                offsets = []
-                for i in xrange(num_refs):
-                    off = self._read_long(f)
-                    offsets.append(off)
+                size = num_refs * 4
+                data = f.read(size)
+                if len(data) != size:
+                    raise HunkParseError("read_long failed")
+                offsets = list(struct.unpack(">%dI" % num_refs, data))
             # is a definition
             else:
                 value = self._read_long(f)
             e = HunkExtEntry(name, ext_type, value, bss_size, offsets)
             self.entries.append(e)
 
-    def write(self, f):
+    def get_size(self):
+        size = 4
         for entry in self.entries:
             ext_type = entry.ext_type
-            self._write_name(f, entry.name, tag=ext_type)
-            # ABSCOMMON
-            if ext_type == EXT_ABSCOMMON:
-                self._write_long(f, entry.bss_size)
+            size += self._name_size(entry.name)
+            if ext_type == EXT_ABSCOMMON or ext_type == EXT_RELCOMMON:
+                size += 4
+            if ext_type >= 0x80:
+                size += 4 + 4 * len(entry.ref_offsets)
+            else:
+                size += 4
+        return size
+
+    def write_into(self, buf, pos):
+        for entry in self.entries:
+            ext_type = entry.ext_type
+            pos = self._put_name(buf, pos, entry.name, tag=ext_type)
+            # ABSCOMMON/RELCOMMON
+            if ext_type == EXT_ABSCOMMON or ext_type == EXT_RELCOMMON:
+                struct.pack_into(">I", buf, pos, entry.bss_size)
+                pos += 4
             # is a reference
-            elif ext_type >= 0x80:
+            if ext_type >= 0x80:
                 num_offsets = len(entry.ref_offsets)
-                self._write_long(f, num_offsets)
-                for off in entry.ref_offsets:
-                    self._write_long(f, off)
+                struct.pack_into(">I%dI" % num_offsets, buf, pos, num_offsets, *entry.ref_offsets)
+                pos += 4 + num_offsets * 4
             # is a definition
             else:
-                self._write_long(f, entry.def_value)
-        self._write_long(f, 0)
+                struct.pack_into(">I", buf, pos, entry.def_value)
+                pos += 4
+        return pos + 4
 
 
 class HunkLibBlock(HunkBlock):
@@ -575,6 +871,7 @@ class HunkLibBlock(HunkBlock):
                 # create block and parse
                 block = blk_type()
                 block.blk_id = blk_id
+                block.raw_id = struct.unpack(">I", tag)[0]
                 block.parse(f)
                 self.offsets.append(pos)
                 self.blocks.append(block)
@@ -582,29 +879,21 @@ class HunkLibBlock(HunkBlock):
                 raise HunkParseError("Unsupported hunk type: %04d" % blk_id)
             pos = f.tell()
 
-    def write(self, f):
-        # write dummy length (fill in later)
-        pos = f.tell()
-        start = pos
-        self._write_long(f, 0)
+    def get_size(self):
+        return 4 + sum(4 + block.get_size() for block in self.blocks)
+
+    def write_into(self, buf, pos):
+        size = self.get_size()
+        struct.pack_into(">I", buf, pos, (size - 4) / 4)
+        end = pos + size
+        pos += 4
+        # offsets of the block ids, file offsets if buf holds the file
         self.offsets = []
-        # write blocks
         for block in self.blocks:
-            block_id = block.blk_id
-            block_id_raw = struct.pack(">I", block_id)
-            f.write(block_id_raw)
-            # write block itself
-            block.write(f)
-            # update offsets
             self.offsets.append(pos)
-            pos = f.tell()
-        # fill in size
-        end = f.tell()
-        size = end - start - 4
-        num_longs = size / 4
-        f.seek(start, 0)
-        self._write_long(f, num_longs)
-        f.seek(end, 0)
+            struct.pack_into(">I", buf, pos, HunkBlockFile.get_block_id(block))
+            pos = block.write_into(buf, pos + 4)
+        return end
 
 
 class HunkIndexUnitEntry:
@@ -685,49 +974,43 @@ class HunkIndexBlock(HunkBlock):
         if num_words == 1:
             self._read_word(f)
 
-    def write(self, f):
-        # write dummy size
-        num_longs_pos = f.tell()
-        self._write_long(f, 0)
-        num_words = 0
-        # write string table
-        size_strtab = len(self.strtab)
-        self._write_word(f, size_strtab)
-        f.write(self.strtab)
-        num_words += size_strtab / 2 + 1
-        # write unit blocks
+    def _get_num_words(self):
+        """words after the size long, padded to long"""
+        num_words = len(self.strtab) / 2 + 1
         for unit in self.units:
-            self._write_word(f, unit.name_off)
-            self._write_word(f, unit.first_hunk_long_off)
-            self._write_word(f, len(unit.index_hunks))
             num_words += 3
             for index in unit.index_hunks:
-                self._write_word(f, index.name_off)
-                self._write_word(f, index.hunk_longs)
-                self._write_word(f, index.hunk_ctype)
-                # refs
+                num_words += 5 + len(index.sym_refs) + len(index.sym_defs) * 3
+        return num_words + num_words % 2
+
+    def get_size(self):
+        # an odd string table adds a byte the word count misses
+        return 4 + self._get_num_words() * 2 + len(self.strtab) % 2
+
+    def write_into(self, buf, pos):
+        end = pos + self.get_size()
+        struct.pack_into(">IH", buf, pos, self._get_num_words() / 2, len(self.strtab))
+        pos += 6
+        buf[pos:pos + len(self.strtab)] = self.strtab
+        pos += len(self.strtab)
+        # unit blocks
+        for unit in self.units:
+            struct.pack_into(">HHH", buf, pos, unit.name_off, unit.first_hunk_long_off, len(unit.index_hunks))
+            pos += 6
+            for index in unit.index_hunks:
                 num_refs = len(index.sym_refs)
-                self._write_word(f, num_refs)
+                struct.pack_into(">HHHH", buf, pos, index.name_off, index.hunk_longs, index.hunk_ctype, num_refs)
+                pos += 8
                 for sym_ref in index.sym_refs:
-                    self._write_word(f, sym_ref.name_off)
-                # defs
-                num_defs = len(index.sym_defs)
-                self._write_word(f, num_defs)
+                    struct.pack_into(">H", buf, pos, sym_ref.name_off)
+                    pos += 2
+                struct.pack_into(">H", buf, pos, len(index.sym_defs))
+                pos += 2
                 for sym_def in index.sym_defs:
-                    self._write_word(f, sym_def.name_off)
-                    self._write_word(f, sym_def.value)
-                    self._write_word(f, sym_def.sym_ctype)
-                # count words
-                num_words += 5 + num_refs + num_defs * 3
-        # alignment word?
-        if num_words % 2 == 1:
-            num_words += 1
-            self._write_word(f, 0)
-        # fill in real size
-        pos = f.tell()
-        f.seek(num_longs_pos, 0)
-        self._write_long(f, num_words / 2)
-        f.seek(pos, 0)
+                    struct.pack_into(">HHH", buf, pos, sym_def.name_off, sym_def.value, sym_def.sym_ctype)
+                    pos += 6
+        # alignment word is zero
+        return end
 
 
 # map the hunk types to the block classes
@@ -753,6 +1036,8 @@ hunk_block_type_map = {
     HUNK_DREL32: HunkRelocLongBlock,
     HUNK_DREL16: HunkRelocLongBlock,
     HUNK_DREL8: HunkRelocLongBlock,
+    HUNK_RELRELOC32: HunkRelocLongBlock,
+    HUNK_ABSRELOC16: HunkRelocLongBlock,
     HUNK_EXT: HunkExtBlock,
     # New Library
     HUNK_LIB: HunkLibBlock,
@@ -775,14 +1060,23 @@ class HunkBlockFile:
     def set_blocks(self, blocks):
         self.blocks = blocks
 
-    def read_path(self, path_name, is_load_seg=False):
+    def read_path(self, path_name, is_load_seg=False, skip_data=False):
         f = open(path_name, "rb")
-        self.read(f, is_load_seg)
+        self.read(f, is_load_seg, skip_data)
         f.close()
 
-    def read(self, f, is_load_seg=False):
-        """read a hunk file and fill block list"""
-        while True:
+    @profile.timed("block_read")
+    def read(self, f, is_load_seg=False, skip_data=False, max_ends=None, stop_at=()):
+        """read a hunk file and fill block list.
+           with skip_data the segment payloads are not read but only
+           their data_offset and data_size are recorded.
+           with max_ends reading stops after that many HUNK_END blocks,
+           blocks in stop_at end reading after they were read."""
+        if profile.enabled:
+            start_pos = f.tell()
+            num_blocks = len(self.blocks)
+        num_ends = 0
+        while max_ends is None or num_ends < max_ends:
             # first read block id
             tag = f.read(4)
             # EOF
@@ -803,10 +1097,22 @@ class HunkBlockFile:
                 # create block and parse
                 block = blk_type()
                 block.blk_id = blk_id
-                block.parse(f)
+                block.raw_id = struct.unpack(">I", tag)[0]
+                block.file_offset = f.tell() - 4
+                if skip_data and blk_type is HunkSegmentBlock:
+                    block.parse(f, skip_data=True)
+                else:
+                    block.parse(f)
                 self.blocks.append(block)
+                if blk_id == HUNK_END:
+                    num_ends += 1
+                elif blk_id in stop_at:
+                    break
             else:
                 raise HunkParseError("Unsupported hunk type: %04d" % blk_id)
+        if profile.enabled:
+            profile.count("blocks", len(self.blocks) - num_blocks)
+            profile.count("bytes_read", f.tell() - start_pos)
 
     def write_path(self, path_name):
         f = open(path_name, "wb")
@@ -814,17 +1120,37 @@ class HunkBlockFile:
         f.close()
 
     def write(self, f, is_load_seg=False):
-        """write a hunk file back to file object"""
+        """write a hunk file back to file object. the file is built in
+           one buffer and written at once, f needs not be seekable"""
+        f.write(self.encode(is_load_seg))
+
+    def get_size(self):
+        """return the size of the encoded file"""
+        return sum(4 + block.get_size() for block in self.blocks)
+
+    def encode(self, is_load_seg=False):
+        """return the encoded file as a bytearray"""
+        buf = bytearray(self.get_size())
+        pos = 0
         for block in self.blocks:
-            # write block id
-            block_id = block.blk_id
-            # convert id
-            if is_load_seg and block_id == HUNK_RELOC32SHORT:
+            block_id = self.get_block_id(block)
+            # convert id of new blocks
+            if is_load_seg and block_id == HUNK_RELOC32SHORT and block.raw_id is None:
                 block_id = HUNK_DREL32
-            block_id_raw = struct.pack(">I", block_id)
-            f.write(block_id_raw)
-            # write block itself
-            block.write(f)
+            struct.pack_into(">I", buf, pos, block_id)
+            pos = block.write_into(buf, pos + 4)
+        return buf
+
+    @staticmethod
+    def get_block_id(block):
+        """return the id to write for a block: the id it was read with
+           (memory flags, v37 HUNK_RELOC32SHORT) unless its type changed"""
+        raw_id = block.raw_id
+        if raw_id is not None:
+            raw_type = raw_id & HUNK_TYPE_MASK
+            if raw_type == block.blk_id or (raw_type == HUNK_DREL32 and block.blk_id == HUNK_RELOC32SHORT):
+                return raw_id
+        return block.blk_id
 
     def detect_type(self):
         """look at blocks and try to deduce the type of hunk file"""
@@ -871,6 +1197,329 @@ class HunkBlockFile:
         return res
 
 
+class HunkPatcher:
+    """patch an executable or object file in place. segment bytes are
+       written at their file offset, changed blocks of the same size are
+       written over the old ones. if a block changes its size, the file is
+       rewritten from that block on with the unchanged blocks copied raw"""
+
+    def __init__(self, f):
+        self.f = f
+        bf = HunkBlockFile()
+        file_type = bf.peek_type(f)
+        if file_type not in (TYPE_LOADSEG, TYPE_UNIT):
+            raise HunkParseError("only executables and object files can be patched")
+        bf.read(f, is_load_seg=file_type == TYPE_LOADSEG, skip_data=True)
+        self.blocks = bf.get_blocks()
+        f.seek(0, 2)
+        self.file_size = f.tell()
+        self.sizes = {}  # block -> size in the file including the id
+        self._update_sizes()
+        self.changed = set()
+        self.dirty = None  # first index with inserted or removed blocks
+
+    def _update_sizes(self):
+        ends = [blk.file_offset for blk in self.blocks[1:]] + [self.file_size]
+        self.sizes = dict((blk, end - blk.file_offset) for blk, end in zip(self.blocks, ends))
+
+    def get_hunk_blocks(self, hunk):
+        """return the blocks of a hunk from its segment block to its end"""
+        num = -1
+        res = []
+        for blk in self.blocks:
+            if blk.blk_id in loadseg_valid_begin_hunks:
+                num += 1
+            if num == hunk:
+                res.append(blk)
+                if blk.blk_id == HUNK_END:
+                    break
+        if not res:
+            raise HunkParseError("no hunk #%d" % hunk)
+        return res
+
+    def write_data(self, hunk, offset, data):
+        """overwrite bytes of the stored data of a hunk"""
+        blk = self.get_hunk_blocks(hunk)[0]
+        if offset < 0 or offset + len(data) > blk.data_size or blk.blk_id == HUNK_BSS:
+            raise HunkParseError("patch outside of the data of hunk #%d" % hunk)
+        self.f.seek(blk.data_offset + offset)
+        self.f.write(data)
+
+    def update_block(self, blk):
+        """mark a block as changed after its fields were modified"""
+        if blk.blk_id in loadseg_valid_begin_hunks:
+            raise HunkParseError("segment data is patched with write_data")
+        self.changed.add(blk)
+
+    def insert_block(self, index, blk):
+        self.blocks.insert(index, blk)
+        self.changed.add(blk)
+        self._set_dirty(index)
+
+    def remove_block(self, blk):
+        index = self.blocks.index(blk)
+        del self.blocks[index]
+        self.changed.discard(blk)
+        self._set_dirty(index)
+
+    def _set_dirty(self, index):
+        if self.dirty is None or index < self.dirty:
+            self.dirty = index
+
+    def set_symbols(self, hunk, symbols):
+        """replace the HUNK_SYMBOL block of a hunk, symbols: [(name, offset)]"""
+        blks = self.get_hunk_blocks(hunk)
+        for blk in blks:
+            if blk.blk_id == HUNK_SYMBOL:
+                if symbols:
+                    blk.symbols = list(symbols)
+                    self.update_block(blk)
+                else:
+                    self.remove_block(blk)
+                return
+        if symbols:
+            # before HUNK_END or at the end of a hunk without one
+            index = self.blocks.index(blks[-1])
+            if blks[-1].blk_id != HUNK_END:
+                index += 1
+            self.insert_block(index, HunkSymbolBlock(list(symbols)))
+
+    def rename_symbol(self, old, new):
+        """rename a symbol in all HUNK_SYMBOL and HUNK_EXT blocks, return count"""
+        num = 0
+        for blk in self.blocks:
+            if blk.blk_id == HUNK_SYMBOL:
+                for i, (name, off) in enumerate(blk.symbols):
+                    if name == old:
+                        blk.symbols[i] = (new, off)
+                        self.update_block(blk)
+                        num += 1
+            elif blk.blk_id == HUNK_EXT:
+                for e in blk.entries:
+                    if e.name == old:
+                        e.name = new
+                        self.update_block(blk)
+                        num += 1
+        return num
+
+    @staticmethod
+    def _encode(blk):
+        buf = bytearray(4 + blk.get_size())
+        struct.pack_into(">I", buf, 0, HunkBlockFile.get_block_id(blk))
+        blk.write_into(buf, 4)
+        return buf
+
+    def flush(self):
+        """write the changes to the file"""
+        f = self.f
+        first = self.dirty
+        for i, blk in enumerate(self.blocks):
+            if first is not None and i >= first:
+                break
+            if blk in self.changed:
+                data = self._encode(blk)
+                if len(data) == self.sizes[blk]:
+                    f.seek(blk.file_offset)
+                    f.write(data)
+                else:
+                    first = i
+        if first is not None:
+            # everything from the first moved block on is written again
+            if first > 0:
+                prev = self.blocks[first - 1]
+                start = prev.file_offset + self.sizes[prev]
+            else:
+                start = 0
+            f.seek(start)
+            old = f.read(self.file_size - start)
+            parts = []
+            pos = start
+            for blk in self.blocks[first:]:
+                if blk in self.changed:
+                    data = self._encode(blk)
+                else:
+                    end = blk.file_offset - start
+                    data = old[end:end + self.sizes[blk]]
+                if blk.blk_id in loadseg_valid_begin_hunks:
+                    blk.data_offset = pos + 8
+                blk.file_offset = pos
+                parts.append(data)
+                pos += len(data)
+            f.seek(start)
+            for data in parts:
+                f.write(data)
+            f.truncate(pos)
+            self.file_size = pos
+            self._update_sizes()
+        f.flush()
+        self.changed.clear()
+        self.dirty = None
+
+
+class HunkStripper:
+    """copy a hunk file without the blocks of the given ids. only block ids
+       and the counts giving the length of a block are read, kept blocks are
+       copied byte for byte. input and output are used sequentially and may
+       be pipes. an overlay table holds file offsets, so it and the overlay
+       nodes after it are copied as they are. HUNK_LIB is copied as a whole"""
+
+    CHUNK_SIZE = 256 * 1024
+    OVERLAY_ERROR = "can't strip the root node of an overlaid file"
+
+    def __init__(self, drop_ids=(HUNK_SYMBOL, HUNK_DEBUG)):
+        self.drop_ids = drop_ids
+        self.f = None
+        self.out = None
+        self.keep = True
+        self.num_blocks = 0
+        self.num_dropped = 0
+        self.bytes_dropped = 0
+
+    def strip(self, f, out):
+        """copy f to out and return the number of dropped blocks. seekable
+           input is checked for an overlay table before copying"""
+        if self._is_seekable(f):
+            self._check_overlay(f)
+        self.f = f
+        self.out = out
+        is_load_seg = None
+        while True:
+            tag = f.read(4)
+            # EOF
+            if len(tag) == 0:
+                break
+            elif len(tag) != 4:
+                raise HunkParseError("Hunk block tag too short!")
+            if is_load_seg is None and tag in cruncher_magics:
+                raise HunkParseError("%s crunched files can't be stripped" % cruncher_magics[tag])
+            blk_id = struct.unpack(">I", tag)[0] & HUNK_TYPE_MASK
+            if is_load_seg is None:
+                is_load_seg = blk_id == HUNK_HEADER
+            self.num_blocks += 1
+            if blk_id == HUNK_OVERLAY:
+                if self.bytes_dropped > 0:
+                    raise HunkParseError(self.OVERLAY_ERROR)
+                out.write(tag)
+                self._copy_rest()
+                break
+            self.keep = blk_id not in self.drop_ids
+            if self.keep:
+                out.write(tag)
+            else:
+                self.num_dropped += 1
+                self.bytes_dropped += 4
+            self._pass_block(blk_id, is_load_seg)
+        self.keep = True
+        return self.num_dropped
+
+    @staticmethod
+    def _is_seekable(f):
+        try:
+            f.seek(0, 1)
+        except (IOError, AttributeError):
+            return False
+        return True
+
+    def _check_overlay(self, f):
+        """raise if blocks would be dropped before an overlay table"""
+        pos = f.tell()
+        bf = HunkBlockFile()
+        if bf.peek_type(f) != TYPE_LOADSEG:
+            return
+        bf.read(f, is_load_seg=True, skip_data=True, stop_at=(HUNK_OVERLAY,))
+        f.seek(pos)
+        blocks = bf.get_blocks()
+        if blocks[-1].blk_id == HUNK_OVERLAY and any(blk.blk_id in self.drop_ids for blk in blocks):
+            raise HunkParseError(self.OVERLAY_ERROR)
+
+    def _pass_block(self, blk_id, is_load_seg):
+        if blk_id in (HUNK_CODE, HUNK_DATA, HUNK_DEBUG, HUNK_LIB, HUNK_INDEX):
+            self._pass(self._read_long() * 4)
+        elif blk_id == HUNK_BSS:
+            self._read_long()
+        elif blk_id in (HUNK_END, HUNK_BREAK):
+            pass
+        elif blk_id in (HUNK_UNIT, HUNK_NAME):
+            self._pass((self._read_long() & 0xffffff) * 4)
+        elif blk_id == HUNK_SYMBOL:
+            while True:
+                num_longs = self._read_long()
+                if num_longs == 0:
+                    break
+                # name and value
+                self._pass((num_longs & 0xffffff) * 4 + 4)
+        elif blk_id == HUNK_RELOC32SHORT or (blk_id == HUNK_DREL32 and is_load_seg):
+            num_words = 0
+            while True:
+                num_offs = struct.unpack(">H", self._read(2))[0]
+                num_words += 1
+                if num_offs == 0:
+                    break
+                self._pass(2 + num_offs * 2)
+                num_words += num_offs + 1
+            # pad to long
+            if num_words % 2 == 1:
+                self._read(2)
+        elif hunk_block_type_map.get(blk_id) is HunkRelocLongBlock:
+            while True:
+                num = self._read_long()
+                if num == 0:
+                    break
+                self._pass(4 + num * 4)
+        elif blk_id == HUNK_EXT:
+            while True:
+                tag = self._read_long()
+                if tag == 0:
+                    break
+                ext_type = tag >> 24
+                self._pass((tag & 0xffffff) * 4)
+                if ext_type == EXT_ABSCOMMON or ext_type == EXT_RELCOMMON:
+                    self._read_long()
+                if ext_type >= 0x80:
+                    self._pass(self._read_long() * 4)
+                else:
+                    self._read_long()
+        elif blk_id == HUNK_HEADER:
+            while True:
+                num_longs = self._read_long()
+                if num_longs == 0:
+                    break
+                self._pass((num_longs & 0xffffff) * 4)
+            table_size, first_hunk, last_hunk = struct.unpack(">III", self._read(12))
+            for a in xrange(last_hunk - first_hunk + 1):
+                # both memory flags set: attributes follow
+                if self._read_long() >> 30 == 3:
+                    self._read_long()
+        else:
+            raise HunkParseError("Unsupported hunk type: %04d" % blk_id)
+
+    def _read(self, size):
+        data = self.f.read(size)
+        if len(data) != size:
+            raise HunkParseError("unexpected end of file")
+        if self.keep:
+            self.out.write(data)
+        else:
+            self.bytes_dropped += size
+        return data
+
+    def _read_long(self):
+        return struct.unpack(">I", self._read(4))[0]
+
+    def _pass(self, size):
+        while size > 0:
+            n = min(size, self.CHUNK_SIZE)
+            self._read(n)
+            size -= n
+
+    def _copy_rest(self):
+        while True:
+            data = self.f.read(self.CHUNK_SIZE)
+            if not data:
+                break
+            self.out.write(data)
+
+
 class DebugLineEntry:
     def __init__(self, offset, src_line, flags=0):
         self.offset = offset
@@ -987,12 +1636,23 @@ class Segment:
         self.size = size
         self.data_offset = data_offset
         self.data = data
+        self.data_size = len(data) if data is not None else 0
+        # memory flags of the hunk: 1 chip, 2 fast, 3 mem_attrs given
         self.flags = flags
+        self.mem_attrs = 0
         self.relocs = {}
         self.symtab = None
         self.id = None
         self.file_data = None
         self.debug_line = None
+        # object files only
+        self.name = None
+        self.unit = None
+        self.ext_defs = []  # (name, ext_type, value)
+        self.ext_refs = []  # (name, ext_type, offsets, bss_size)
+        self.extra_relocs = []  # (blk_id, to_seg, offsets) other than ABSRELOC32
+        # overlay node of the segment, None in the root node
+        self.overlay_node = None
 
     def __str__(self):
         # relocs
@@ -1032,6 +1692,10 @@ class Segment:
     def get_data(self):
         return self.data
 
+    def get_data_size(self):
+        """size of the initialized data stored in the file"""
+        return self.data_size
+
     def add_reloc(self, to_seg, relocs):
         self.relocs[to_seg] = relocs
 
@@ -1104,6 +1768,7 @@ class BinImage:
         self.segments = []
         self.file_data = None
         self.file_type = file_type
+        self.overlay_nodes = []
 
     def __str__(self):
         return "<%s>" % ",".join(map(str, self.segments))
@@ -1190,6 +1855,7 @@ class HunkDebugAny:
 class HunkDebug:
     def encode(self, debug_info):
         """encode a debug info and return a debug_data chunk"""
+        import StringIO
         out = StringIO.StringIO()
         # +0: base offset
         self._write_long(out, debug_info.base_offset)
@@ -1281,6 +1947,12 @@ class HunkSegment:
         self.reloc_blks = None
         self.debug_blks = None
         self.debug_infos = None
+        self.name_blk = None
+        self.ext_blks = None
+        # memory flags and attributes of the hunk, alloc size if not data size
+        self.mem_flags = 0
+        self.mem_attrs = 0
+        self.size_longs = None
 
     def __repr__(self):
         return "[seg=%s,symbol=%s,reloc=%s,debug=%s,debug_info=%s]" % \
@@ -1292,11 +1964,11 @@ class HunkSegment:
 
     def setup_code(self, data):
         data, size_longs = self._pad_data(data)
-        self.seg_blk = HunkSegmentBlock(HUNK_CODE, data, size_longs)
+        self.seg_blk = HunkSegmentBlock(HUNK_CODE, data, size_longs=size_longs)
 
     def setup_data(self, data):
         data, size_longs = self._pad_data(data)
-        self.seg_blk = HunkSegmentBlock(HUNK_DATA, data, size_longs)
+        self.seg_blk = HunkSegmentBlock(HUNK_DATA, data, size_longs=size_longs)
 
     @staticmethod
     def _pad_data(data):
@@ -1310,18 +1982,44 @@ class HunkSegment:
 
     def setup_bss(self, size_bytes):
         size_longs = int((size_bytes + 3) / 4)
-        self.seg_blk = HunkSegmentBlock(HUNK_BSS, None, size_longs)
+        self.seg_blk = HunkSegmentBlock(HUNK_BSS, None, size_longs=size_longs)
 
     def setup_relocs(self, relocs, force_long=False):
-        """relocs: ((hunk_num, (off1, off2, ...)), ...)"""
-        if force_long:
-            use_short = False
-        else:
-            use_short = self._are_relocs_short(relocs)
-        if use_short:
-            self.reloc_blks = [HunkRelocWordBlock(HUNK_RELOC32SHORT, relocs)]
-        else:
-            self.reloc_blks = [HunkRelocLongBlock(HUNK_ABSRELOC32, relocs)]
+        """relocs: ((hunk_num, (off1, off2, ...)), ...)
+           offsets are sorted and duplicates dropped. offsets that fit in a
+           word go to a HUNK_RELOC32SHORT block and the rest to
+           HUNK_ABSRELOC32 unless all long tables are smaller.
+           force_long writes HUNK_ABSRELOC32 only (LoadSeg before V37)"""
+        import bisect
+
+        merged = {}
+        for hunk_num, offsets in relocs:
+            merged.setdefault(hunk_num, set()).update(offsets)
+        long_relocs = []
+        short_relocs = []
+        for hunk_num in sorted(merged):
+            offsets = sorted(merged[hunk_num])
+            if len(offsets) == 0:
+                continue
+            if force_long or hunk_num > 0xffff:
+                long_relocs.append((hunk_num, offsets))
+                continue
+            n = bisect.bisect_right(offsets, 0xffff)
+            if n > 0:
+                short_relocs.append((hunk_num, offsets[:n]))
+            if n < len(offsets):
+                long_relocs.append((hunk_num, offsets[n:]))
+        blks = []
+        if long_relocs:
+            blks.append(HunkRelocLongBlock(HUNK_ABSRELOC32, long_relocs))
+        if short_relocs:
+            blks.append(HunkRelocWordBlock(HUNK_RELOC32SHORT, short_relocs))
+            # a second block costs its id and end marker
+            all_long = HunkRelocLongBlock(HUNK_ABSRELOC32, [(hunk_num, sorted(merged[hunk_num]))
+                                                            for hunk_num in sorted(merged) if merged[hunk_num]])
+            if 4 + all_long.get_size() <= sum(4 + blk.get_size() for blk in blks):
+                blks = [all_long]
+        self.reloc_blks = blks
 
     def setup_symbols(self, symbols):
         """symbols: ((name, off), ...)"""
@@ -1338,14 +2036,6 @@ class HunkSegment:
             self.debug_blks = []
         self.debug_blks.append(blk)
 
-    @staticmethod
-    def _are_relocs_short(relocs):
-        for hunk_num, offsets in relocs:
-            for off in offsets:
-                if off > 65535:
-                    return False
-        return True
-
     def _debug_infos_str(self):
         if self.debug_infos is None:
             return "n/a"
@@ -1375,6 +2065,8 @@ class HunkSegment:
             blk_id = blk.blk_id
             if blk_id in loadseg_valid_begin_hunks:
                 self.seg_blk = blk
+                if blk.raw_id is not None:
+                    self.mem_flags = blk.raw_id >> 30
             elif blk_id == HUNK_SYMBOL:
                 if self.symbol_blk is None:
                     self.symbol_blk = blk
@@ -1390,10 +2082,16 @@ class HunkSegment:
                     if self.debug_infos is None:
                         self.debug_infos = []
                     self.debug_infos.append(debug_info)
-            elif blk_id in (HUNK_ABSRELOC32, HUNK_RELOC32SHORT):
+            elif blk_id in hunk_reloc_types:
                 if self.reloc_blks is None:
                     self.reloc_blks = []
                 self.reloc_blks.append(blk)
+            elif blk_id == HUNK_NAME:
+                self.name_blk = blk
+            elif blk_id == HUNK_EXT:
+                if self.ext_blks is None:
+                    self.ext_blks = []
+                self.ext_blks.append(blk)
             else:
                 raise HunkParseError("invalid hunk block")
 
@@ -1401,7 +2099,7 @@ class HunkSegment:
         # already has blocks?
         if self.blocks is not None:
             blocks += self.blocks
-            return self.seg_blk.size_longs
+            return self._get_size_longs()
         # start with segment block
         if self.seg_blk is None:
             raise HunkParseError("no segment block!")
@@ -1418,6 +2116,11 @@ class HunkSegment:
         # store blocks
         blocks += self.blocks
         # return size of segment
+        return self._get_size_longs()
+
+    def _get_size_longs(self):
+        if self.size_longs is not None:
+            return self.size_longs
         return self.seg_blk.size_longs
 
 
@@ -1439,21 +2142,120 @@ class BinFmtHunk:
         bf_type = bf.peek_type(fobj)
         return bf_type == TYPE_LOADSEG
 
-    def load_image(self, path):
+    @staticmethod
+    def is_object_fobj(fobj):
+        """check if a given fobj is a hunk object file"""
+        bf = HunkBlockFile()
+        bf_type = bf.peek_type(fobj)
+        return bf_type == TYPE_UNIT
+
+    def load_object_fobj(self, fobj, skip_data=False):
+        """load a BinImage with the hunks of all units of an object file"""
+        bf = HunkBlockFile()
+        bf.read(fobj, skip_data=skip_data)
+        obj = HunkObjectFile()
+        obj.parse_block_file(bf)
+        return self.create_image_from_object_file(obj)
+
+    @staticmethod
+    def load_lib_index(fobj):
+        """read only the HUNK_INDEX of a link library"""
+        index = HunkLibIndex()
+        index.read(fobj)
+        return index
+
+    def load_lib_units(self, fobj, index, units, skip_data=False):
+        """load a BinImage with the hunks of some units of a link library.
+           sort the units by file_offset for sequential reads"""
+        obj = index.load_units(fobj, units, skip_data)
+        return self.create_image_from_object_file(obj)
+
+    def load_image(self, path, cache=None):
         """load a BinImage from a hunk file given via path"""
         with open(path, "rb") as f:
-            return self.load_image_fobj(f)
-
-    def load_image_fobj(self, fobj):
-        """load a BinImage from a hunk file given via file obj"""
-        # read the hunk blocks
+            return self.load_image_fobj(f, cache=cache)
+
+    def load_image_fobj(self, fobj, skip_data=False, cache=None):
+        """load a BinImage from a hunk file given via file obj.
+           with skip_data segments carry no data but only the data_offset
+           and data_size of their payload in fobj.
+           with a ParseCache a cached layout of the same file is used
+           instead of parsing it"""
+        key = None
+        if cache is not None:
+            with profile.phase("cache_get"):
+                key = cache.get_key(fobj)
+                bi = cache.get(key)
+            if bi is not None:
+                profile.count("cache_hits")
+                if not skip_data:
+                    self._read_segment_data(fobj, bi)
+                return bi
+        # read the hunk blocks, overlay nodes are loaded on demand
         bf = HunkBlockFile()
-        bf.read(fobj, is_load_seg=True)
+        bf.read(fobj, is_load_seg=True, skip_data=skip_data, stop_at=(HUNK_OVERLAY,))
         # derive load seg file
         lsf = HunkLoadSegFile()
         lsf.parse_block_file(bf)
         # convert load seg file
-        return self.create_image_from_load_seg_file(lsf)
+        bi = self.create_image_from_load_seg_file(lsf)
+        bi.overlay_nodes = lsf.get_overlay_nodes()
+        # the cache does not keep the overlay table
+        if cache is not None and len(bi.overlay_nodes) == 0:
+            cache.put(key, bi)
+        return bi
+
+    def load_overlay_node(self, fobj, bin_img, node, skip_data=False):
+        """add the segments of an overlay node of a BinImage loaded with
+           load_image_fobj(). parent nodes are loaded first. return the
+           new segments"""
+        if node.segments is not None:
+            return []
+        new_segs = []
+        # hunk numbers of the root and the parent nodes
+        hunks = {}
+        for seg in bin_img.get_segments():
+            if seg.overlay_node is None:
+                hunks[seg.id] = seg
+        for parent in get_overlay_parents(bin_img.overlay_nodes, node):
+            new_segs.extend(self.load_overlay_node(fobj, bin_img, parent, skip_data))
+            for i, seg in enumerate(parent.segments):
+                hunks[parent.first_hunk + i] = seg
+        # read the node up to its BREAK
+        fobj.seek(node.offset, 0)
+        bf = HunkBlockFile()
+        bf.read(fobj, is_load_seg=True, skip_data=skip_data, stop_at=(HUNK_BREAK, HUNK_OVERLAY))
+        lsf = HunkLoadSegFile()
+        lsf.parse_block_file(bf)
+        node.first_hunk = lsf.hdr_blk.first_hunk
+        node.segments = []
+        for i, seg in enumerate(lsf.get_segments()):
+            bs = self._create_segment(seg, seg.size_longs * 4)
+            bs.overlay_node = node
+            bin_img.add_segment(bs)
+            node.segments.append(bs)
+            hunks[node.first_hunk + i] = bs
+        for seg in node.segments:
+            hseg = seg.file_data
+            if hseg.reloc_blks is not None:
+                try:
+                    self._add_hunk_relocs(hseg.reloc_blks, seg, hunks)
+                except KeyError as e:
+                    raise HunkParseError("Invalid hunk in overlay relocations: %s" % e)
+            if hseg.symbol_blk is not None:
+                self._add_hunk_symbols(hseg.symbol_blk, seg)
+            if hseg.debug_infos is not None:
+                self._add_debug_infos(hseg.debug_infos, seg)
+        new_segs.extend(node.segments)
+        return new_segs
+
+    @staticmethod
+    def _read_segment_data(fobj, bin_img):
+        """fill in the segment data of an image from the file"""
+        for seg in bin_img.get_segments():
+            if seg.data_size > 0:
+                fobj.seek(seg.data_offset, 0)
+                seg.data = fobj.read(seg.data_size)
 
     def save_image(self, path, bin_img):
         """save a BinImage to a hunk file given via path"""
@@ -1482,6 +2284,10 @@ class BinFmtHunk:
                 lseg.setup_bss(seg.size)
             else:
                 raise HunkParseError("Unknown Segment Type in BinImage: %d" % seg_type)
+            # keep the alloc size and memory type
+            lseg.size_longs = (seg.size + 3) / 4
+            lseg.mem_flags = seg.flags
+            lseg.mem_attrs = seg.mem_attrs
             # add relocs
             self._add_bin_img_relocs(lseg, seg)
             # add symbols
@@ -1522,6 +2328,9 @@ class BinFmtHunk:
         if debug_line is not None:
             for file in debug_line.get_files():
                 src_file = file.get_src_file()
+                dir_name = file.get_dir_name()
+                if dir_name:
+                    src_file = dir_name + "/" + src_file
                 base_offset = file.get_base_offset()
                 dl = HunkDebugLine(src_file, base_offset)
                 for e in file.get_entries():
@@ -1532,29 +2341,14 @@ class BinFmtHunk:
                     dl.add_entry(offset, hunk_src_line)
                 hunk_seg.setup_debug(dl)
 
+    @profile.timed("image_create")
     def create_image_from_load_seg_file(self, lsf):
         """create a BinImage from a HunkLoadSegFile object"""
         bi = BinImage(BIN_IMAGE_TYPE_HUNK)
         bi.set_file_data(lsf)
         segs = lsf.get_segments()
         for seg in segs:
-            # what type of segment to we have?
-            blk_id = seg.seg_blk.blk_id
-            size = seg.size_longs * 4
-            data_offset = seg.seg_blk.data_offset
-            data = seg.seg_blk.data
-            if blk_id == HUNK_CODE:
-                seg_type = SEGMENT_TYPE_CODE
-            elif blk_id == HUNK_DATA:
-                seg_type = SEGMENT_TYPE_DATA
-            elif blk_id == HUNK_BSS:
-                seg_type = SEGMENT_TYPE_BSS
-            else:
-                raise HunkParseError("Unknown Segment Type for BinImage: %d" % blk_id)
-            # create seg
-            bs = Segment(seg_type, size, data, data_offset)
-            bs.set_file_data(seg)
-            bi.add_segment(bs)
+            bi.add_segment(self._create_segment(seg, seg.size_longs * 4))
         # add relocations if any
         bi_segs = bi.get_segments()
         for seg in bi_segs:
@@ -1574,6 +2368,75 @@ class BinFmtHunk:
 
         return bi
 
+    @staticmethod
+    def _create_segment(seg, size):
+        """create a Segment for a HunkSegment"""
+        # what type of segment to we have?
+        blk_id = seg.seg_blk.blk_id
+        data_offset = seg.seg_blk.data_offset
+        data = seg.seg_blk.data
+        if blk_id == HUNK_CODE:
+            seg_type = SEGMENT_TYPE_CODE
+        elif blk_id == HUNK_DATA:
+            seg_type = SEGMENT_TYPE_DATA
+        elif blk_id == HUNK_BSS:
+            seg_type = SEGMENT_TYPE_BSS
+        else:
+            raise HunkParseError("Unknown Segment Type for BinImage: %d" % blk_id)
+        # create seg
+        bs = Segment(seg_type, size, data, data_offset, seg.mem_flags)
+        bs.mem_attrs = seg.mem_attrs
+        bs.data_size = seg.seg_blk.data_size
+        bs.set_file_data(seg)
+        if seg.name_blk is not None:
+            bs.name = seg.name_blk.name
+        return bs
+
+    def create_image_from_object_file(self, obj):
+        """create a BinImage from a HunkObjectFile object.
+           the segments of all units are added in order, relocations only
+           refer to segments of the same unit"""
+        bi = BinImage(BIN_IMAGE_TYPE_HUNK)
+        bi.set_file_data(obj)
+        for unit in obj.get_units():
+            first = len(bi.get_segments())
+            for seg in unit.segments:
+                # object hunks carry their size
+                bs = self._create_segment(seg, seg.seg_blk.size_longs * 4)
+                bs.unit = unit
+                bi.add_segment(bs)
+            unit_segs = bi.get_segments()[first:]
+            for seg in unit_segs:
+                hseg = seg.file_data
+                if hseg.reloc_blks is not None:
+                    abs_blks = []
+                    for blk in hseg.reloc_blks:
+                        if blk.blk_id in (HUNK_ABSRELOC32, HUNK_RELOC32SHORT):
+                            abs_blks.append(blk)
+                        else:
+                            for hunk_num, offsets in blk.relocs:
+                                if hunk_num >= len(unit_segs):
+                                    raise HunkParseError("Invalid hunk in relocations: %d" % hunk_num)
+                                seg.extra_relocs.append((blk.blk_id, unit_segs[hunk_num], offsets))
+                    self._add_hunk_relocs(abs_blks, seg, unit_segs)
+                if hseg.ext_blks is not None:
+                    self._add_hunk_exts(hseg.ext_blks, seg)
+                if hseg.symbol_blk is not None:
+                    self._add_hunk_symbols(hseg.symbol_blk, seg)
+                if hseg.debug_infos is not None:
+                    self._add_debug_infos(hseg.debug_infos, seg)
+        return bi
+
+    @staticmethod
+    def _add_hunk_exts(blks, seg):
+        """add external definitions and references to a segment"""
+        for blk in blks:
+            for e in blk.entries:
+                if e.ext_type >= 0x80:
+                    seg.ext_refs.append((e.name, e.ext_type, e.ref_offsets, e.bss_size))
+                else:
+                    seg.ext_defs.append((e.name, e.ext_type, e.def_value))
+
     @staticmethod
     def _add_hunk_relocs(blks, seg, all_segs):
         """add relocations to a segment"""
@@ -1594,6 +2457,7 @@ class BinFmtHunk:
                     r = Reloc(o)
                     rl.add_reloc(r)
                 seg.add_reloc(to_seg, rl)
+                profile.count("relocs", len(offsets))
 
     @staticmethod
     def _add_hunk_symbols(blk, seg):
@@ -1640,6 +2504,7 @@ class HunkLoadSegFile:
 
     def __init__(self):
         self.hdr_blk = None
+        self.overlay_blk = None
         self.segments = []
 
     def get_segments(self):
@@ -1648,6 +2513,12 @@ class HunkLoadSegFile:
     def add_segment(self, seg):
         self.segments.append(seg)
 
+    def get_overlay_nodes(self):
+        if self.overlay_blk is None:
+            return []
+        return get_overlay_nodes(self.overlay_blk.get_entries())
+
+    @profile.timed("segment_assembly")
     def parse_block_file(self, bf):
         """assign hunk blocks into segments"""
         # get file blocks
@@ -1664,8 +2535,14 @@ class HunkLoadSegFile:
         cur = None
         for blk in blks[1:]:
             blk_id = blk.blk_id
+            # overlay table ends the root node, BREAK ends an overlay node
+            if blk_id == HUNK_OVERLAY:
+                self.overlay_blk = blk
+                break
+            elif blk_id == HUNK_BREAK:
+                break
             # split by END block
-            if blk_id == HUNK_END:
+            elif blk_id == HUNK_END:
                 cur = None
             # add non end block to list
             else:
@@ -1716,6 +2593,10 @@ class HunkLoadSegFile:
         for i in xrange(n):
             self.segments[i].size_longs = hdr_blk.hunk_table[i]
             self.segments[i].size = self.segments[i].size_longs * 4
+            if i < len(hdr_blk.hunk_flags):
+                self.segments[i].mem_flags = hdr_blk.hunk_flags[i]
+                self.segments[i].mem_attrs = hdr_blk.hunk_mem_attrs.get(i, 0)
+        profile.count("segments", n)
 
     def create_block_file(self):
         """create a HunkBlockFile from the segments given"""
@@ -1723,17 +2604,299 @@ class HunkLoadSegFile:
         self.hdr_blk = HunkHeaderBlock()
         blks = [self.hdr_blk]
         sizes = []
-        for seg in self.segments:
+        flags = []
+        for i, seg in enumerate(self.segments):
             size = seg.create(blks)
             sizes.append(size)
+            flags.append(seg.mem_flags)
+            if seg.mem_flags == 3:
+                self.hdr_blk.hunk_mem_attrs[i] = seg.mem_attrs
             # add HUNK_END
             blks.append(HunkEndBlock())
         # finally setup header
-        self.hdr_blk.setup(sizes)
+        self.hdr_blk.setup(sizes, flags)
         # create HunkBlockFile
         return HunkBlockFile(blks)
 
 
+class HunkUnit:
+    """the hunks of one HUNK_UNIT"""
+
+    def __init__(self, name):
+        self.name = name
+        self.segments = []
+
+
+class HunkObjectFile:
+    """manage an object file made of HUNK_UNITs"""
+
+    def __init__(self):
+        self.units = []
+
+    def get_units(self):
+        return self.units
+
+    def parse_block_file(self, bf):
+        """assign hunk blocks into units and segments"""
+        blks = bf.get_blocks()
+        if blks is None or len(blks) == 0:
+            raise HunkParseError("no hunk blocks found!")
+        if blks[0].blk_id != HUNK_UNIT:
+            raise HunkParseError("no UNIT block found!")
+        # split block list by UNIT blocks
+        start = 0
+        for i in xrange(1, len(blks)):
+            if blks[i].blk_id == HUNK_UNIT:
+                self.add_unit(blks[start].name, blks[start + 1:i])
+                start = i
+        self.add_unit(blks[start].name, blks[start + 1:])
+
+    def add_unit(self, name, blks):
+        """split the blocks of a unit into segments and add it"""
+        block_lists = []
+        cur = None
+        has_seg = False
+        for blk in blks:
+            blk_id = blk.blk_id
+            if blk_id == HUNK_END:
+                cur = None
+                continue
+            is_seg = blk_id in loadseg_valid_begin_hunks
+            if not is_seg and blk_id not in unit_valid_extra_hunks:
+                raise HunkParseError("invalid block found: %d" % blk_id)
+            # a second segment block starts a new hunk (missing END)
+            if cur is None or (is_seg and has_seg):
+                cur = []
+                has_seg = False
+                block_lists.append(cur)
+            has_seg = has_seg or is_seg
+            cur.append(blk)
+        # convert block lists into segments
+        unit = HunkUnit(name)
+        for l in block_lists:
+            seg = HunkSegment()
+            seg.parse(l)
+            if seg.seg_blk is None:
+                raise HunkParseError("no segment block in unit %s" % name)
+            unit.segments.append(seg)
+        self.units.append(unit)
+        return unit
+
+
+class HunkLibUnit:
+    """a unit of a link library as described by its HUNK_INDEX"""
+
+    def __init__(self, name, file_offset):
+        self.name = name
+        self.file_offset = file_offset
+        self.hunks = []  # (name, blk_id, size)
+        self.defs = []  # (name, hunk_index, value, ext_type)
+        self.refs = []  # names
+
+
+class HunkLibIndex:
+    """the units of a HUNK_LIB file read from its HUNK_INDEX blocks only.
+       the hunks of a unit are parsed on demand with load_units()"""
+
+    def __init__(self):
+        self.units = []
+        self.defs = {}  # name -> (unit, hunk_index, value, ext_type)
+
+    @profile.timed("lib_index")
+    def read(self, f):
+        """read all LIB/INDEX block pairs and skip the LIB contents"""
+        while True:
+            tag = f.read(4)
+            if len(tag) == 0:
+                break
+            elif len(tag) != 4:
+                raise HunkParseError("Hunk block tag too short!")
+            blk_id = struct.unpack(">I", tag)[0] & HUNK_TYPE_MASK
+            if blk_id != HUNK_LIB:
+                raise HunkParseError("no LIB block found!")
+            data = f.read(4)
+            if len(data) != 4:
+                raise HunkParseError("read_long failed")
+            num_longs = struct.unpack(">I", data)[0]
+            lib_start = f.tell()
+            f.seek(lib_start + num_longs * 4, 0)
+            tag = f.read(4)
+            if len(tag) != 4 or struct.unpack(">I", tag)[0] & HUNK_TYPE_MASK != HUNK_INDEX:
+                raise HunkParseError("no INDEX block after LIB block!")
+            index = HunkIndexBlock()
+            index.parse(f)
+            self._add_index(index, lib_start)
+
+    def _add_index(self, index, lib_start):
+        strtab = index.strtab
+
+        def get_name(off):
+            end = strtab.find("\0", off)
+            if end < 0:
+                end = len(strtab)
+            return strtab[off:end]
+
+        for u in index.units:
+            # the first hunk is given in longs from the start of the LIB contents
+            unit = HunkLibUnit(get_name(u.name_off), lib_start + u.first_hunk_long_off * 4)
+            for i, h in enumerate(u.index_hunks):
+                unit.hunks.append((get_name(h.name_off), h.hunk_ctype & 0x3fff, h.hunk_longs * 4))
+                for r in h.sym_refs:
+                    unit.refs.append(get_name(r.name_off))
+                for d in h.sym_defs:
+                    name = get_name(d.name_off)
+                    unit.defs.append((name, i, d.value, d.sym_ctype))
+                    if name not in self.defs:
+                        self.defs[name] = (unit, i, d.value, d.sym_ctype)
+            self.units.append(unit)
+
+    def find_unit(self, name):
+        for unit in self.units:
+            if unit.name == name:
+                return unit
+        return None
+
+    def load_units(self, f, units, skip_data=False):
+        """parse the hunks of the given units in the given order and
+           return them as HunkObjectFile"""
+        obj = HunkObjectFile()
+        for unit in units:
+            f.seek(unit.file_offset, 0)
+            bf = HunkBlockFile()
+            bf.read(f, skip_data=skip_data, max_ends=len(unit.hunks))
+            hunit = obj.add_unit(unit.name, bf.get_blocks())
+            if len(hunit.segments) != len(unit.hunks):
+                raise HunkParseError("unit %s has %d hunks, index lists %d" %
+                                     (unit.name, len(hunit.segments), len(unit.hunks)))
+        return obj
+
+
+def _add_to_longs(data, sites):
+    """add deltas to the big endian longs at the given sorted (offset, delta)
+       sites of data and return the new data. all sites are converted by
+       one unpack and one pack"""
+    if len(sites) == 0:
+        return data
+    fmt = [">"]
+    deltas = []
+    pos = 0
+    for off, delta in sites:
+        if off < pos:
+            raise HunkParseError("overlapping relocation at offset %d" % off)
+        fmt.append("%dsI" % (off - pos))
+        deltas.append(delta)
+        pos = off + 4
+    if pos > len(data):
+        raise HunkParseError("relocation at offset %d beyond data" % (pos - 4))
+    fmt.append("%ds" % (len(data) - pos))
+    st = struct.Struct("".join(fmt))
+    values = list(st.unpack(data))
+    values[1::2] = [(v + d) & 0xffffffff for v, d in zip(values[1::2], deltas)]
+    return st.pack(*values)
+
+
+def merge_segments(bin_img):
+    """return a new BinImage with all segments of the same type and memory
+       flags merged into one segment, in the order of their first segment.
+       the members are appended at long aligned offsets, the relocated longs
+       get the offset of their target in its merged segment added and the
+       relocations, symbols and debug lines are moved by the offset of their
+       segment. the first segment stays at the start of the first merged
+       segment. programs that walk their own segment list can't be merged"""
+    segs = bin_img.get_segments()
+    if len(bin_img.overlay_nodes) > 0:
+        raise HunkParseError("can't merge overlaid files")
+    groups = []
+    group_map = {}
+    bases = {}
+    merged_of = {}
+    for seg in segs:
+        if seg.unit is not None or seg.ext_defs or seg.ext_refs or seg.extra_relocs:
+            raise HunkParseError("can't merge object file segments")
+        if seg.data is None and seg.seg_type != SEGMENT_TYPE_BSS:
+            raise HunkParseError("segment #%d has no data" % seg.id)
+        key = (seg.seg_type, seg.flags, seg.mem_attrs)
+        group = group_map.get(key)
+        if group is None:
+            group = group_map[key] = []
+            groups.append(group)
+        group.append(seg)
+    # merged segments and the offsets of their members
+    bi = BinImage(bin_img.file_type)
+    for group in groups:
+        first = group[0]
+        pos = 0
+        datas = []
+        for seg in group:
+            bases[seg] = pos
+            size = seg.size
+            if seg.data is not None:
+                size = max(size, len(seg.data))
+            size = (size + 3) & ~3
+            if seg.data is not None:
+                datas.append(seg.data)
+                if seg is not group[-1]:
+                    datas.append("\0" * (size - len(seg.data)))
+            pos += size
+        data = "".join(datas) if first.seg_type != SEGMENT_TYPE_BSS else None
+        ms = Segment(first.seg_type, pos, data, 0, first.flags)
+        ms.mem_attrs = first.mem_attrs
+        bi.add_segment(ms)
+        for seg in group:
+            merged_of[seg] = ms
+    # relocations, symbols and debug lines
+    for group, ms in zip(groups, bi.get_segments()):
+        sites = []
+        symbols = []
+        for seg in group:
+            base = bases[seg]
+            for to_seg in seg.get_reloc_to_segs():
+                offsets = [r.get_offset() for r in seg.get_reloc(to_seg).get_relocs()
+                           if r.get_width() == 2 and r.get_addend() == 0]
+                if len(offsets) != len(seg.get_reloc(to_seg).get_relocs()):
+                    raise HunkParseError("can't merge relocations other than 32 bit")
+                to_ms = merged_of[to_seg]
+                rl = ms.get_reloc(to_ms)
+                if rl is None:
+                    rl = Relocations(to_ms)
+                    ms.add_reloc(to_ms, rl)
+                rl.entries.extend([Reloc(off + base) for off in offsets])
+                delta = bases[to_seg]
+                if delta != 0:
+                    sites.extend([(off + base, delta) for off in offsets])
+            symtab = seg.get_symtab()
+            if symtab is not None:
+                symbols.extend([Symbol(sym.offset + base, sym.name, sym.file_name)
+                                for sym in symtab.get_symbols()])
+            debug_line = seg.get_debug_line()
+            if debug_line is not None:
+                if ms.get_debug_line() is None:
+                    ms.set_debug_line(DebugLine())
+                for df in debug_line.get_files():
+                    mdf = DebugLineFile(df.src_file, df.dir_name, df.base_offset + base)
+                    for e in df.get_entries():
+                        mdf.add_entry(DebugLineEntry(e.offset, e.src_line, e.flags))
+                    ms.get_debug_line().add_file(mdf)
+        if len(sites) > 0:
+            # a long relocated twice gets both deltas
+            sites.sort()
+            summed = [sites[0]]
+            for off, delta in sites[1:]:
+                if off == summed[-1][0]:
+                    summed[-1] = (off, summed[-1][1] + delta)
+                else:
+                    summed.append((off, delta))
+            ms.data = _add_to_longs(ms.data, summed)
+        if len(symbols) > 0:
+            st = SymbolTable()
+            st.symbols = symbols
+            ms.set_symtab(st)
+    return bi
+
+
+_long_struct = struct.Struct(">i")
+
+
 class Relocate:
     """Relocate a BinImage to given addresses"""
 
@@ -1768,6 +2931,7 @@ class Relocate:
             addr += s + padding
         return addrs
 
+    @profile.timed("relocate")
     def relocate_one_block(self, base_addr, padding=0):
         total_size = self.get_total_size(padding)
         data = bytearray(total_size)
@@ -1780,20 +2944,65 @@ class Relocate:
             offset += segment.size + padding
         return data
 
-    def relocate(self, addrs):
-        """perform relocations on segments and return relocated data"""
+    @profile.timed("relocate")
+    def relocate(self, addrs, init_only=False):
+        """perform relocations on segments and return relocated data.
+           with init_only a buffer only covers the initialized data of its
+           segment, the rest up to the segment size is implicitly zero and
+           BSS segments get an empty buffer."""
         segs = self.bin_img.get_segments()
         if len(segs) != len(addrs):
             raise ValueError("addrs != segments")
         datas = []
         for segment in segs:
             # allocate new buffer
-            data = bytearray(segment.size)
+            if init_only:
+                size = self._get_init_size(segment)
+            else:
+                size = segment.size
+            data = bytearray(size)
             self._copy_data(data, segment)
             self._reloc_data(data, segment, addrs)
             datas.append(data)
         return datas
 
+    @staticmethod
+    def get_reloc_values(data, offsets, to_addr):
+        """return the relocated longs at the offsets of unrelocated data"""
+        unpack_from = _long_struct.unpack_from
+        size = len(data)
+        return [(to_addr + unpack_from(data, off)[0]) & 0xffffffff if off + 4 <= size
+                else to_addr for off in offsets]
+
+    @staticmethod
+    def find_tables(offsets, min_entries=3):
+        """find runs of adjacent longs in sorted relocation offsets.
+           return list of (index of first offset, num_entries)"""
+        tables = []
+        n = len(offsets)
+        i = 0
+        while i < n:
+            j = i
+            while j + 1 < n and offsets[j + 1] - offsets[j] == 4:
+                j += 1
+            if j - i + 1 >= min_entries:
+                tables.append((i, j - i + 1))
+            i = j + 1
+        return tables
+
+    @staticmethod
+    def _get_init_size(segment):
+        """size of the part of a segment that holds data or relocations"""
+        size = 0
+        if segment.data is not None:
+            size = len(segment.data)
+        for to_seg in segment.get_reloc_to_segs():
+            for r in segment.get_reloc(to_seg).get_relocs():
+                end = r.get_offset() + 4
+                if end > size:
+                    size = end
+        return min(size, segment.size)
+
     @staticmethod
     def _copy_data(data, segment, offset=0):
         # allocate segment data
@@ -1814,6 +3023,7 @@ class Relocate:
             reloc = segment.get_reloc(to_seg)
             for r in reloc.get_relocs():
                 self._reloc(segment.id, data, r, to_addr, to_id, offset)
+            profile.count("relocs_applied", len(reloc.get_relocs()))
 
     def _reloc(self, my_id, data, reloc, to_addr, to_id, extra_offset):
         """relocate one entry"""
@@ -1833,83 +3043,3258 @@ class Relocate:
         data[offset:offset + 4] = d
 
 
+class ParseCache:
+    """opt-in on-disk cache of parsed BinImage layouts.
+
+       Entries are keyed by the SHA-256 of the input file and the parser
+       version. An entry holds the segment table, relocation offsets,
+       symbols and debug lines (not the segment data) in a flat binary
+       format of little endian longs that is read through mmap. The least
+       recently used entries are evicted when the cache exceeds max_size.
+       Images with relocations of another width or with an addend and
+       images with debug infos other than line numbers are not stored.
+       Storing is best effort, errors are reported and the entry dropped.
+
+       header:     magic, version, #segments, #reloc groups, #relocs,
+                   #symbols, #line files, #lines, string table size
+       segments:   type, size, data_offset, data_size, flags, mem_attrs
+       groups:     seg, to_seg, first reloc, #relocs
+       relocs:     offset
+       symbols:    seg, offset, name offset, name size
+       line files: seg, base_offset, file offset, file size, dir offset,
+                   dir size, first line, #lines
+       lines:      offset, src_line, flags
+       strings
+    """
+
+    MAGIC = 0x43504841  # "AHPC"
+    SUFFIX = ".ahc"
+    DEF_MAX_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, path, max_size=DEF_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @classmethod
+    def from_env(cls):
+        """return the cache given by AMIGA_HUNK_CACHE or None"""
+        path = os.environ.get("AMIGA_HUNK_CACHE")
+        if not path:
+            return None
+        max_size = os.environ.get("AMIGA_HUNK_CACHE_SIZE")
+        if max_size:
+            return cls(path, int(max_size))
+        return cls(path)
+
+    @staticmethod
+    def get_key(fobj, chunk_size=1024 * 1024):
+        """hash the whole file and return to the current position"""
+        import hashlib
+        pos = fobj.tell()
+        fobj.seek(0, 0)
+        h = hashlib.sha256()
+        while True:
+            data = fobj.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+        fobj.seek(pos, 0)
+        return "%s-%d" % (h.hexdigest(), PARSER_VERSION)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def get(self, key):
+        """return the cached BinImage or None"""
+        path = self._entry_path(key)
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        with f:
+            import mmap
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                return None
+            try:
+                bi = self._decode(buf)
+            except struct.error:
+                bi = None
+            finally:
+                buf.close()
+        if bi is not None:
+            # mark as recently used
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return bi
+
+    def put(self, key, bin_img):
+        """store the layout of a BinImage and evict old entries.
+           return False if the image was not stored"""
+        data = self._encode(bin_img)
+        if data is None:
+            return False
+        path = self._entry_path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            # entries of a key are equal, an existing one is kept
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.rename(tmp_path, path)
+            self.evict()
+        except EnvironmentError as e:
+            import sys
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            sys.stderr.write("amiga_hunk: can't store cache entry: %s\n" % e)
+            return False
+        return True
+
+    def evict(self):
+        """remove least recently used entries beyond max_size"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def _encode(self, bin_img):
+        strings = []
+        str_pos = [0]
+
+        def add_str(s):
+            pos = str_pos[0]
+            strings.append(s)
+            str_pos[0] += len(s)
+            return pos, len(s)
+
+        segs = []
+        groups = []
+        relocs = []
+        syms = []
+        files = []
+        lines = []
+        for seg in bin_img.get_segments():
+            hseg = seg.get_file_data()
+            if isinstance(hseg, HunkSegment) and hseg.debug_infos is not None:
+                for debug_info in hseg.debug_infos:
+                    if not isinstance(debug_info, HunkDebugLine):
+                        return None
+            segs.extend((seg.seg_type, seg.size, seg.data_offset, seg.data_size, seg.flags, seg.mem_attrs))
+            for to_seg in seg.get_reloc_to_segs():
+                entries = seg.get_reloc(to_seg).get_relocs()
+                for r in entries:
+                    if r.width != 2 or r.addend != 0:
+                        return None
+                offsets = [r.offset for r in entries]
+                groups.extend((seg.id, to_seg.id, len(relocs), len(offsets)))
+                relocs.extend(offsets)
+            symtab = seg.get_symtab()
+            if symtab is not None:
+                for sym in symtab.get_symbols():
+                    name_pos, name_len = add_str(sym.get_name())
+                    syms.extend((seg.id, sym.get_offset(), name_pos, name_len))
+            debug_line = seg.get_debug_line()
+            if debug_line is not None:
+                for df in debug_line.get_files():
+                    file_pos, file_len = add_str(df.get_src_file())
+                    dir_pos, dir_len = add_str(df.get_dir_name() or "")
+                    entries = df.get_entries()
+                    files.extend((seg.id, df.get_base_offset(), file_pos, file_len,
+                                  dir_pos, dir_len, len(lines) / 3, len(entries)))
+                    for e in entries:
+                        lines.extend((e.offset, e.src_line, e.flags))
+        longs = [self.MAGIC, PARSER_VERSION, len(segs) / 6, len(groups) / 4, len(relocs),
+                 len(syms) / 4, len(files) / 8, len(lines) / 3, str_pos[0]]
+        for part in (segs, groups, relocs, syms, files, lines):
+            longs.extend(part)
+        return struct.pack("<%dI" % len(longs), *longs) + "".join(strings)
+
+    def _decode(self, buf):
+        header = struct.unpack_from("<9I", buf, 0)
+        magic, version, num_segs, num_groups, num_relocs, num_syms, num_files, num_lines, str_size = header
+        if magic != self.MAGIC or version != PARSER_VERSION:
+            return None
+        pos = 36
+
+        def read_longs(n):
+            values = struct.unpack_from("<%dI" % n, buf, read_longs.pos)
+            read_longs.pos += n * 4
+            return values
+        read_longs.pos = pos
+
+        seg_vals = read_longs(num_segs * 6)
+        group_vals = read_longs(num_groups * 4)
+        reloc_vals = read_longs(num_relocs)
+        sym_vals = read_longs(num_syms * 4)
+        file_vals = read_longs(num_files * 8)
+        line_vals = read_longs(num_lines * 3)
+        str_base = read_longs.pos
+        strtab = buf[str_base:str_base + str_size]
+        if len(strtab) != str_size:
+            return None
+
+        bi = BinImage(BIN_IMAGE_TYPE_HUNK)
+        for i in xrange(0, num_segs * 6, 6):
+            seg_type, size, data_offset, data_size, flags, mem_attrs = seg_vals[i:i + 6]
+            seg = Segment(seg_type, size, None, data_offset, flags)
+            seg.data_size = data_size
+            seg.mem_attrs = mem_attrs
+            bi.add_segment(seg)
+        segs = bi.get_segments()
+        for i in xrange(0, num_groups * 4, 4):
+            seg_id, to_id, first, num = group_vals[i:i + 4]
+            rl = Relocations(segs[to_id])
+            rl.entries = [Reloc(off) for off in reloc_vals[first:first + num]]
+            segs[seg_id].add_reloc(segs[to_id], rl)
+        for i in xrange(0, num_syms * 4, 4):
+            seg_id, offset, name_pos, name_len = sym_vals[i:i + 4]
+            seg = segs[seg_id]
+            if seg.get_symtab() is None:
+                seg.set_symtab(SymbolTable())
+            seg.get_symtab().add_symbol(Symbol(offset, strtab[name_pos:name_pos + name_len]))
+        for i in xrange(0, num_files * 8, 8):
+            seg_id, base_offset, file_pos, file_len, dir_pos, dir_len, first, num = file_vals[i:i + 8]
+            seg = segs[seg_id]
+            if seg.get_debug_line() is None:
+                seg.set_debug_line(DebugLine())
+            df = DebugLineFile(strtab[file_pos:file_pos + file_len],
+                               strtab[dir_pos:dir_pos + dir_len], base_offset)
+            seg.get_debug_line().add_file(df)
+            for j in xrange(first * 3, (first + num) * 3, 3):
+                df.add_entry(DebugLineEntry(line_vals[j], line_vals[j + 1], line_vals[j + 2]))
+        return bi
+
+
+def mask_relocs(seg, data):
+    """return the data of a segment with all relocated and externally
+       referenced bytes set to zero"""
+    return _mask_sites(data, _reloc_widths(seg))
+
+
+def _reloc_widths(seg):
+    """return (offset, width) of the relocated and referenced bytes of a segment"""
+    sites = []
+    for to_seg in seg.get_reloc_to_segs():
+        sites.extend((r.get_offset(), 4) for r in seg.get_reloc(to_seg).get_relocs())
+    for blk_id, to_seg, offsets in seg.extra_relocs:
+        kind = _reloc_kinds.get(blk_id)
+        sites.extend((off, kind[0] if kind else 4) for off in offsets)
+    for name, ext_type, offsets, bss_size in seg.ext_refs:
+        kind = _ext_ref_kinds.get(ext_type)
+        sites.extend((off, kind[0] if kind else 4) for off in offsets)
+    return sites
+
+
+def _mask_sites(data, sites):
+    masked = bytearray(data)
+    size = len(masked)
+    for off, width in sites:
+        end = min(off + width, size)
+        if off < end:
+            masked[off:end] = "\0" * (end - off)
+    return str(masked)
+
+
+def get_functions(seg):
+    """return (offset, size, name) of the functions of a CODE segment
+       bounded by its symbols and external definitions"""
+    starts = {}
+    for name, ext_type, value in seg.ext_defs:
+        if ext_type == EXT_DEF:
+            starts.setdefault(value, name)
+    symtab = seg.get_symtab()
+    if symtab is not None:
+        for sym in symtab.get_symbols():
+            starts.setdefault(sym.get_offset(), sym.get_name())
+    offsets = sorted(off for off in starts if off < seg.size)
+    ends = offsets[1:] + [seg.data_size]
+    return [(off, end - off, starts[off]) for off, end in zip(offsets, ends) if end > off]
+
+
+class SegmentDiff:
+    """changes between two matched segments. old or new is None for a
+       removed or added segment. offsets are segment offsets, relocation
+       targets are segment ids of the new image"""
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.ranges = []  # (offset, size) of changed bytes
+        self.relocs_added = []  # (to_id, offset)
+        self.relocs_removed = []
+        self.relocs_changed = []  # (to_id, offset, old value, new value)
+        self.symbols_added = []  # (name, offset)
+        self.symbols_removed = []
+        self.symbols_moved = []  # (name, old offset, new offset)
+
+    def is_equal(self):
+        return (self.old is not None and self.new is not None and
+                self.old.size == self.new.size and
+                not (self.ranges or self.relocs_added or self.relocs_removed or
+                     self.relocs_changed or self.symbols_added or self.symbols_removed or
+                     self.symbols_moved))
+
+
+def _match_segments(old_segs, new_segs):
+    """pair segments of two images by their type sequence"""
+    import difflib
+
+    sm = difflib.SequenceMatcher(None, [s.seg_type for s in old_segs],
+                                 [s.seg_type for s in new_segs], autojunk=False)
+    pairs = []
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+        n = min(i2 - i1, j2 - j1) if tag == "replace" else 0
+        if tag == "equal":
+            n = i2 - i1
+        for k in xrange(i2 - i1):
+            pairs.append((old_segs[i1 + k], new_segs[j1 + k] if k < n else None))
+        for k in xrange(n, j2 - j1):
+            pairs.append((None, new_segs[j1 + k]))
+    return pairs
+
+
+def _diff_ranges(old, new, block_size):
+    """return (offset, size) of the differing bytes of two strings.
+       equal blocks are skipped with one compare"""
+    ranges = []
+    size = min(len(old), len(new))
+    start = None
+    pos = 0
+    while pos < size:
+        end = min(pos + block_size, size)
+        if old[pos:end] == new[pos:end]:
+            if start is not None:
+                ranges.append((start, pos - start))
+                start = None
+            pos = end
+            continue
+        for i in xrange(pos, end):
+            if old[i] != new[i]:
+                if start is None:
+                    start = i
+            elif start is not None:
+                ranges.append((start, i - start))
+                start = None
+        pos = end
+    if start is not None:
+        ranges.append((start, size - start))
+    if len(old) != len(new):
+        if ranges and ranges[-1][0] + ranges[-1][1] == size:
+            start = ranges.pop()[0]
+        else:
+            start = size
+        ranges.append((start, max(len(old), len(new)) - start))
+    return ranges
+
+
+def _reloc_keys(seg, seg_ids):
+    """return the set of (to_id, offset) of the long relocations of a segment"""
+    keys = set()
+    for to_seg in seg.get_reloc_to_segs():
+        to_id = seg_ids.get(to_seg.id)
+        keys.update((to_id, r.get_offset()) for r in seg.get_reloc(to_seg).get_relocs())
+    return keys
+
+
+def _seg_symbols(seg):
+    """return {name: offset} of the symbols and definitions of a segment"""
+    symbols = {}
+    symtab = seg.get_symtab()
+    if symtab is not None:
+        for sym in symtab.get_symbols():
+            symbols.setdefault(sym.get_name(), sym.get_offset())
+    for name, ext_type, value in seg.ext_defs:
+        symbols.setdefault(name, value)
+    return symbols
+
+
+def diff_images(old, new, block_size=256):
+    """compare two BinImages and return a SegmentDiff for each pair of
+       matched segments. relocation sites of either side are masked in
+       the content compare and the relocated values compared separately"""
+    import bisect
+
+    pairs = _match_segments(old.get_segments(), new.get_segments())
+    # old segment ids to new ones, relocations to dropped segments get None
+    seg_ids = dict((a.id, b.id) for a, b in pairs if a is not None and b is not None)
+    new_ids = dict((b.id, b.id) for a, b in pairs if b is not None)
+    result = []
+    for a, b in pairs:
+        d = SegmentDiff(a, b)
+        result.append(d)
+        if a is None or b is None:
+            continue
+        a_data = a.data if a.data is not None else ""
+        b_data = b.data if b.data is not None else ""
+        a_relocs = _reloc_keys(a, seg_ids)
+        b_relocs = _reloc_keys(b, new_ids)
+        d.relocs_added = sorted(b_relocs - a_relocs)
+        d.relocs_removed = sorted(a_relocs - b_relocs)
+
+        # content and relocated values can only change where the raw bytes
+        # do. sites of both sides are masked, added relocations show once
+        raw = _diff_ranges(a_data, b_data, block_size)
+        if raw:
+            sites = sorted(set(_reloc_widths(a)).union(_reloc_widths(b)))
+            starts = [off for off, width in sites]
+            hit = set()
+            for off, size in raw:
+                i = bisect.bisect_left(starts, off - 3)
+                while i < len(starts) and starts[i] < off + size:
+                    if starts[i] + sites[i][1] > off:
+                        hit.add(sites[i])
+                    i += 1
+            d.ranges = _diff_ranges(_mask_sites(a_data, hit), _mask_sites(b_data, hit), block_size)
+            hit_offs = set(off for off, width in hit)
+            for to_id, off in sorted(k for k in a_relocs & b_relocs if k[1] in hit_offs):
+                if off + 4 <= min(len(a_data), len(b_data)):
+                    old_value = struct.unpack_from(">I", a_data, off)[0]
+                    new_value = struct.unpack_from(">I", b_data, off)[0]
+                    if old_value != new_value:
+                        d.relocs_changed.append((to_id, off, old_value, new_value))
+        if not d.ranges and a.size != b.size:
+            d.ranges.append((min(a.size, b.size), abs(a.size - b.size)))
+
+        a_syms = _seg_symbols(a)
+        b_syms = _seg_symbols(b)
+        for name in sorted(b_syms):
+            if name not in a_syms:
+                d.symbols_added.append((name, b_syms[name]))
+            elif a_syms[name] != b_syms[name]:
+                d.symbols_moved.append((name, a_syms[name], b_syms[name]))
+        d.symbols_removed = sorted((name, off) for name, off in a_syms.items() if name not in b_syms)
+    return result
+
+
+class SignatureDB:
+    """relocation masked function signatures.
+
+       A signature is the masked bytes of a function: relocation sites are
+       zeroed, so the same library routine matches wherever it was linked.
+       Signatures are keyed by their first WINDOW bytes, a CODE segment is
+       matched in one pass by looking up the window at every even offset
+       and checking the SHA-1 of the candidate lengths. Signatures are best
+       built from linked executables, object files also mask PC relative
+       references to other units.
+
+       file:   magic, window, #signatures
+       entry:  size, name size, window bytes, sha1 (20 bytes), name
+    """
+
+    MAGIC = 0x53474841  # "AHGS"
+    WINDOW = 16
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.sigs = {}  # window bytes -> [(size, sha1, name)]
+        self.num = 0
+
+    def add(self, name, masked):
+        """add the masked bytes of a function, shorter ones are ignored"""
+        if len(masked) < self.window:
+            return False
+        import hashlib
+        key = masked[:self.window]
+        entry = (len(masked), hashlib.sha1(masked).digest(), name)
+        cands = self.sigs.setdefault(key, [])
+        for size, digest, other in cands:
+            if size == entry[0] and digest == entry[1]:
+                # same code under another name
+                return False
+        cands.append(entry)
+        # longest first for matching
+        cands.sort(reverse=True)
+        self.num += 1
+        return True
+
+    def add_image(self, bin_img):
+        """add the symbol bounded functions of all CODE segments"""
+        num = 0
+        for seg in bin_img.get_segments():
+            if seg.seg_type != SEGMENT_TYPE_CODE or seg.data is None:
+                continue
+            masked = mask_relocs(seg, seg.data)
+            for off, size, name in get_functions(seg):
+                if self.add(name, masked[off:off + size]):
+                    num += 1
+        return num
+
+    def match(self, masked):
+        """scan masked code and return non overlapping (offset, size, name)"""
+        import hashlib
+        res = []
+        window = self.window
+        sigs = self.sigs
+        end = len(masked) - window
+        off = 0
+        while off <= end:
+            cands = sigs.get(masked[off:off + window])
+            if cands is not None:
+                found = None
+                for size, digest, name in cands:
+                    if hashlib.sha1(masked[off:off + size]).digest() == digest:
+                        found = (off, size, name)
+                        break
+                if found is not None:
+                    res.append(found)
+                    off += found[1]
+                    continue
+            off += 2
+        return res
+
+    def match_segment(self, seg, data=None):
+        """match the functions of a CODE segment"""
+        if data is None:
+            data = seg.data
+        if seg.seg_type != SEGMENT_TYPE_CODE or not data:
+            return []
+        return self.match(mask_relocs(seg, data))
+
+    def save(self, path):
+        parts = [struct.pack(">III", self.MAGIC, self.window, self.num)]
+        for key in sorted(self.sigs):
+            for size, digest, name in self.sigs[key]:
+                parts.append(struct.pack(">II", size, len(name)))
+                parts.append(key)
+                parts.append(digest)
+                parts.append(name)
+        with open(path, "wb") as f:
+            f.write("".join(parts))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < 12:
+            raise HunkParseError("signature file too short")
+        magic, window, num = struct.unpack_from(">III", data, 0)
+        if magic != cls.MAGIC:
+            raise HunkParseError("no signature file")
+        db = cls(window)
+        pos = 12
+        for i in xrange(num):
+            size, name_size = struct.unpack_from(">II", data, pos)
+            pos += 8
+            key = data[pos:pos + window]
+            digest = data[pos + window:pos + window + 20]
+            pos += window + 20
+            name = data[pos:pos + name_size]
+            pos += name_size
+            db.sigs.setdefault(key, []).append((size, digest, name))
+        for cands in db.sigs.itervalues():
+            cands.sort(reverse=True)
+        db.num = num
+        return db
+
+
+class MinHashIndex:
+    """near duplicate search over relocation masked segments.
+
+       Every CODE and DATA segment gets a one permutation MinHash of its
+       SHINGLE byte shingles at even offsets: the CRC-32 of a shingle picks
+       one of NUM_BINS bins by its top bits and the bin keeps the minimum of
+       the remaining bits. Empty bins borrow from the next bin. Segments are
+       bucketed by BANDS bands of the signature (LSH), candidates of a query
+       segment are ranked by the share of equal bins and files by the size
+       weighted similarity of their best matching segments.
+
+       file:     magic, #bins, #files, #segments
+       files:    path size, path
+       segments: file, type, size, bins
+    """
+
+    MAGIC = 0x4d484841  # "AHHM"
+    NUM_BINS = 64
+    BANDS = 16
+    SHINGLE = 8
+
+    def __init__(self):
+        self.paths = []
+        self.segs = []  # (file, seg_type, size, signature)
+        self.buckets = {}  # band hash -> [segment]
+
+    @classmethod
+    def signature(cls, masked):
+        """return the MinHash of masked data or None if it is too short"""
+        import zlib
+        num_bins = cls.NUM_BINS
+        shift = 32 - (num_bins.bit_length() - 1)
+        mask = (1 << shift) - 1
+        empty = 1 << 32
+        mins = [empty] * num_bins
+        crc32 = zlib.crc32
+        shingle = cls.SHINGLE
+        for off in xrange(0, len(masked) - shingle + 1, 2):
+            h = crc32(masked[off:off + shingle]) & 0xffffffff
+            b = h >> shift
+            v = h & mask
+            if v < mins[b]:
+                mins[b] = v
+        if min(mins) == empty:
+            return None
+        sig = list(mins)
+        for i in xrange(num_bins):
+            if mins[i] == empty:
+                j = 1
+                while mins[(i + j) % num_bins] == empty:
+                    j += 1
+                sig[i] = mins[(i + j) % num_bins] | (j << shift)
+        return sig
+
+    @classmethod
+    def image_signatures(cls, bin_img):
+        """return (seg_type, size, signature) of the CODE and DATA segments"""
+        res = []
+        for seg in bin_img.get_segments():
+            if seg.seg_type == SEGMENT_TYPE_BSS or seg.data is None:
+                continue
+            sig = cls.signature(mask_relocs(seg, seg.data))
+            if sig is not None:
+                res.append((seg.seg_type, len(seg.data), sig))
+        return res
+
+    def _band_keys(self, sig):
+        rows = self.NUM_BINS / self.BANDS
+        return [hash((band,) + tuple(sig[band * rows:(band + 1) * rows]))
+                for band in xrange(self.BANDS)]
+
+    def add(self, path, signatures):
+        file_idx = len(self.paths)
+        self.paths.append(path)
+        for seg_type, size, sig in signatures:
+            seg_idx = len(self.segs)
+            self.segs.append((file_idx, seg_type, size, sig))
+            for key in self._band_keys(sig):
+                self.buckets.setdefault(key, []).append(seg_idx)
+
+    def query(self, signatures, k=10):
+        """return the k most similar files as (similarity, path)"""
+        total = float(sum(size for seg_type, size, sig in signatures))
+        scores = {}
+        for seg_type, size, sig in signatures:
+            cands = set()
+            for key in self._band_keys(sig):
+                cands.update(self.buckets.get(key, ()))
+            best = {}
+            for seg_idx in cands:
+                file_idx, other_type, other_size, other_sig = self.segs[seg_idx]
+                if other_type != seg_type:
+                    continue
+                same = sum(1 for a, b in zip(sig, other_sig) if a == b)
+                sim = same / float(self.NUM_BINS)
+                if sim > best.get(file_idx, 0.0):
+                    best[file_idx] = sim
+            for file_idx, sim in best.iteritems():
+                scores[file_idx] = scores.get(file_idx, 0.0) + sim * size / total
+        ranked = sorted(scores.iteritems(), key=lambda x: (-x[1], x[0]))[:k]
+        return [(score, self.paths[file_idx]) for file_idx, score in ranked]
+
+    def save(self, path):
+        n = self.NUM_BINS
+        parts = [struct.pack(">IIII", self.MAGIC, n, len(self.paths), len(self.segs))]
+        for p in self.paths:
+            parts.append(struct.pack(">I", len(p)))
+            parts.append(p)
+        for file_idx, seg_type, size, sig in self.segs:
+            parts.append(struct.pack(">III%dI" % n, file_idx, seg_type, size, *sig))
+        with open(path, "wb") as f:
+            f.write("".join(parts))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < 16:
+            raise HunkParseError("similarity index too short")
+        magic, n, num_files, num_segs = struct.unpack_from(">IIII", data, 0)
+        if magic != cls.MAGIC or n != cls.NUM_BINS:
+            raise HunkParseError("no similarity index")
+        idx = cls()
+        pos = 16
+        for i in xrange(num_files):
+            size = struct.unpack_from(">I", data, pos)[0]
+            idx.paths.append(data[pos + 4:pos + 4 + size])
+            pos += 4 + size
+        seg_fmt = struct.Struct(">III%dI" % n)
+        sigs = [[] for i in xrange(num_files)]
+        for i in xrange(num_segs):
+            values = seg_fmt.unpack_from(data, pos)
+            pos += seg_fmt.size
+            sigs[values[0]].append((values[1], values[2], list(values[3:])))
+        # re-add to rebuild the buckets
+        paths = idx.paths
+        idx.paths = []
+        for p, signatures in zip(paths, sigs):
+            idx.add(p, signatures)
+        return idx
+
+
+class SymbolIndex:
+    """SQLite index of the symbol names of many hunk files.
+       kinds are 'sym' (HUNK_SYMBOL), 'def' and 'ref' (HUNK_EXT) and
+       'lib' (HUNK_INDEX definitions)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER, hash TEXT);
+        CREATE TABLE IF NOT EXISTS symbols (
+            file_id INTEGER, name TEXT, kind TEXT, hunk INTEGER, value INTEGER);
+        CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);
+        CREATE INDEX IF NOT EXISTS symbols_file ON symbols (file_id);
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def get_files(self):
+        """return path -> (id, mtime, size, hash) of all indexed files"""
+        res = {}
+        for row in self.db.execute("SELECT path, id, mtime, size, hash FROM files"):
+            res[row[0]] = row[1:]
+        return res
+
+    def touch(self, path, mtime, size):
+        """record a new mtime of an unchanged file"""
+        self.db.execute("UPDATE files SET mtime = ?, size = ? WHERE path = ?",
+                        (mtime, size, self._text(path)))
+
+    def update(self, path, mtime, size, digest, symbols):
+        """replace the symbols of a file, symbols are (name, kind, hunk, value)"""
+        self.remove(path)
+        cur = self.db.execute("INSERT INTO files (path, mtime, size, hash) VALUES (?, ?, ?, ?)",
+                              (self._text(path), mtime, size, digest))
+        file_id = cur.lastrowid
+        self.db.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?, ?)",
+                            [(file_id, self._text(name), kind, hunk, value)
+                             for name, kind, hunk, value in symbols])
+
+    def remove(self, path):
+        row = self.db.execute("SELECT id FROM files WHERE path = ?", (self._text(path),)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM symbols WHERE file_id = ?", row)
+            self.db.execute("DELETE FROM files WHERE id = ?", row)
+
+    def find(self, name, prefix=False, kind=None, limit=None):
+        """return (name, kind, hunk, value, path) of an exact name or of
+           all names starting with a prefix"""
+        name = self._text(name)
+        if prefix:
+            # a range on the name index instead of LIKE
+            where = "s.name >= ? AND s.name < ?"
+            args = [name, name[:-1] + unichr(ord(name[-1]) + 1)] if name else ["", u"\uffff"]
+        else:
+            where = "s.name = ?"
+            args = [name]
+        if kind is not None:
+            where += " AND s.kind = ?"
+            args.append(kind)
+        sql = ("SELECT s.name, s.kind, s.hunk, s.value, f.path FROM symbols s "
+               "JOIN files f ON f.id = s.file_id WHERE %s ORDER BY s.name, f.path" % where)
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        return self.db.execute(sql, args).fetchall()
+
+    @staticmethod
+    def _text(s):
+        # names are bytes in any Amiga charset
+        if isinstance(s, str):
+            return s.decode("latin-1")
+        return s
+
+
+def _collect_symbols(blks, symbols, hunk=-1):
+    """add the names of a block list as (name, kind, hunk, value)"""
+    for blk in blks:
+        blk_id = blk.blk_id
+        if blk_id in loadseg_valid_begin_hunks:
+            hunk += 1
+        elif blk_id == HUNK_SYMBOL:
+            for name, off in blk.symbols:
+                symbols.append((name, "sym", hunk, off))
+        elif blk_id == HUNK_EXT:
+            for e in blk.entries:
+                if e.ext_type >= 0x80:
+                    symbols.append((e.name, "ref", hunk, None))
+                else:
+                    symbols.append((e.name, "def", hunk, e.def_value))
+        elif blk_id == HUNK_LIB:
+            hunk = _collect_symbols(blk.blocks, symbols, hunk)
+        elif blk_id == HUNK_INDEX:
+            index = HunkLibIndex()
+            index._add_index(blk, 0)
+            first = 0
+            for unit in index.units:
+                for name, hunk_idx, value, ext_type in unit.defs:
+                    symbols.append((name, "lib", first + hunk_idx, value))
+                first += len(unit.hunks)
+    return hunk
+
+
+class MemFile:
+    """a read only, seekable file object of a byte string"""
+
+    def __init__(self, data, name=None):
+        self.data = data
+        self.file_size = len(data)
+        self.name = name
+        self.pos = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+    def size(self):
+        return self.file_size
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.file_size
+        if offset < 0:
+            raise IOError("invalid seek offset")
+        self.pos = offset
+
+    def read(self, n=-1):
+        end = self.file_size if n < 0 else min(self.pos + n, self.file_size)
+        data = self.data[self.pos:end]
+        self.pos = max(self.pos, end)
+        return data
+
+
+# first long of crunched files
+cruncher_magics = {
+    "PP20": "PowerPacker",
+    "PX20": "PowerPacker (encrypted)",
+    "IMP!": "Imploder",
+    "ATN!": "Imploder",
+    "CrM!": "CrunchMania",
+    "CrM2": "CrunchMania",
+    "RNC\x01": "ProPack",
+    "S404": "StoneCracker",
+    "XPKF": "XPK",
+}
+
+# byte values with reversed bit order
+_bitrev_table = "".join(chr(int("{0:08b}".format(i)[::-1], 2)) for i in range(256))
+
+# mask of the low n bits
+_bit_masks = [(1 << n) - 1 for n in range(65)]
+
+
+class Decruncher:
+    """unpacks crunched files. the output buffer is reused by all calls"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    @staticmethod
+    def detect(data):
+        """return the cruncher name of crunched data or None"""
+        return cruncher_magics.get(data[:4])
+
+    def decrunch(self, data):
+        """return the unpacked bytes of crunched data"""
+        name = self.detect(data)
+        if name is None:
+            raise HunkParseError("no crunched data")
+        if name != "PowerPacker":
+            raise HunkParseError("%s crunched files are not supported" % name)
+        n = self.decrunch_pp20(data)
+        return str(self.buf[:n])
+
+    def decrunch_pp20(self, data):
+        """unpack a PowerPacker data stream into the buffer, return its size.
+           the stream is read backwards from the end and the output is
+           written backwards, too"""
+        if len(data) < 12:
+            raise HunkParseError("PowerPacker data is truncated")
+        eff = bytearray(data[4:8])
+        if max(eff) > 24:
+            raise HunkParseError("invalid PowerPacker offset sizes")
+        tail = bytearray(data[-4:])
+        out_len = (tail[0] << 16) | (tail[1] << 8) | tail[2]
+        if len(self.buf) < out_len:
+            self.buf = bytearray(out_len)
+        buf = self.buf
+
+        # with the bits of every byte reversed the stream reads MSB first
+        src = data[8:-4][::-1].translate(_bitrev_table)
+        src += "\0" * (-len(src) % 4)
+        words = struct.unpack(">%dI" % (len(src) / 4), src)
+        masks = _bit_masks
+
+        # bit reader state kept in locals: acc holds nbits unread bits
+        acc = nbits = wi = 0
+        try:
+            n = tail[3]
+            if nbits < n:
+                acc = ((acc & masks[nbits]) << 32) | words[wi]
+                wi += 1
+                nbits += 32
+            nbits -= n
+
+            o = out_len
+            while o > 0:
+                if nbits < 1:
+                    acc = ((acc & masks[nbits]) << 32) | words[wi]
+                    wi += 1
+                    nbits += 32
+                nbits -= 1
+                if not (acc >> nbits) & 1:
+                    # literal run, then a match unless the output is complete
+                    n = 1
+                    while True:
+                        if nbits < 2:
+                            acc = ((acc & masks[nbits]) << 32) | words[wi]
+                            wi += 1
+                            nbits += 32
+                        nbits -= 2
+                        x = (acc >> nbits) & 3
+                        n += x
+                        if x != 3:
+                            break
+                    if n > o:
+                        raise HunkParseError("PowerPacker literals exceed output")
+                    for i in xrange(o - 1, o - 1 - n, -1):
+                        if nbits < 8:
+                            acc = ((acc & masks[nbits]) << 32) | words[wi]
+                            wi += 1
+                            nbits += 32
+                        nbits -= 8
+                        buf[i] = (acc >> nbits) & 0xff
+                    o -= n
+                    if o == 0:
+                        break
+
+                if nbits < 2:
+                    acc = ((acc & masks[nbits]) << 32) | words[wi]
+                    wi += 1
+                    nbits += 32
+                nbits -= 2
+                x = (acc >> nbits) & 3
+                offbits = eff[x]
+                n = x + 2
+                if x == 3:
+                    if nbits < 1:
+                        acc = ((acc & masks[nbits]) << 32) | words[wi]
+                        wi += 1
+                        nbits += 32
+                    nbits -= 1
+                    if not (acc >> nbits) & 1:
+                        offbits = 7
+                if nbits < offbits:
+                    acc = ((acc & masks[nbits]) << 32) | words[wi]
+                    wi += 1
+                    nbits += 32
+                nbits -= offbits
+                dist = ((acc >> nbits) & masks[offbits]) + 1
+                if x == 3:
+                    while True:
+                        if nbits < 3:
+                            acc = ((acc & masks[nbits]) << 32) | words[wi]
+                            wi += 1
+                            nbits += 32
+                        nbits -= 3
+                        x = (acc >> nbits) & 7
+                        n += x
+                        if x != 7:
+                            break
+                if n > o or o + dist > out_len:
+                    raise HunkParseError("PowerPacker match exceeds output")
+                if dist >= n:
+                    buf[o - n:o] = buf[o - n + dist:o + dist]
+                else:
+                    for i in xrange(o - 1, o - 1 - n, -1):
+                        buf[i] = buf[i + dist]
+                o -= n
+        except IndexError:
+            raise HunkParseError("PowerPacker data is truncated")
+        return out_len
+
+    def open(self, f):
+        """return a MemFile of the unpacked contents of a crunched data file
+           or None if the file is not crunched. crunched executables are
+           not recognized and load as their decruncher stub"""
+        f.seek(0)
+        if self.detect(f.read(4)) is None:
+            return None
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(0)
+        return MemFile(self.decrunch(f.read(size)), getattr(f, "name", None))
+
+
+def pp20_crunch(data, eff=(9, 10, 11, 11)):
+    """pack data as a PowerPacker data stream. a simple greedy encoder
+       with a 1 KB window for test data and benchmarks"""
+    import binascii
+
+    window = min(1 << min(eff), 1024)
+    n = len(data)
+    parts = []
+    lits = []
+    heads = {}
+    ins = n + 1
+    p = n
+
+    def put_lits():
+        parts.append("0")
+        m = len(lits) - 1
+        while m >= 3:
+            parts.append("11")
+            m -= 3
+        parts.append("{0:02b}".format(m))
+        parts.extend("{0:08b}".format(ord(c)) for c in lits)
+        del lits[:]
+
+    while p > 0:
+        # matches end at p and copy from the already packed bytes above
+        length = dist = 0
+        if p >= 3:
+            for e in xrange(ins - 1, p, -1):
+                if e >= 3:
+                    heads.setdefault(data[e - 3:e], []).append(e)
+            ins = p + 1
+            cands = heads.get(data[p - 3:p], ())
+            for e in reversed(cands[-16:]):
+                if e - p > window:
+                    break
+                m = 3
+                while m < p and m < 1024 and data[p - 1 - m] == data[e - 1 - m]:
+                    m += 1
+                if m > length:
+                    length, dist = m, e - p
+        if length == 0:
+            lits.append(data[p - 1])
+            p -= 1
+            continue
+        if lits:
+            put_lits()
+        else:
+            parts.append("1")
+        offset = dist - 1
+        if length < 5:
+            parts.append("{0:02b}".format(length - 2))
+            parts.append("{0:0{1}b}".format(offset, eff[length - 2]))
+        else:
+            parts.append("11")
+            if offset < 128:
+                parts.append("0{0:07b}".format(offset))
+            else:
+                parts.append("1{0:0{1}b}".format(offset, eff[3]))
+            m = length - 5
+            while m >= 7:
+                parts.append("111")
+                m -= 7
+            parts.append("{0:03b}".format(m))
+        p -= length
+    if lits:
+        put_lits()
+
+    bits = "".join(parts)
+    skip = -len(bits) % 32
+    if bits:
+        bits = "0" * skip + bits
+        stream = binascii.unhexlify("%0*x" % (len(bits) / 4, int(bits, 2)))
+    else:
+        stream = ""
+    return ("PP20" + "".join(map(chr, eff)) + stream.translate(_bitrev_table)[::-1] +
+            struct.pack(">I", (n << 8) | skip))
+
+
+class AdfFile(MemFile):
+    """a read only, seekable file object of a file on an ADF image.
+       reads are served from the data blocks in the image buffer"""
+
+    def __init__(self, data, offsets, block_size, file_size, name):
+        MemFile.__init__(self, data, name)
+        self.offsets = offsets  # image offset of the payload of each block
+        self.block_size = block_size
+        self.file_size = file_size
+
+    def read(self, n=-1):
+        end = self.file_size if n < 0 else min(self.pos + n, self.file_size)
+        pos = self.pos
+        block_size = self.block_size
+        parts = []
+        while pos < end:
+            i, off = divmod(pos, block_size)
+            if i >= len(self.offsets):
+                break
+            size = min(block_size - off, end - pos)
+            start = self.offsets[i] + off
+            parts.append(self.data[start:start + size])
+            pos += size
+        self.pos = pos
+        return "".join(parts)
+
+
+class AdfBlocks(object):
+    """the bytes of a seekable file read block by block on access. slices
+       are served from the blocks read so far"""
+
+    def __init__(self, f, size, block_size):
+        self.f = f
+        self.size = size
+        self.block_size = block_size
+        self.blocks = {}
+
+    def __len__(self):
+        return self.size
+
+    def _get_block(self, i):
+        blk = self.blocks.get(i)
+        if blk is None:
+            self.f.seek(i * self.block_size)
+            blk = self.blocks[i] = self.f.read(self.block_size)
+        return blk
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            key = slice(key, key + 1)
+        start, stop, step = key.indices(self.size)
+        block_size = self.block_size
+        parts = []
+        pos = start
+        while pos < stop:
+            i, off = divmod(pos, block_size)
+            size = min(block_size - off, stop - pos)
+            parts.append(self._get_block(i)[off:off + size])
+            pos += size
+        return "".join(parts)
+
+
+class AdfImage:
+    """an OFS/FFS floppy disk image. a path is mapped with mmap, a file
+       object is read block by block. files are read from the image
+       without extracting them"""
+
+    BLOCK_SIZE = 512
+    IMAGE_SIZES = (901120, 1802240)
+    HASH_SIZE = 72
+    T_HEADER = 2
+    ST_ROOT = 1
+    ST_USERDIR = 2
+    ST_FILE = -3
+
+    def __init__(self, data):
+        if not self.is_adf_data(len(data), data[:3]):
+            raise HunkParseError("no OFS/FFS disk image")
+        self.data = data
+        self.ffs = ord(data[3]) & 1 == 1
+        self.num_blocks = len(data) / self.BLOCK_SIZE
+        self.root_block = self.num_blocks / 2
+        self._map = None
+        root = self.root_block
+        if self._long(root, 0) != self.T_HEADER or self._sec_type(root) != self.ST_ROOT:
+            raise HunkParseError("no root block")
+
+    @classmethod
+    def is_adf_data(cls, size, magic):
+        return size in cls.IMAGE_SIZES and magic == "DOS"
+
+    @classmethod
+    def open_path(cls, path):
+        import mmap
+        with open(path, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            img = cls(m)
+        except HunkParseError:
+            m.close()
+            raise
+        img._map = m
+        return img
+
+    @classmethod
+    def from_fobj(cls, f, size):
+        """read the image from a seekable file, only the blocks used"""
+        return cls(AdfBlocks(f, size, cls.BLOCK_SIZE))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _long(self, blk, off):
+        off += blk * self.BLOCK_SIZE
+        return struct.unpack(">I", self.data[off:off + 4])[0]
+
+    def _sec_type(self, blk):
+        off = (blk + 1) * self.BLOCK_SIZE - 4
+        return struct.unpack(">i", self.data[off:off + 4])[0]
+
+    def _block(self, key):
+        if key < 2 or key >= self.num_blocks:
+            raise HunkParseError("invalid disk block %d" % key)
+        return key
+
+    def _name(self, blk):
+        off = blk * self.BLOCK_SIZE + self.BLOCK_SIZE - 80
+        size = min(ord(self.data[off]), 30)
+        return self.data[off + 1:off + 1 + size]
+
+    def _entries(self, blk):
+        """return the header blocks in the hash table of a directory"""
+        keys = []
+        seen = set()
+        for i in xrange(self.HASH_SIZE):
+            key = self._long(blk, 24 + i * 4)
+            # follow hash chains
+            while key != 0 and key not in seen:
+                seen.add(key)
+                keys.append(self._block(key))
+                key = self._long(key, self.BLOCK_SIZE - 16)
+        return keys
+
+    def walk(self, blk=None, prefix=""):
+        """yield (path, header block) of all files"""
+        if blk is None:
+            blk = self.root_block
+        entries = []
+        for key in self._entries(blk):
+            if self._long(key, 0) != self.T_HEADER:
+                continue
+            entries.append((self._name(key), key, self._sec_type(key)))
+        for name, key, sec_type in sorted(entries):
+            if sec_type == self.ST_USERDIR:
+                for entry in self.walk(key, prefix + name + "/"):
+                    yield entry
+            elif sec_type == self.ST_FILE:
+                yield prefix + name, key
+
+    def get_file(self, key, name=None):
+        """return an AdfFile for a file header block"""
+        file_size = self._long(key, self.BLOCK_SIZE - 188)
+        blocks = []
+        blk = key
+        seen = set()
+        # data block tables of the header and its extension blocks
+        while blk != 0 and blk not in seen:
+            seen.add(blk)
+            num = min(self._long(blk, 8), self.HASH_SIZE)
+            for i in xrange(num):
+                blocks.append(self._block(self._long(blk, 24 + (self.HASH_SIZE - 1 - i) * 4)))
+            blk = self._long(blk, self.BLOCK_SIZE - 8)
+        if self.ffs:
+            offsets = [b * self.BLOCK_SIZE for b in blocks]
+            block_size = self.BLOCK_SIZE
+        else:
+            # OFS data blocks start with a 24 byte header
+            offsets = [b * self.BLOCK_SIZE + 24 for b in blocks]
+            block_size = self.BLOCK_SIZE - 24
+        return AdfFile(self.data, offsets, block_size, file_size, name)
+
+    def open(self, path):
+        """open a file by its path, names are case insensitive"""
+        lower = path.lower()
+        for name, key in self.walk():
+            if name.lower() == lower:
+                return self.get_file(key, name)
+        raise IOError("%s: not found on disk image" % path)
+
+    def get_hunk_files(self):
+        """return (path, type) of all files that are hunk files"""
+        res = []
+        bf = HunkBlockFile()
+        for name, key in self.walk():
+            file_type = bf.peek_type(self.get_file(key, name))
+            if file_type != TYPE_UNKNOWN:
+                res.append((name, file_type))
+        return res
+
+
 def accept_file(li, filename):
     li.seek(0)
 
     bf = BinFmtHunk()
-    tag = li.read(4)
-    tagf = StringIO.StringIO(tag)
 
-    if bf.is_image_fobj(tagf):
+    if bf.is_image_fobj(li):
         return {'format': 'Amiga Hunk executable', 'processor': '68040'}
-    else:
+    elif bf.is_object_fobj(li):
+        return {'format': 'Amiga Hunk object file', 'processor': '68040'}
+    elif HunkBlockFile().peek_type(li) == TYPE_LIB:
+        return {'format': 'Amiga Hunk link library', 'processor': '68040'}
+    elif _get_adf_image(li) is not None:
+        return {'format': 'Amiga ADF disk image with hunk files', 'processor': '68040'}
+    li.seek(0)
+    name = Decruncher.detect(li.read(4))
+    if name is not None:
+        # claim crunched files that unpack to a hunk file only
+        try:
+            mf = Decruncher().open(li)
+        except HunkParseError:
+            return 0
+        if HunkBlockFile().peek_type(mf) != TYPE_UNKNOWN:
+            return {'format': 'Amiga %s crunched hunk file' % name, 'processor': '68040'}
+    return 0
+
+
+# IDA name characters, everything else is mapped to '_'
+_name_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$?@."
+_name_xlat = "".join(c if c in _name_chars else "_" for c in map(chr, range(256)))
+
+
+def _make_names(symbols, reserved=None):
+    """map (ea, name) pairs to sanitized and unique names by ea.
+       only the first name of an address is kept. reserved maps names
+       already present in the database to their address."""
+    if reserved is None:
+        reserved = {}
+    used = dict((name, 1) for name in reserved)
+    names = {}
+    for ea, name in symbols:
+        if ea in names:
+            continue
+        name = name.translate(_name_xlat)
+        if name == "" or name[0].isdigit():
+            name = "_" + name
+        n = used.get(name, 0)
+        if n == 0 or reserved.get(name) == ea:
+            used[name] = 1
+        else:
+            # find next free suffix
+            while True:
+                new_name = "%s_%d" % (name, n)
+                n += 1
+                if new_name not in used:
+                    break
+            used[name] = n
+            used[new_name] = 1
+            name = new_name
+        names[ea] = name
+    return names
+
+
+@profile.timed("symbols")
+def _apply_symbols(bi, addrs, reserved=None, extra=None):
+    """set the HUNK_SYMBOL names of all segments in one pass. extra
+       (ea, name) pairs take precedence over the symbols"""
+    symbols = []
+    if extra is not None:
+        symbols.extend(extra)
+    for seg in bi.get_segments():
+        symtab = seg.get_symtab()
+        if symtab is None:
+            continue
+        ea = addrs[seg.id]
+        for sym in symtab.get_symbols():
+            if sym.get_offset() < seg.size:
+                symbols.append((ea + sym.get_offset(), sym.get_name()))
+    if len(symbols) == 0:
         return 0
+    names = _make_names(symbols, reserved)
+    _set_names(names)
+    return len(names)
 
 
-def load_file(li, neflags, format):
-    idaapi.set_processor_type('68040', ida_idp.SETPROC_LOADER)
+def _set_names(names):
+    """set the names of an ea -> name dict in one batch"""
+    # do not trigger analysis for every single name
+    old_auto = idaapi.enable_auto(False)
+    try:
+        flags = idaapi.SN_NOCHECK | idaapi.SN_NOWARN
+        for ea in sorted(names):
+            idaapi.set_name(ea, names[ea], flags)
+    finally:
+        idaapi.enable_auto(old_auto)
 
-    idaapi.cvar.inf.af = idaapi.AF_CODE | idaapi.AF_JUMPTBL | idaapi.AF_USED | idaapi.AF_UNK | \
-                         idaapi.AF_PROC | idaapi.AF_LVAR | idaapi.AF_STKARG | idaapi.AF_REGARG | \
-                         idaapi.AF_TRACE | idaapi.AF_VERSP | idaapi.AF_ANORET | idaapi.AF_MEMFUNC | \
-                         idaapi.AF_TRFUNC | idaapi.AF_FIXUP | idaapi.AF_JFUNC | idaapi.AF_NULLSUB | \
-                         idaapi.AF_NULLSUB | idaapi.AF_IMMOFF | idaapi.AF_STRLIT
 
-    li.seek(0)
-    data = li.read(li.size())
+# signature file matched against the CODE segments at load time
+SIGNATURES = os.environ.get("AMIGA_HUNK_SIGNATURES", "")
+
+# signature file loaded last: (path, mtime) -> SignatureDB
+_sig_cache = {}
+
 
+def _load_signatures(path):
+    """return the SignatureDB of a file, parsed again only when it changed"""
+    key = (path, os.stat(path).st_mtime)
+    db = _sig_cache.get(key)
+    if db is None:
+        _sig_cache.clear()
+        db = _sig_cache[key] = SignatureDB.load(path)
+    return db
+
+
+@profile.timed("signatures")
+def _apply_signatures(bi, addrs):
+    """name the library functions found with SIGNATURES that have no
+       symbol yet and queue them as functions"""
+    if not SIGNATURES:
+        return 0
+    db = _load_signatures(SIGNATURES)
+    named = set()
+    for seg in bi.get_segments():
+        if seg.seg_type == SEGMENT_TYPE_CODE:
+            named.update(addrs[seg.id] + off for off, size, name in get_functions(seg))
+    matches = []
+    for seg in bi.get_segments():
+        size = min(seg.data_size, seg.size)
+        if seg.seg_type != SEGMENT_TYPE_CODE or size <= 0:
+            continue
+        ea = addrs[seg.id]
+        # relocated bytes are masked, so the patched database bytes do
+        for off, n, name in db.match_segment(seg, idaapi.get_bytes(ea, size)):
+            if ea + off not in named:
+                matches.append((ea + off, name))
+    names = _make_names(matches)
+    _set_names(names)
+    for ea in sorted(names):
+        idaapi.auto_make_proc(ea)
+    profile.count("signature_matches", len(names))
+    return len(names)
+
+
+@profile.timed("debug_lines")
+def _apply_debug_lines(bi, addrs):
+    """register source files and line numbers of all segments.
+       the entries of a segment are sorted once and then swept in address
+       order, each run of entries of one file becomes a source file range"""
+    for seg in bi.get_segments():
+        debug_line = seg.get_debug_line()
+        if debug_line is None:
+            continue
+        ea = addrs[seg.id]
+        end_ea = ea + seg.size
+        file_names = []
+        entries = []
+        for df in debug_line.get_files():
+            dir_name = df.get_dir_name()
+            if dir_name:
+                file_names.append(dir_name + "/" + df.get_src_file())
+            else:
+                file_names.append(df.get_src_file())
+            idx = len(file_names) - 1
+            base = ea + df.get_base_offset()
+            entries.extend([(base + e.offset, e.src_line, idx) for e in df.get_entries()])
+        if len(entries) == 0:
+            continue
+        entries.sort()
+        cur_file = None
+        cur_start = ea
+        for addr, src_line, idx in entries:
+            if addr >= end_ea:
+                break
+            if idx != cur_file:
+                if cur_file is not None and addr > cur_start:
+                    idaapi.add_sourcefile(cur_start, addr, file_names[cur_file])
+                cur_file = idx
+                cur_start = addr
+            idaapi.set_source_linnum(addr, src_line)
+        if cur_file is not None:
+            idaapi.add_sourcefile(cur_start, end_ea, file_names[cur_file])
+
+
+# first analysis pass without the expensive AF_TRACE and AF_VERSP passes,
+# the full analysis is run on the code once the first pass is finished
+FAST_ANALYSIS = os.environ.get("AMIGA_HUNK_FAST_ANALYSIS", "") not in ("", "0")
+
+# keep installed hooks alive
+_hooks = []
+
+
+def _analysis_flags(fast=False):
+    af = idaapi.AF_CODE | idaapi.AF_JUMPTBL | idaapi.AF_USED | idaapi.AF_UNK | \
+         idaapi.AF_PROC | idaapi.AF_LVAR | idaapi.AF_STKARG | idaapi.AF_REGARG | \
+         idaapi.AF_TRACE | idaapi.AF_VERSP | idaapi.AF_ANORET | idaapi.AF_MEMFUNC | \
+         idaapi.AF_TRFUNC | idaapi.AF_FIXUP | idaapi.AF_JFUNC | idaapi.AF_NULLSUB | \
+         idaapi.AF_IMMOFF | idaapi.AF_STRLIT
+    if fast:
+        af &= ~(idaapi.AF_TRACE | idaapi.AF_VERSP)
+    return af
+
+
+def _create_full_analysis_hook(ranges):
+    """create a hook that enables all analysis flags and reanalyzes the
+       code ranges when the fast first pass is finished"""
+
+    class FullAnalysisHook(idaapi.IDB_Hooks):
+        def auto_empty_finally(self):
+            self.unhook()
+            if self in _hooks:
+                _hooks.remove(self)
+            idaapi.cvar.inf.af = _analysis_flags()
+            for start, end in ranges:
+                idaapi.auto_mark_range(start, end, idaapi.AU_USED)
+            return 0
+
+    return FullAnalysisHook()
+
+
+@profile.timed("analysis_plan")
+def _plan_analysis(bi, addrs, entry_ea, fast=False):
+    """queue the entry and the CODE hunks first and DATA/BSS hunks last.
+       symbols in CODE hunks seed functions"""
+    segs = bi.get_segments()
+    code_segs = [seg for seg in segs if seg.get_type() == SEGMENT_TYPE_CODE]
+    other_segs = [seg for seg in segs if seg.get_type() != SEGMENT_TYPE_CODE]
+
+    if entry_ea is not None:
+        idaapi.auto_make_proc(entry_ea)
+    for seg in code_segs:
+        ea = addrs[seg.id]
+        offsets = set(value for name, ext_type, value in seg.ext_defs if ext_type == EXT_DEF)
+        symtab = seg.get_symtab()
+        if symtab is not None:
+            offsets.update(sym.get_offset() for sym in symtab.get_symbols())
+        for off in sorted(offsets):
+            # 68k code is word aligned
+            if off < seg.size and off & 1 == 0:
+                idaapi.auto_make_proc(ea + off)
+
+    code_ranges = [(addrs[seg.id], addrs[seg.id] + seg.size) for seg in code_segs]
+    for start, end in code_ranges:
+        idaapi.auto_mark_range(start, end, idaapi.AU_CODE)
+    for seg in other_segs:
+        start = addrs[seg.id]
+        idaapi.auto_mark_range(start, start + seg.size, idaapi.AU_USED)
+
+    if fast:
+        hook = _create_full_analysis_hook(code_ranges)
+        if hook.hook():
+            _hooks.append(hook)
+
+
+# netnode keeping segment addresses and relocation table for move_segm
+_RELOC_NODE = "$ amiga hunk relocs"
+# max distance of relocation sites patched as one span
+_RELOC_SPAN_GAP = 0x100
+
+
+def _store_seg_addrs(seg_addrs):
+    data = []
+    for start, size in seg_addrs:
+        data.append(start)
+        data.append(size)
+    node = idaapi.netnode(_RELOC_NODE, 0, True)
+    node.setblob(struct.pack(">%dI" % len(data), *data), 0, 'S')
+
+
+@profile.timed("reloc_table")
+def _store_reloc_table(bi, addrs, extra_seg_addrs=(), extra_groups=()):
+    """persist segment addresses and relocation offsets in the database.
+       relocations are stored as groups of (seg, to_seg, num, offsets...).
+       extra segments follow the image segments, extra groups are given as
+       (seg_id, to_seg_id, offsets)"""
+    seg_addrs = [(addrs[seg.id], seg.size) for seg in bi.get_segments()]
+    seg_addrs.extend(extra_seg_addrs)
+    _store_seg_addrs(seg_addrs)
+    groups = _reloc_groups(bi) + list(extra_groups)
+    node = idaapi.netnode(_RELOC_NODE, 0, True)
+    node.setblob(_pack_reloc_groups(groups), 0, 'R')
+
+
+def _reloc_groups(bi):
+    groups = []
+    for seg in bi.get_segments():
+        for to_seg in seg.get_reloc_to_segs():
+            offsets = [r.get_offset() for r in seg.get_reloc(to_seg).get_relocs()]
+            groups.append((seg.id, to_seg.id, offsets))
+    return groups
+
+
+def _pack_reloc_groups(groups):
+    parts = []
+    for seg_id, to_id, offsets in groups:
+        parts.append(struct.pack(">III", seg_id, to_id, len(offsets)))
+        parts.append(struct.pack(">%dI" % len(offsets), *offsets))
+    return "".join(parts)
+
+
+def _append_reloc_groups(groups):
+    """add relocation groups of lazily loaded segments"""
+    node = idaapi.netnode(_RELOC_NODE, 0, True)
+    data = node.getblob(0, 'R') or ""
+    node.setblob(data + _pack_reloc_groups(groups), 0, 'R')
+
+
+def _load_reloc_table():
+    """return segment address list and relocation groups or None, None"""
+    node = idaapi.netnode(_RELOC_NODE, 0, False)
+    seg_data = node.getblob(0, 'S')
+    reloc_data = node.getblob(0, 'R')
+    if seg_data is None or reloc_data is None:
+        return None, None
+    n = len(seg_data) / 4
+    values = struct.unpack(">%dI" % n, seg_data)
+    seg_addrs = [(values[i], values[i + 1]) for i in xrange(0, n, 2)]
+    relocs = []
+    pos = 0
+    end = len(reloc_data)
+    while pos < end:
+        seg_id, to_id, num = struct.unpack_from(">III", reloc_data, pos)
+        pos += 12
+        offsets = struct.unpack_from(">%dI" % num, reloc_data, pos)
+        pos += num * 4
+        relocs.append((seg_id, to_id, offsets))
+    return seg_addrs, relocs
+
+
+def _map_segment(li, seg, ea, file_size):
+    """map the stored data of a segment directly from the input file.
+       BSS and the tail beyond the stored data stay uninitialized"""
+    size = seg.size
+    data_size = min(seg.get_data_size(), size, max(file_size - seg.data_offset, 0))
+    if data_size > 0:
+        if isinstance(li, MemFile):
+            # files on disk images and decrunched files are not an input file region
+            li.seek(seg.data_offset, 0)
+            idaapi.mem2base(li.read(data_size), ea, -1)
+        else:
+            idaapi.file2base(li, seg.data_offset, ea, ea + data_size, idaapi.FILEREG_PATCHABLE)
+    return data_size
+
+
+def _apply_relocs(seg, addrs, data_size):
+    """patch the relocation sites of a mapped segment and register fixups.
+       the mapped data is read once, the relocated longs are computed from
+       it and the sites inside it are written back as one span.
+       return list of (to_seg, sorted offsets, relocated values)"""
+    ea = addrs[seg.id]
+    data = idaapi.get_bytes(ea, data_size) if data_size > 0 else None
+    buf = bytearray(data or "")
+    lo = len(buf)
+    hi = 0
+    pack_into = _long_struct.pack_into
+    fd = idaapi.fixup_data_t(idaapi.FIXUP_OFF32)
+    result = []
+    for to_seg in seg.get_reloc_to_segs():
+        relocs = sorted(seg.get_reloc(to_seg).get_relocs(), key=Reloc.get_offset)
+        offsets = [r.get_offset() for r in relocs]
+        # sites beyond the mapped data relocate a zero long
+        values = Relocate.get_reloc_values(buf, offsets, addrs[to_seg.id])
+        for i, r in enumerate(relocs):
+            off = offsets[i]
+            addr = (values[i] + r.addend) & 0xffffffff
+            values[i] = addr
+            if off + 4 <= len(buf):
+                pack_into(buf, off, addr)
+                lo = min(lo, off)
+                hi = max(hi, off + 4)
+            else:
+                idaapi.put_dword(ea + off, addr)
+            fd.off = addr
+            fd.set(ea + off)
+        result.append((to_seg, offsets, values))
+        profile.count("fixups", len(offsets))
+    if lo < hi:
+        idaapi.put_bytes(ea + lo, str(buf[lo:hi]))
+    return result
+
+
+def _create_table_hook(tables):
+    """create a hook that marks the jump tables when auto-analysis is
+       finished. a table overlapping decoded instructions is left alone,
+       consecutive jsr/lea abs.l operands look like tables too"""
+
+    class TableHook(idaapi.IDB_Hooks):
+        def auto_empty_finally(self):
+            self.unhook()
+            if self in _hooks:
+                _hooks.remove(self)
+            for table_ea, num in tables:
+                if any(_is_code_at(table_ea + i) for i in xrange(0, num * 4, 2)):
+                    continue
+                idaapi.create_data(table_ea, idaapi.FF_DWORD, num * 4, idaapi.BADADDR)
+                idaapi.op_plain_offset(table_ea, 0, 0)
+            return 0
+
+    return TableHook()
+
+
+def _is_code_at(ea):
+    """True if ea is part of a decoded instruction"""
+    return idaapi.is_code(idaapi.get_flags(idaapi.get_item_head(ea)))
+
+
+@profile.timed("code_seeds")
+def _seed_code_targets(code_relocs, delta):
+    """queue the targets of CODE->CODE relocations. the jump tables are
+       marked after auto-analysis. code_relocs is a list of
+       (ea, offsets, values) as loaded, delta the distance to the current
+       addresses"""
+    procs = set()
+    labels = set()
+    tables = []
+    for ea, offsets, values in code_relocs:
+        in_table = set()
+        for idx, num in Relocate.find_tables(offsets):
+            tables.append((ea + offsets[idx] + delta, num))
+            in_table.update(xrange(idx, idx + num))
+        for i, value in enumerate(values):
+            # 68k code is word aligned
+            if value & 1:
+                continue
+            if i in in_table:
+                labels.add(value + delta)
+            else:
+                procs.add(value + delta)
+    for ea in sorted(labels):
+        idaapi.auto_make_code(ea)
+    for ea in sorted(procs - labels):
+        idaapi.auto_make_proc(ea)
+    if len(tables) > 0:
+        hook = _create_table_hook(tables)
+        if hook.hook():
+            _hooks.append(hook)
+
+
+def _load_hunk_file(li):
+    # parse the block structure only, the payloads stay in the input file
+    li.seek(0)
     bf = BinFmtHunk()
-    fobj = StringIO.StringIO(data)
-    bi = bf.load_image_fobj(fobj)
+    bi = bf.load_image_fobj(li, skip_data=True, cache=ParseCache.from_env())
 
     rel = Relocate(bi)
     addrs = rel.get_seq_addrs(0)
-    datas = rel.relocate(addrs)
+    file_size = li.size()
 
+    code_relocs = []
     for seg in bi.get_segments():
         offset = addrs[seg.id]
         size = seg.size
 
-        to_segs = seg.get_reloc_to_segs()
-        for to_seg in to_segs:
-            reloc = seg.get_reloc(to_seg)
-            for r in reloc.get_relocs():
-                offset2 = r.get_offset()
-                rel_off = Relocate.read_long(datas[seg.id], offset2)
-                addr = offset + rel_off + r.addend
-
-                fd = idaapi.fixup_data_t(idaapi.FIXUP_OFF32)
-                fd.off = addr
-                fd.set(offset + offset2)
+        with profile.phase("map"):
+            data_size = _map_segment(li, seg, offset, file_size)
+        with profile.phase("fixups"):
+            relocs = _apply_relocs(seg, addrs, data_size)
+        if seg.get_type() == SEGMENT_TYPE_CODE:
+            for to_seg, offsets, values in relocs:
+                if to_seg.get_type() == SEGMENT_TYPE_CODE:
+                    code_relocs.append((offset, offsets, values))
 
-        idaapi.mem2base(str(datas[seg.id]), offset, seg.data_offset)
         idaapi.add_segm(0, offset, offset + size, 'SEG_%02d' % seg.id, seg.get_type_name())
+        profile.count("bytes_mapped", data_size)
+
+    _store_reloc_table(bi, addrs)
+
+    base = Relocate.DEF_IMAGE_BASE
+    with profile.phase("rebase"):
+        idaapi.rebase_program(base, idaapi.MSF_FIXONCE)
+    idaapi.add_entry(base, base, "start", 1)
+
+    addrs = rel.get_seq_addrs(base)
+    _apply_symbols(bi, addrs, reserved={"start": base})
+    _apply_signatures(bi, addrs)
+    _apply_debug_lines(bi, addrs)
+    _plan_analysis(bi, addrs, base, FAST_ANALYSIS)
+    _seed_code_targets(code_relocs, base)
+
+    if len(bi.overlay_nodes) > 0:
+        _register_overlay_nodes(bi.overlay_nodes)
+
+
+# loaded overlay nodes: file offset -> first segment in the reloc table + 1
+_OVERLAY_NODE = "$ amiga hunk overlay nodes"
+_OVERLAY_HOTKEY = "Shift-O"
+_overlay_hotkey = None
+
+
+def _register_overlay_nodes(nodes):
+    """remember the overlay node offsets and offer loading them"""
+    node_tab = idaapi.netnode(_OVERLAY_NODE, 0, True)
+    offsets = [node.offset for node in nodes]
+    node_tab.setblob(struct.pack(">%dI" % len(offsets), *offsets), 0, 'O')
+    idaapi.msg("amiga_hunk: %d overlay nodes, load them with %s or load_overlay_nodes()\n" %
+               (len(nodes), _OVERLAY_HOTKEY))
+    add_overlay_hotkey()
+
+
+def add_overlay_hotkey():
+    """add the hotkey for loading overlay nodes if the database has any.
+       loaders only run when a file is loaded, after reopening a database
+       this is called from IDAPython (e.g. idapythonrc.py). return True if
+       the hotkey is available"""
+    global _overlay_hotkey
+    _import_ida()
+    if _overlay_hotkey is not None:
+        return True
+    if not idaapi.netnode(_OVERLAY_NODE, 0, False).getblob(0, 'O') or not hasattr(idaapi, "add_hotkey"):
+        return False
+    _overlay_hotkey = idaapi.add_hotkey(_OVERLAY_HOTKEY, _ask_overlay_node)
+    return _overlay_hotkey is not None
+
+
+def _ask_overlay_node():
+    node_tab = idaapi.netnode(_OVERLAY_NODE, 0, False)
+    data = node_tab.getblob(0, 'O') or ""
+    offsets = struct.unpack(">%dI" % (len(data) / 4), data)
+    todo = [off for off in offsets if not node_tab.altval(off)]
+    if len(todo) == 0:
+        idaapi.msg("amiga_hunk: all overlay nodes are loaded\n")
+        return
+    offset = idaapi.ask_long(todo[0], "Load overlay node at file offset")
+    if offset is not None:
+        load_overlay_nodes([offset])
+
+
+@profile.timed("overlay_nodes")
+def _load_overlay_nodes(li, offsets):
+    """map overlay nodes given by file offset and their parents. nodes
+       get addresses after all other segments"""
+    li.seek(0)
+    bf = BinFmtHunk()
+    bi = bf.load_image_fobj(li, skip_data=True)
+    nodes = dict((node.offset, node) for node in bi.overlay_nodes)
+    if offsets is None:
+        offsets = sorted(nodes)
+    for offset in offsets:
+        if offset not in nodes:
+            raise HunkParseError("no overlay node at file offset %d" % offset)
+        bf.load_overlay_node(li, bi, nodes[offset], skip_data=True)
+
+    # number the segments like the reloc table, already mapped nodes keep
+    # their entries
+    node_tab = idaapi.netnode(_OVERLAY_NODE, 0, True)
+    seg_addrs, relocs = _load_reloc_table()
+    end = max(start + size for start, size in seg_addrs)
+    end = (end + 0xf) & ~0xf
+    new_segs = []
+    for node in bi.overlay_nodes:
+        if node.segments is None:
+            continue
+        first = node_tab.altval(node.offset)
+        if first:
+            for i, seg in enumerate(node.segments):
+                seg.id = first - 1 + i
+            continue
+        node_tab.altset(node.offset, len(seg_addrs) + 1)
+        for seg in node.segments:
+            seg.id = len(seg_addrs)
+            seg_addrs.append((end, seg.size))
+            end = (end + seg.size + 0xf) & ~0xf
+            new_segs.append(seg)
+    if len(new_segs) == 0:
+        return 0
 
-    idaapi.rebase_program(Relocate.DEF_IMAGE_BASE, idaapi.MSF_FIXONCE)
-    idaapi.add_entry(Relocate.DEF_IMAGE_BASE, Relocate.DEF_IMAGE_BASE, "start", 1)
+    addrs = [start for start, size in seg_addrs]
+    file_size = li.size()
+    code_relocs = []
+    for seg in new_segs:
+        offset = addrs[seg.id]
+        node = seg.overlay_node
+        with profile.phase("map"):
+            data_size = _map_segment(li, seg, offset, file_size)
+        with profile.phase("fixups"):
+            relocs = _apply_relocs(seg, addrs, data_size)
+        if seg.get_type() == SEGMENT_TYPE_CODE:
+            for to_seg, offsets, values in relocs:
+                if to_seg.get_type() == SEGMENT_TYPE_CODE:
+                    code_relocs.append((offset, offsets, values))
+        name = "OVL_%d_%d_%02d" % (node.level, node.ordinate, node.segments.index(seg))
+        idaapi.add_segm(0, offset, offset + seg.size, name, seg.get_type_name())
+        profile.count("bytes_mapped", data_size)
+    _store_seg_addrs(seg_addrs)
+
+    sub = BinImage(BIN_IMAGE_TYPE_HUNK)
+    sub.segments = new_segs
+    _append_reloc_groups(_reloc_groups(sub))
+    _apply_symbols(sub, addrs)
+    _apply_debug_lines(sub, addrs)
+    _plan_analysis(sub, addrs, None, FAST_ANALYSIS)
+    _seed_code_targets(code_relocs, 0)
+
+    # the overlay table symbols are the entry points of the nodes
+    for node in set(seg.overlay_node for seg in new_segs):
+        for hunk, offset in node.symbols:
+            i = hunk - node.first_hunk
+            if 0 <= i < len(node.segments) and offset < node.segments[i].size:
+                idaapi.auto_make_proc(addrs[node.segments[i].id] + offset)
+    return len(new_segs)
+
+
+def load_overlay_nodes(offsets=None):
+    """load overlay nodes given by file offset (all when None) into the
+       database. return the number of new segments"""
+    _import_ida()
+    li = _open_ida_input()
+    try:
+        return _load_overlay_nodes(li, offsets)
+    finally:
+        _close_ida_input(li)
+
+
+# width and pc relative flag of patched relocations and references
+_reloc_kinds = {
+    HUNK_RELRELOC32: (4, True),
+    HUNK_RELRELOC16: (2, True),
+    HUNK_RELRELOC8: (1, True),
+    HUNK_ABSRELOC16: (2, False)
+}
+
+_ext_ref_kinds = {
+    EXT_ABSREF32: (4, False),
+    EXT_ABSCOMMON: (4, False),
+    EXT_RELREF32: (4, True),
+    EXT_RELREF16: (2, True),
+    EXT_RELREF8: (1, True),
+    EXT_ABSREF16: (2, False),
+    EXT_ABSREF8: (1, False)
+}
+
+_fixup_types = {
+    4: "FIXUP_OFF32",
+    2: "FIXUP_OFF16",
+    1: "FIXUP_OFF8"
+}
+
+# minimum size of a slot in the externs segment
+_EXTERN_SLOT_SIZE = 4
+
+
+def _patch_site(site, width, pc_rel, target, initialized):
+    """add target (or its distance for pc relative sites) to the value at
+       site and register a fixup for absolute sites"""
+    if width == 4:
+        old = idaapi.get_dword(site) if initialized else 0
+    elif width == 2:
+        old = idaapi.get_word(site) if initialized else 0
+    else:
+        old = idaapi.get_byte(site) if initialized else 0
+    if pc_rel:
+        value = old + target - site
+    else:
+        value = old + target
+    value &= (1 << (width * 8)) - 1
+    if width == 4:
+        idaapi.put_dword(site, value)
+    elif width == 2:
+        idaapi.put_word(site, value)
+    else:
+        idaapi.put_byte(site, value)
+    if not pc_rel:
+        fd = idaapi.fixup_data_t(getattr(idaapi, _fixup_types[width]))
+        fd.off = value
+        fd.set(site)
+
+
+def _apply_sites(ea, offsets, kind, target, data_size):
+    """patch the sites of a relocation or reference of the given kind.
+       kinds without a known encoding only get a data reference"""
+    if kind is None:
+        for off in offsets:
+            idaapi.add_dref(ea + off, target, idaapi.dr_O)
+        return
+    width, pc_rel = kind
+    for off in offsets:
+        _patch_site(ea + off, width, pc_rel, target, off + width <= data_size)
+
+
+def _resolve_externals(bi, addrs, ext_start):
+    """resolve all external references with a hash index of the
+       definitions. unresolved names get a slot in the externs segment.
+       return the map name -> (ea, seg_id or None), the names of the
+       definitions and the extern slots as (ea, name) and the end of
+       the externs segment"""
+    ext_id = len(bi.get_segments())
+    defs = {}
+    def_names = []
+    for seg in bi.get_segments():
+        for name, ext_type, value in seg.ext_defs:
+            if ext_type == EXT_ABS:
+                # absolute value, not part of any segment
+                entry = (value, None)
+            else:
+                entry = (addrs[seg.id] + value, seg.id)
+                def_names.append((entry[0], name))
+            if name not in defs:
+                defs[name] = entry
+    ext_names = []
+    ext_ea = ext_start
+    for seg in bi.get_segments():
+        for name, ext_type, offsets, bss_size in seg.ext_refs:
+            if name in defs:
+                continue
+            size = max(bss_size or 0, _EXTERN_SLOT_SIZE)
+            defs[name] = (ext_ea, ext_id)
+            ext_names.append((ext_ea, name))
+            ext_ea += (size + 3) & ~3
+    return defs, def_names, ext_names, ext_ea
+
+
+def _map_object_segments(li, segs, addrs, defs):
+    """map the hunks of object units and apply their relocations and
+       external references. return the relocations between code hunks
+       and the groups of absolute 32 bit references"""
+    file_size = li.size()
+    code_relocs = []
+    ext_groups = []
+    for seg in segs:
+        offset = addrs[seg.id]
+
+        with profile.phase("map"):
+            data_size = _map_segment(li, seg, offset, file_size)
+        with profile.phase("fixups"):
+            relocs = _apply_relocs(seg, addrs, data_size)
+            for blk_id, to_seg, offsets in seg.extra_relocs:
+                _apply_sites(offset, offsets, _reloc_kinds.get(blk_id), addrs[to_seg.id], data_size)
+            for name, ext_type, offsets, bss_size in seg.ext_refs:
+                if name not in defs:
+                    idaapi.msg("amiga_hunk: unresolved external %s\n" % name)
+                    continue
+                target, to_id = defs[name]
+                _apply_sites(offset, offsets, _ext_ref_kinds.get(ext_type), target, data_size)
+                if _ext_ref_kinds.get(ext_type) == (4, False) and to_id is not None:
+                    ext_groups.append((seg.id, to_id, offsets))
+        if seg.get_type() == SEGMENT_TYPE_CODE:
+            for to_seg, offsets, values in relocs:
+                if to_seg.get_type() == SEGMENT_TYPE_CODE:
+                    code_relocs.append((offset, offsets, values))
+        profile.count("bytes_mapped", data_size)
+    return code_relocs, ext_groups
+
+
+def _add_extern_segm(start, end):
+    idaapi.add_segm(0, start, end, "EXTERN", "XTRN")
+    ext_seg = idaapi.getseg(start)
+    if ext_seg is not None:
+        ext_seg.type = idaapi.SEG_XTRN
+        ext_seg.update()
+
+
+def _load_unit_file(li):
+    li.seek(0)
+    bf = BinFmtHunk()
+    bi = bf.load_object_fobj(li, skip_data=True)
+    segs = bi.get_segments()
+
+    base = Relocate.DEF_IMAGE_BASE
+    rel = Relocate(bi)
+    addrs = rel.get_seq_addrs(base)
+    ext_start = base + rel.get_total_size()
+    with profile.phase("resolve"):
+        defs, def_names, ext_names, ext_end = _resolve_externals(bi, addrs, ext_start)
+    profile.count("externals", len(ext_names))
+
+    code_relocs, ext_groups = _map_object_segments(li, segs, addrs, defs)
+    for seg in segs:
+        offset = addrs[seg.id]
+        name = seg.name or 'SEG_%02d' % seg.id
+        idaapi.add_segm(0, offset, offset + seg.size, name, seg.get_type_name())
+
+    extra_seg_addrs = []
+    if ext_end > ext_start:
+        _add_extern_segm(ext_start, ext_end)
+        extra_seg_addrs.append((ext_start, ext_end - ext_start))
+
+    _store_reloc_table(bi, addrs, extra_seg_addrs, ext_groups)
+
+    _apply_symbols(bi, addrs, extra=def_names + ext_names)
+    _apply_signatures(bi, addrs)
+    _apply_debug_lines(bi, addrs)
+    _plan_analysis(bi, addrs, None, FAST_ANALYSIS)
+    _seed_code_targets(code_relocs, 0)
+
+
+# units of a link library loaded with the index: "all" or a comma separated
+# list of unit names. other units can be loaded later with load_lib_units()
+LIB_UNITS = os.environ.get("AMIGA_HUNK_LIB_UNITS", "")
+
+# materialized library units by index
+_LIB_NODE = "$ amiga hunk lib units"
+
+_lib_seg_classes = {
+    HUNK_CODE: "CODE",
+    HUNK_DATA: "DATA",
+    HUNK_BSS: "BSS"
+}
+
+
+def _lib_first_hunks(index):
+    """return the global hunk number of the first hunk of each unit"""
+    firsts = []
+    n = 0
+    for unit in index.units:
+        firsts.append(n)
+        n += len(unit.hunks)
+    return firsts
+
+
+def _resolve_lib_defs(index, starts):
+    """map the index definitions of a library to addresses. starts holds
+       the address of every hunk followed by the externs segment. return
+       the map name -> (ea, hunk or None), the names of the definitions
+       and the extern slots as (ea, name) and the size of the externs"""
+    firsts = _lib_first_hunks(index)
+    ext_id = len(starts) - 1
+    defs = {}
+    def_names = []
+    for unit, first in zip(index.units, firsts):
+        for name, hunk_idx, value, ext_type in unit.defs:
+            if ext_type == EXT_ABS:
+                entry = (value, None)
+            else:
+                entry = (starts[first + hunk_idx] + value, first + hunk_idx)
+                def_names.append((entry[0], name))
+            if name not in defs:
+                defs[name] = entry
+    ext_names = []
+    ext_ea = starts[ext_id]
+    for unit in index.units:
+        for name in unit.refs:
+            if name not in defs:
+                defs[name] = (ext_ea, ext_id)
+                ext_names.append((ext_ea, name))
+                ext_ea += _EXTERN_SLOT_SIZE
+    return defs, def_names, ext_names, ext_ea - starts[ext_id]
+
+
+def _select_lib_units(index, names):
+    """return the numbers of the units given by name or of all units"""
+    if names is None or names == "all":
+        return range(len(index.units))
+    if isinstance(names, str):
+        names = names.split(",")
+    names = set(names)
+    return [i for i, unit in enumerate(index.units) if unit.name in names]
+
+
+def _load_lib_file(li):
+    li.seek(0)
+    index = BinFmtHunk.load_lib_index(li)
+
+    # lay out all hunks from the index without reading them
+    starts = []
+    ea = Relocate.DEF_IMAGE_BASE
+    for unit in index.units:
+        for name, blk_id, size in unit.hunks:
+            starts.append(ea)
+            ea += size
+    starts.append(ea)
+    defs, def_names, ext_names, ext_size = _resolve_lib_defs(index, starts)
+    profile.count("externals", len(ext_names))
+
+    seg_addrs = []
+    for unit, first in zip(index.units, _lib_first_hunks(index)):
+        for i, (name, blk_id, size) in enumerate(unit.hunks):
+            start = starts[first + i]
+            if not name:
+                name = unit.name if i == 0 else "%s_%d" % (unit.name, i)
+            idaapi.add_segm(0, start, start + size, name, _lib_seg_classes.get(blk_id, "DATA"))
+            seg_addrs.append((start, size))
+    if ext_size > 0:
+        _add_extern_segm(starts[-1], starts[-1] + ext_size)
+    seg_addrs.append((starts[-1], ext_size))
+    _store_seg_addrs(seg_addrs)
+    _append_reloc_groups([])
+
+    _set_names(_make_names(def_names + ext_names))
+
+    if LIB_UNITS:
+        _load_lib_units(li, index, _select_lib_units(index, LIB_UNITS))
+
+
+@profile.timed("lib_units")
+def _load_lib_units(li, index, unit_nums):
+    """materialize the hunks of library units in one batch"""
+    node = idaapi.netnode(_LIB_NODE, 0, True)
+    unit_nums = [i for i in unit_nums if not node.altval(i)]
+    if len(unit_nums) == 0:
+        return 0
+    # read the units in file order
+    unit_nums.sort(key=lambda i: index.units[i].file_offset)
+    bi = BinFmtHunk().load_lib_units(li, index, [index.units[i] for i in unit_nums], skip_data=True)
+
+    # number the segments by their global hunk number
+    firsts = _lib_first_hunks(index)
+    segs = bi.get_segments()
+    pos = 0
+    for i in unit_nums:
+        for j in xrange(len(index.units[i].hunks)):
+            segs[pos].id = firsts[i] + j
+            pos += 1
+
+    # current hunk addresses, segments may have been moved
+    seg_addrs, relocs = _load_reloc_table()
+    starts = [start for start, size in seg_addrs]
+    defs, def_names, ext_names, ext_size = _resolve_lib_defs(index, starts)
+    code_relocs, ext_groups = _map_object_segments(li, segs, starts, defs)
+    _append_reloc_groups(_reloc_groups(bi) + ext_groups)
+
+    names = _make_names(def_names + ext_names)
+    _apply_symbols(bi, starts, reserved=dict((name, ea) for ea, name in names.items()))
+    _apply_debug_lines(bi, starts)
+    _plan_analysis(bi, starts, None, FAST_ANALYSIS)
+    _seed_code_targets(code_relocs, 0)
+
+    for i in unit_nums:
+        node.altset(i, 1)
+    profile.count("lib_units", len(unit_nums))
+    return len(unit_nums)
+
+
+def load_lib_units(names=None):
+    """load the hunks of library units given by name (all when None)
+       into the database. return the number of newly loaded units"""
+    _import_ida()
+    li = _open_ida_input()
+    try:
+        li.seek(0)
+        index = BinFmtHunk.load_lib_index(li)
+        return _load_lib_units(li, index, _select_lib_units(index, names))
+    finally:
+        _close_ida_input(li)
+
+
+# file loaded from an ADF image (supval 0) and crunched input (altval 0)
+_INPUT_NODE = "$ amiga hunk input file"
+
+
+def _get_adf_image(li):
+    """return an AdfImage of the input if it is a disk image with hunk files.
+       only the directory blocks and the first blocks of files are read"""
+    size = li.size()
+    li.seek(0)
+    if not AdfImage.is_adf_data(size, li.read(3)):
+        return None
+    try:
+        img = AdfImage.from_fobj(li, size)
+        if len(img.get_hunk_files()) == 0:
+            return None
+    except HunkParseError:
+        return None
+    return img
+
+
+def _open_adf_file(img):
+    """open the hunk file of a disk image to load, ask if there are several"""
+    files = img.get_hunk_files()
+    name = os.environ.get("AMIGA_HUNK_ADF_FILE", "")
+    if not name:
+        name = files[0][0]
+        if len(files) > 1 and hasattr(idaapi, "ask_str"):
+            idaapi.msg("amiga_hunk: hunk files on disk: %s\n" % ", ".join(n for n, t in files))
+            name = idaapi.ask_str(name, 0, "File on disk image to load") or name
+    idaapi.netnode(_INPUT_NODE, 0, True).supset(0, name)
+    return img.open(name)
+
+
+def _decrunch_input(li):
+    """return the unpacked input if it is crunched, li otherwise"""
+    mf = Decruncher().open(li)
+    if mf is None:
+        return li
+    idaapi.netnode(_INPUT_NODE, 0, True).altset(0, 1)
+    return mf
+
+
+def _open_ida_input():
+    """open the input file of the database for lazy loading"""
+    path = idaapi.get_input_file_path()
+    node = idaapi.netnode(_INPUT_NODE, 0, True)
+    name = node.supval(0)
+    if name:
+        li = AdfImage.open_path(path).open(name)
+    else:
+        li = idaapi.open_linput(path, False)
+        if li is None:
+            raise IOError("can't open input file")
+    if node.altval(0):
+        mf = Decruncher().open(li)
+        _close_ida_input(li)
+        return mf
+    return li
+
+
+def _close_ida_input(li):
+    if not isinstance(li, MemFile):
+        idaapi.close_linput(li)
+
+
+def load_file(li, neflags, format):
+    _import_ida()
+    idaapi.set_processor_type('68040', ida_idp.SETPROC_LOADER)
+
+    idaapi.cvar.inf.af = _analysis_flags(FAST_ANALYSIS)
+
+    profile.reset()
+    with profile.phase("load_file"):
+        li.seek(0)
+        file_type = HunkBlockFile().peek_type(li)
+        if file_type == TYPE_UNKNOWN:
+            img = _get_adf_image(li)
+            if img is not None:
+                li = _open_adf_file(img)
+                file_type = HunkBlockFile().peek_type(li)
+        if file_type == TYPE_UNKNOWN:
+            li = _decrunch_input(li)
+            li.seek(0)
+            file_type = HunkBlockFile().peek_type(li)
+        if file_type == TYPE_UNIT:
+            _load_unit_file(li)
+        elif file_type == TYPE_LIB:
+            _load_lib_file(li)
+        else:
+            _load_hunk_file(li)
+    profile.emit(idaapi.msg)
 
     return 1
 
 
-def move_segm(frm, to, sz, fileformatname):
-    delta = to
+def _move_fixups(frm, to, sz):
+    """rebase by walking all fixups of the database (databases without
+       a stored relocation table)"""
+    if frm == idaapi.BADADDR:
+        delta = to
+    else:
+        delta = to - frm
     xEA = ida_fixup.get_first_fixup_ea()
     while xEA != idaapi.BADADDR:
         fd = ida_fixup.fixup_data_t(idaapi.FIXUP_OFF32)
         ida_fixup.get_fixup(xEA, fd)
-        fd.off += delta
+        # only targets inside the moved range change
+        if frm == idaapi.BADADDR or frm <= fd.off < frm + sz:
+            fd.off += delta
 
-        if fd.get_type() == ida_fixup.FIXUP_OFF8:
-            idaapi.put_byte(xEA, fd.off)
-        elif fd.get_type() == ida_fixup.FIXUP_OFF16:
-            idaapi.put_word(xEA, fd.off)
-        elif fd.get_type() == ida_fixup.FIXUP_OFF32:
-            idaapi.put_long(xEA, fd.off)
+            if fd.get_type() == ida_fixup.FIXUP_OFF8:
+                idaapi.put_byte(xEA, fd.off)
+            elif fd.get_type() == ida_fixup.FIXUP_OFF16:
+                idaapi.put_word(xEA, fd.off)
+            elif fd.get_type() == ida_fixup.FIXUP_OFF32:
+                idaapi.put_long(xEA, fd.off)
 
-        fd.set(xEA)
+            fd.set(xEA)
 
         xEA = ida_fixup.get_next_fixup_ea(xEA)
 
-    idaapi.cvar.inf.baseaddr = idaapi.cvar.inf.baseaddr + delta
+
+def _patch_reloc_sites(ea, offsets, delta):
+    """add delta to the longs at the sorted offsets from ea. neighbouring
+       sites are read and written back as one span. get_bytes fails on
+       spans with uninitialized bytes, their sites and overlapping ones are
+       patched one by one to keep the gaps uninitialized"""
+    fd = idaapi.fixup_data_t(idaapi.FIXUP_OFF32)
+    n = len(offsets)
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and offsets[j + 1] - offsets[j] <= _RELOC_SPAN_GAP:
+            j += 1
+        lo = offsets[i]
+        size = offsets[j] + 4 - lo
+        span = offsets[i:j + 1]
+        gaps = [off - prev for off, prev in zip(span, [lo] + [off + 4 for off in span[:-1]])]
+        data = idaapi.get_bytes(ea + lo, size) if min(gaps) >= 0 else None
+        if data is not None and len(data) == size:
+            # gaps and longs of the span in one unpack and one pack
+            st = struct.Struct(">" + "".join("%dsI" % gap for gap in gaps))
+            fields = list(st.unpack(data))
+            values = [(v + delta) & 0xffffffff for v in fields[1::2]]
+            fields[1::2] = values
+            idaapi.put_bytes(ea + lo, st.pack(*fields))
+        else:
+            values = []
+            for off in span:
+                value = (idaapi.get_dword(ea + off) + delta) & 0xffffffff
+                idaapi.put_dword(ea + off, value)
+                values.append(value)
+        for off, value in zip(span, values):
+            fd.off = value
+            fd.set(ea + off)
+        i = j + 1
+
+
+@profile.timed("move_segm")
+def move_segm(frm, to, sz, fileformatname):
+    _import_ida()
+    seg_addrs, relocs = _load_reloc_table()
+    if seg_addrs is None:
+        _move_fixups(frm, to, sz)
+        if frm == idaapi.BADADDR:
+            idaapi.cvar.inf.baseaddr = idaapi.cvar.inf.baseaddr + to
+        return 1
+
+    # whole program is rebased by 'to' or a single range is moved
+    if frm == idaapi.BADADDR:
+        delta = to
+        moved = set(xrange(len(seg_addrs)))
+    else:
+        delta = to - frm
+        moved = set(i for i, (start, size) in enumerate(seg_addrs)
+                    if frm <= start < frm + sz)
+    if delta == 0 or len(moved) == 0:
+        return 1
+
+    for i in moved:
+        start, size = seg_addrs[i]
+        seg_addrs[i] = (start + delta, size)
+
+    # only sites referring to a moved segment change their value
+    sites = {}
+    for seg_id, to_id, offsets in relocs:
+        if to_id in moved:
+            sites.setdefault(seg_id, []).extend(offsets)
+    for seg_id in sorted(sites):
+        offsets = sorted(sites[seg_id])
+        _patch_reloc_sites(seg_addrs[seg_id][0], offsets, delta)
+
+    _store_seg_addrs(seg_addrs)
+
+    if frm == idaapi.BADADDR:
+        idaapi.cvar.inf.baseaddr = idaapi.cvar.inf.baseaddr + delta
 
     return 1
+
+
+def _block_info(blk, verbose=False):
+    """one line description of a hunk block"""
+    blk_id = blk.blk_id
+    if blk_id == HUNK_HEADER:
+        return "hunks=%d..%d sizes=%s" % (blk.first_hunk, blk.last_hunk,
+                                          ",".join(["%d" % (x * 4) for x in blk.hunk_table]))
+    elif blk_id in loadseg_valid_begin_hunks:
+        if blk_id == HUNK_BSS:
+            return "size=%d" % (blk.size_longs * 4)
+        return "size=%d data@%d" % (blk.size_longs * 4, blk.data_offset)
+    elif isinstance(blk, (HunkRelocLongBlock, HunkRelocWordBlock)):
+        if verbose:
+            return " ".join(["#%d:%s" % (hunk_num, ",".join(["%x" % off for off in offsets]))
+                             for hunk_num, offsets in blk.relocs])
+        return " ".join(["#%d:%d" % (hunk_num, len(offsets)) for hunk_num, offsets in blk.relocs])
+    elif blk_id == HUNK_SYMBOL:
+        if verbose:
+            return " ".join(["%s=%x" % (name, off) for name, off in blk.symbols])
+        return "symbols=%d" % len(blk.symbols)
+    elif blk_id == HUNK_DEBUG:
+        debug_info = HunkDebug().decode(blk.debug_data)
+        if isinstance(debug_info, HunkDebugLine) and not verbose:
+            return "LINE %s @%08x lines=%d" % (debug_info.src_file, debug_info.base_offset,
+                                                len(debug_info.entries))
+        elif isinstance(debug_info, HunkDebugAny) and not verbose:
+            return "%s @%08x size=%d" % (debug_info.tag, debug_info.base_offset,
+                                          len(debug_info.data))
+        return str(debug_info)
+    elif blk_id in (HUNK_UNIT, HUNK_NAME):
+        return blk.name
+    elif blk_id == HUNK_EXT:
+        return " ".join(["%s(%d)" % (e.name, e.ext_type) for e in blk.entries])
+    elif blk_id == HUNK_LIB:
+        return "blocks=%d" % len(blk.blocks)
+    elif blk_id == HUNK_INDEX:
+        return "units=%d" % len(blk.units)
+    else:
+        return ""
+
+
+# separates a disk image and the path of a file on it
+_ADF_SEP = "::"
+
+# disk image opened last in this process
+_adf_cache = {}
+
+
+# unpacks crunched input files, keeps its buffer between files
+_decruncher = Decruncher()
+
+
+def _open_input(path, decrunch=True):
+    """open a file or a file on a disk image given as image::file.
+       crunched files are unpacked unless decrunch is False"""
+    if _ADF_SEP not in path:
+        f = open(path, "rb")
+    else:
+        image, name = path.split(_ADF_SEP, 1)
+        img = _adf_cache.get(image)
+        if img is None:
+            for old in _adf_cache.values():
+                old.close()
+            _adf_cache.clear()
+            img = _adf_cache[image] = AdfImage.open_path(image)
+        f = img.open(name)
+    if decrunch:
+        try:
+            mf = _decruncher.open(f)
+        except Exception:
+            f.close()
+            raise
+        if mf is not None:
+            f.close()
+            return mf
+        f.seek(0)
+    return f
+
+
+def _input_stat(path):
+    """return (mtime, size) of a file or a file on a disk image"""
+    if _ADF_SEP not in path:
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+    mtime = os.stat(path.split(_ADF_SEP, 1)[0]).st_mtime
+    with _open_input(path, False) as f:
+        return mtime, f.size()
+
+
+def _open_hunk_file(path, skip_data=False):
+    """read the blocks of a hunk file and return type and HunkBlockFile"""
+    bf = HunkBlockFile()
+    with _open_input(path) as f:
+        file_type = bf.peek_type(f)
+        bf.read(f, is_load_seg=file_type == TYPE_LOADSEG, skip_data=skip_data)
+    return file_type, bf
+
+
+def _load_bin_image(f, skip_data=False):
+    """load an executable, an object file or all units of a library"""
+    bf = BinFmtHunk()
+    file_type = HunkBlockFile().peek_type(f)
+    if file_type == TYPE_LOADSEG:
+        return bf.load_image_fobj(f, skip_data=skip_data)
+    elif file_type == TYPE_UNIT:
+        return bf.load_object_fobj(f, skip_data=skip_data)
+    elif file_type == TYPE_LIB:
+        index = bf.load_lib_index(f)
+        return bf.load_lib_units(f, index, index.units, skip_data=skip_data)
+    raise HunkParseError("no hunk file")
+
+
+def _cmd_info(args, out):
+    with _open_input(args.file) as f:
+        file_type = HunkBlockFile().peek_type(f)
+        out("%s: %s\n" % (args.file, type_names[file_type]))
+        if file_type == TYPE_LOADSEG:
+            bi = BinFmtHunk().load_image_fobj(f, skip_data=True, cache=ParseCache.from_env())
+        elif file_type == TYPE_UNIT:
+            bi = BinFmtHunk().load_object_fobj(f, skip_data=True)
+        elif file_type == TYPE_LIB:
+            index = BinFmtHunk.load_lib_index(f)
+            for unit in index.units:
+                sizes = ",".join("%s:%d" % (hunk_names.get(blk_id, blk_id), size)
+                                 for name, blk_id, size in unit.hunks)
+                out("%s @%d hunks=[%s] defs=%d refs=%d\n" % (unit.name, unit.file_offset, sizes,
+                                                             len(unit.defs), len(unit.refs)))
+            out("units: %d\n" % len(index.units))
+            return 0
+        else:
+            return 0
+    for seg in bi.get_segments():
+        out("%s\n" % seg)
+        if seg.unit is not None:
+            out("  unit=%s name=%s defs=%d refs=%d\n" % (seg.unit.name, seg.name,
+                                                       len(seg.ext_defs), len(seg.ext_refs)))
+    for node in bi.overlay_nodes:
+        out("overlay node @%d level=%d ordinate=%d first_hunk=%d symbols=%d\n" %
+            (node.offset, node.level, node.ordinate, node.first_hunk, len(node.symbols)))
+    out("total size: %d\n" % bi.get_size())
+    return 0
+
+
+def _cmd_dump(args, out):
+    file_type, bf = _open_hunk_file(args.file, skip_data=True)
+    out("%s: %s\n" % (args.file, type_names[file_type]))
+    for blk in bf.get_blocks():
+        out("%-18s %s\n" % (hunk_names[blk.blk_id], _block_info(blk, args.verbose)))
+        if blk.blk_id == HUNK_LIB:
+            for sub_blk in blk.blocks:
+                out("  %-16s %s\n" % (hunk_names[sub_blk.blk_id], _block_info(sub_blk, args.verbose)))
+    return 0
+
+
+def _seg_label(seg):
+    if seg is None:
+        return "-"
+    return "#%d %s size=%d" % (seg.id, seg.get_type_name(), seg.size)
+
+
+def _cmd_diff(args, out):
+    images = []
+    for path in (args.old, args.new):
+        with _open_input(path) as f:
+            images.append(_load_bin_image(f))
+    num = 0
+    for d in diff_images(images[0], images[1], args.block_size):
+        if d.is_equal():
+            continue
+        num += 1
+        out("%s -> %s\n" % (_seg_label(d.old), _seg_label(d.new)))
+        for off, size in d.ranges:
+            out("  changed %08x-%08x (%d)\n" % (off, off + size, size))
+        for to_id, off in d.relocs_added:
+            out("  reloc + %08x -> #%s\n" % (off, to_id))
+        for to_id, off in d.relocs_removed:
+            out("  reloc - %08x -> #%s\n" % (off, to_id))
+        for to_id, off, old_value, new_value in d.relocs_changed:
+            out("  reloc %08x -> #%s: %s -> %s\n" % (off, to_id, "%x" % old_value if old_value is not None else "-",
+                                                    "%x" % new_value if new_value is not None else "-"))
+        for name, off in d.symbols_added:
+            out("  symbol + %s @%x\n" % (name, off))
+        for name, off in d.symbols_removed:
+            out("  symbol - %s @%x\n" % (name, off))
+        for name, old_off, new_off in d.symbols_moved:
+            out("  symbol %s @%x -> @%x\n" % (name, old_off, new_off))
+    out("%d segments differ\n" % num)
+    return 1 if num else 0
+
+
+def _cmd_relocate(args, out):
+    with _open_input(args.file) as f:
+        bi = BinFmtHunk().load_image_fobj(f, cache=ParseCache.from_env())
+    rel = Relocate(bi)
+    addrs = rel.get_seq_addrs(args.base, args.padding)
+    data = rel.relocate_one_block(args.base, args.padding)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    for seg in bi.get_segments():
+        out("#%02d %s %08x-%08x\n" % (seg.id, seg.get_type_name(), addrs[seg.id],
+                                      addrs[seg.id] + seg.size))
+    return 0
+
+
+def _cmd_patch(args, out):
+    import binascii
+
+    with open(args.file, "r+b") as f:
+        hp = HunkPatcher(f)
+        for spec in args.write:
+            hunk, offset, data = spec.split(":", 2)
+            hp.write_data(int(hunk, 0), int(offset, 0), binascii.unhexlify(data))
+        for spec in args.rename:
+            old, new = spec.split("=", 1)
+            if hp.rename_symbol(old, new) == 0:
+                out("%s: not found\n" % old)
+        hp.flush()
+    return 0
+
+
+def _cmd_merge(args, out):
+    with _open_input(args.file) as f:
+        bi = BinFmtHunk().load_image_fobj(f)
+    merged = merge_segments(bi)
+    BinFmtHunk().save_image(args.output, merged)
+    out("merged %d segments into %d\n" % (len(bi.get_segments()), len(merged.get_segments())))
+    return 0
+
+
+def _binary_stdio(f):
+    """switch stdin or stdout to binary mode on windows"""
+    import sys
+    if sys.platform == "win32":
+        import msvcrt
+        msvcrt.setmode(f.fileno(), os.O_BINARY)
+    return f
+
+
+def _cmd_strip(args, out):
+    import sys
+
+    hs = HunkStripper()
+    # crunched files are copied as they are
+    f = _binary_stdio(sys.stdin) if args.file == "-" else _open_input(args.file, False)
+    tmp_path = None
+    try:
+        if args.output == "-":
+            hs.strip(f, _binary_stdio(sys.stdout))
+            sys.stdout.flush()
+            out = sys.stderr.write
+        else:
+            # a failed strip leaves no partial output
+            tmp_path = "%s.%d.tmp" % (args.output, os.getpid())
+            with open(tmp_path, "wb") as o:
+                hs.strip(f, o)
+    except BaseException:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    if tmp_path is not None:
+        if sys.platform == "win32" and os.path.exists(args.output):
+            os.remove(args.output)
+        os.rename(tmp_path, args.output)
+    out("stripped %d of %d blocks, %d bytes\n" % (hs.num_dropped, hs.num_blocks, hs.bytes_dropped))
+    return 0
+
+
+class _ScanTimeout(Exception):
+    pass
+
+
+# per worker settings of the scan command
+_scan_timeout = 0
+
+
+def _scan_init(timeout, mem_limit):
+    """set up a scan worker process"""
+    global _scan_timeout
+    _scan_timeout = timeout
+    if mem_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+
+
+def _scan_alarm(signum, frame):
+    raise _ScanTimeout("timeout after %d s" % _scan_timeout)
+
+
+def _scan_alarm_on():
+    if _scan_timeout:
+        import signal
+        signal.signal(signal.SIGALRM, _scan_alarm)
+        signal.alarm(_scan_timeout)
+
+
+def _scan_alarm_off():
+    if _scan_timeout:
+        import signal
+        signal.alarm(0)
+
+
+def _scan_blocks(blks, rec):
+    for blk in blks:
+        blk_id = blk.blk_id
+        if blk_id in loadseg_valid_begin_hunks:
+            rec["segments"].append([hunk_names[blk_id], blk.size_longs * 4])
+        elif isinstance(blk, (HunkRelocLongBlock, HunkRelocWordBlock)):
+            rec["relocs"] += sum(len(offsets) for hunk_num, offsets in blk.relocs)
+        elif blk_id == HUNK_SYMBOL:
+            rec["symbols"] += len(blk.symbols)
+        elif blk_id == HUNK_DEBUG:
+            tag = _to_text(blk.debug_data[4:8])
+            if tag not in rec["debug"]:
+                rec["debug"].append(tag)
+        elif blk_id == HUNK_LIB:
+            _scan_blocks(blk.blocks, rec)
+
+
+def _to_text(s):
+    """decode the byte strings of file names and tags for JSON records"""
+    return s if isinstance(s, unicode) else s.decode("latin-1")
+
+
+def _scan_file(path):
+    """parse the block structure of a file and return its JSON record"""
+    rec = {"path": _to_text(path), "type": None, "segments": [], "relocs": 0, "symbols": 0, "debug": []}
+    bf = HunkBlockFile()
+    f = None
+    _scan_alarm_on()
+    try:
+        f = _open_input(path)
+        file_type = bf.peek_type(f)
+        bf.read(f, is_load_seg=file_type == TYPE_LOADSEG, skip_data=True)
+        rec["type"] = type_names[bf.detect_type()]
+        # skipped payloads are not checked while reading
+        size = f.size() if isinstance(f, MemFile) else os.fstat(f.fileno()).st_size
+        if f.tell() > size:
+            rec["error"] = "HunkParseError: truncated file"
+            rec["offset"] = size
+    except Exception as e:
+        rec["type"] = type_names[bf.detect_type()]
+        rec["error"] = _to_text("%s: %s" % (e.__class__.__name__, e))
+        if f is not None and not f.closed:
+            rec["offset"] = f.tell()
+    finally:
+        _scan_alarm_off()
+        if f is not None:
+            f.close()
+    rec["blocks"] = len(bf.get_blocks())
+    _scan_blocks(bf.get_blocks(), rec)
+    return rec
+
+
+def _scan_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    for p in _expand_input(os.path.join(root, name)):
+                        yield p
+        else:
+            for p in _expand_input(path):
+                yield p
+
+
+def _expand_input(path):
+    """yield a path or the hunk files on a disk image as image::file"""
+    if not path.lower().endswith(".adf"):
+        yield path
+        return
+    try:
+        img = AdfImage.open_path(path)
+    except (HunkParseError, EnvironmentError, ValueError):
+        yield path
+        return
+    try:
+        files = img.get_hunk_files()
+    finally:
+        img.close()
+    for name, file_type in files:
+        yield path + _ADF_SEP + name
+
+
+def _scan_done(output):
+    """return the paths already recorded in an output file"""
+    import json
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, "r") as f:
+        for line in f:
+            try:
+                # paths are recorded as latin-1 decoded
+                done.add(json.loads(line)["path"].encode("latin-1"))
+            except (ValueError, KeyError):
+                # incomplete last line of an interrupted run
+                pass
+    return done
+
+
+def _file_hash(path):
+    import hashlib
+    h = hashlib.sha256()
+    with _open_input(path, False) as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _index_file(item):
+    """hash a file and collect its symbols unless the hash is unchanged.
+       return (path, mtime, size, hash, symbols or None, error)"""
+    path, old_hash = item
+    symbols = None
+    error = None
+    _scan_alarm_on()
+    try:
+        st = _input_stat(path)
+        digest = _file_hash(path)
+        if digest != old_hash:
+            bf = HunkBlockFile()
+            with _open_input(path) as f:
+                file_type = bf.peek_type(f)
+                if file_type != TYPE_UNKNOWN:
+                    bf.read(f, is_load_seg=file_type == TYPE_LOADSEG, skip_data=True)
+            symbols = []
+            _collect_symbols(bf.get_blocks(), symbols)
+    except Exception as e:
+        st = None
+        digest = None
+        error = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        _scan_alarm_off()
+    if st is None:
+        return path, None, None, None, None, error
+    return path, st[0], st[1], digest, symbols, error
+
+
+def _cmd_index(args, out):
+    import multiprocessing
+
+    idx = SymbolIndex(args.db)
+    files = idx.get_files()
+    todo = []
+    seen = set()
+    for path in _scan_paths(args.paths):
+        path = os.path.abspath(path)
+        seen.add(path)
+        st = _input_stat(path)
+        row = files.get(path.decode("latin-1") if isinstance(path, str) else path)
+        if row is not None and row[1:3] == st:
+            continue
+        todo.append((path, row[3] if row is not None else None))
+    num = unchanged = errors = 0
+    pool = multiprocessing.Pool(args.jobs, _scan_init, (args.timeout, 0))
+    try:
+        for path, mtime, size, digest, symbols, error in pool.imap_unordered(_index_file, todo, args.chunk):
+            if error is not None:
+                out("%s: %s\n" % (path, error))
+                errors += 1
+            elif symbols is None:
+                idx.touch(path, mtime, size)
+                unchanged += 1
+            else:
+                idx.update(path, mtime, size, digest, symbols)
+                num += 1
+                # bulk inserts in large transactions
+                if num % 1000 == 0:
+                    idx.commit()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    # drop files that are gone
+    removed = 0
+    for path in files:
+        if path in seen:
+            continue
+        try:
+            _input_stat(path)
+        except (OSError, IOError, HunkParseError, ValueError):
+            idx.remove(path)
+            removed += 1
+    idx.close()
+    out("indexed %d files, %d unchanged, %d removed, %d errors\n" % (num, unchanged, removed, errors))
+    return 0
+
+
+def _cmd_find(args, out):
+    idx = SymbolIndex(args.db)
+    for name, kind, hunk, value, path in idx.find(args.name, args.prefix, args.kind, args.limit):
+        value = "" if value is None else "%08x" % value
+        out("%s %s #%d %s %s\n" % (path.encode("latin-1"), kind, hunk, value, name.encode("latin-1")))
+    idx.close()
+    return 0
+
+
+def _cmd_mksig(args, out):
+    if args.append and os.path.exists(args.db):
+        db = SignatureDB.load(args.db)
+    else:
+        db = SignatureDB(args.window)
+    for path in _scan_paths(args.paths):
+        try:
+            with _open_input(path) as f:
+                bi = _load_bin_image(f)
+        except (HunkParseError, EnvironmentError) as e:
+            out("%s: %s\n" % (path, e))
+            continue
+        out("%s: %d signatures\n" % (path, db.add_image(bi)))
+    db.save(args.db)
+    out("total: %d signatures\n" % db.num)
+    return 0
+
+
+def _cmd_match(args, out):
+    db = SignatureDB.load(args.db)
+    with _open_input(args.file) as f:
+        bi = _load_bin_image(f)
+    for seg in bi.get_segments():
+        for off, size, name in db.match_segment(seg):
+            out("#%02d+%06x %6d %s\n" % (seg.id, off, size, name))
+    return 0
+
+
+def _sim_file(path):
+    """return (path, segment signatures, error) of a file"""
+    _scan_alarm_on()
+    try:
+        with _open_input(path) as f:
+            bi = _load_bin_image(f)
+        return path, MinHashIndex.image_signatures(bi), None
+    except Exception as e:
+        return path, None, "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        _scan_alarm_off()
+
+
+def _cmd_simindex(args, out):
+    import multiprocessing
+
+    idx = MinHashIndex()
+    paths = list(_scan_paths(args.paths))
+    errors = 0
+    pool = multiprocessing.Pool(args.jobs, _scan_init, (args.timeout, 0))
+    try:
+        for path, signatures, error in pool.imap(_sim_file, paths, args.chunk):
+            if error is not None:
+                out("%s: %s\n" % (path, error))
+                errors += 1
+            elif signatures:
+                idx.add(path, signatures)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    idx.save(args.db)
+    out("indexed %d files, %d segments, %d errors\n" % (len(idx.paths), len(idx.segs), errors))
+    return 0
+
+
+def _cmd_similar(args, out):
+    idx = MinHashIndex.load(args.db)
+    with _open_input(args.file) as f:
+        signatures = MinHashIndex.image_signatures(_load_bin_image(f))
+    for score, path in idx.query(signatures, args.top):
+        out("%.3f %s\n" % (score, path))
+    return 0
+
+
+def _cmd_adf(args, out):
+    img = AdfImage.open_path(args.image)
+    try:
+        out("%s: %s\n" % (args.image, "FFS" if img.ffs else "OFS"))
+        for name, file_type in img.get_hunk_files():
+            out("%-8s %s%s%s\n" % (type_names[file_type], args.image, _ADF_SEP, name))
+    finally:
+        img.close()
+    return 0
+
+
+def _cmd_decrunch(args, out):
+    with _open_input(args.file, False) as f:
+        data = f.read()
+    name = Decruncher.detect(data)
+    if name is None:
+        out("%s: not crunched\n" % args.file)
+        return 1
+    data = Decruncher().decrunch(data)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    out("%s: %s, %d bytes\n" % (args.file, name, len(data)))
+    return 0
+
+
+def _bench_payloads(size):
+    """return (name, data) of synthetic test payloads of about size bytes"""
+    import random
+
+    rnd = random.Random(size)
+    words = ["".join(chr(rnd.randint(97, 122)) for i in xrange(rnd.randint(2, 9)))
+             for j in xrange(100)]
+    parts = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words) + " "
+        parts.append(w)
+        n += len(w)
+    text = "".join(parts)[:size]
+    # 68k like code: instructions of 2 to 6 bytes from a small set
+    ops = ["".join(struct.pack(">H", rnd.randint(0, 0xffff)) for i in xrange(rnd.randint(1, 3)))
+           for j in xrange(200)]
+    parts = []
+    n = 0
+    while n < size:
+        op = rnd.choice(ops)
+        parts.append(op)
+        n += len(op)
+    code = "".join(parts)[:size & ~3]
+    noise = "".join(chr(rnd.randint(0, 255)) for i in xrange(size))
+    exe = (struct.pack(">9I", HUNK_HEADER, 0, 1, 0, 0, len(code) / 4, HUNK_CODE, len(code) / 4, 0)[:-4]
+           + code + struct.pack(">I", HUNK_END))
+    return [("text", text), ("code", code), ("random", noise), ("hunk", exe)]
+
+
+def _cmd_bench(args, out):
+    """time PowerPacker decrunching of synthetic payloads"""
+    dec = Decruncher()
+    out("%-8s %9s %9s %6s %10s %10s\n" % ("payload", "size", "packed", "ratio", "MB/s", "parse MB/s"))
+    for name, data in _bench_payloads(args.size):
+        packed = pp20_crunch(data)
+        if dec.decrunch(packed) != data:
+            raise HunkParseError("%s: decrunched data differs" % name)
+        best = None
+        for i in xrange(args.repeat):
+            start = time.time()
+            dec.decrunch(packed)
+            t = time.time() - start
+            best = t if best is None else min(best, t)
+        parse = "-"
+        if name == "hunk":
+            start = time.time()
+            BinFmtHunk().load_image_fobj(MemFile(data))
+            parse = "%.1f" % (len(data) / max(time.time() - start, 1e-9) / 1e6)
+        out("%-8s %9d %9d %5.1f%% %10.2f %10s\n" % (name, len(data), len(packed),
+                                                  100.0 * len(packed) / max(len(data), 1),
+                                                  len(data) / max(best, 1e-9) / 1e6, parse))
+    return 0
+
+
+def _cmd_scan(args, out):
+    import json
+    import multiprocessing
+
+    done = _scan_done(args.output) if args.resume else set()
+    # the output may be inside a scanned directory
+    output = os.path.abspath(args.output)
+    paths = [p for p in _scan_paths(args.paths) if p not in done and os.path.abspath(p) != output]
+    num = errors = 0
+    pool = multiprocessing.Pool(args.jobs, _scan_init, (args.timeout, args.mem_limit * 1024 * 1024))
+    try:
+        with open(args.output, "a" if args.resume else "w") as f:
+            for rec in pool.imap_unordered(_scan_file, paths, args.chunk):
+                f.write(json.dumps(rec, sort_keys=True) + "\n")
+                f.flush()
+                num += 1
+                if "error" in rec:
+                    errors += 1
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    out("scanned %d files, %d errors, %d skipped\n" % (num, errors, len(done)))
+    return 0
+
+
+def main(argv=None):
+    """headless command line interface"""
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog="amiga_hunk", description="Amiga hunk file tool")
+    sub = parser.add_subparsers(dest="cmd")
+
+    p = sub.add_parser("info", help="show file type and segments")
+    p.add_argument("file")
+    p.set_defaults(func=_cmd_info)
+
+    p = sub.add_parser("dump", help="list all hunk blocks")
+    p.add_argument("file")
+    p.add_argument("-v", "--verbose", action="store_true", help="list relocations and symbols")
+    p.set_defaults(func=_cmd_dump)
+
+    p = sub.add_parser("diff", help="compare two files with relocation sites masked")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("-b", "--block-size", type=int, default=256, help="bytes compared at once")
+    p.set_defaults(func=_cmd_diff)
+
+    p = sub.add_parser("relocate", help="write relocated segments as one binary blob")
+    p.add_argument("file")
+    p.add_argument("output")
+    p.add_argument("-b", "--base", type=lambda x: int(x, 0), default=Relocate.DEF_IMAGE_BASE)
+    p.add_argument("-p", "--padding", type=lambda x: int(x, 0), default=0)
+    p.set_defaults(func=_cmd_relocate)
+
+    p = sub.add_parser("patch", help="change bytes or symbol names of a file in place")
+    p.add_argument("file")
+    p.add_argument("-w", "--write", action="append", default=[], metavar="HUNK:OFFSET:HEX",
+                   help="overwrite bytes of a hunk")
+    p.add_argument("-r", "--rename", action="append", default=[], metavar="OLD=NEW",
+                   help="rename a symbol")
+    p.set_defaults(func=_cmd_patch)
+
+    p = sub.add_parser("merge", help="merge segments of the same type and memory flags")
+    p.add_argument("file")
+    p.add_argument("output")
+    p.set_defaults(func=_cmd_merge)
+
+    p = sub.add_parser("strip", help="remove HUNK_SYMBOL and HUNK_DEBUG blocks")
+    p.add_argument("file", help="input file or - for stdin")
+    p.add_argument("output", help="output file or - for stdout")
+    p.set_defaults(func=_cmd_strip)
+
+    p = sub.add_parser("mksig", help="build function signatures from files with symbols")
+    p.add_argument("db")
+    p.add_argument("paths", nargs="+", help="files or directories")
+    p.add_argument("-a", "--append", action="store_true", help="add to an existing file")
+    p.add_argument("-w", "--window", type=int, default=SignatureDB.WINDOW, help="key bytes")
+    p.set_defaults(func=_cmd_mksig)
+
+    p = sub.add_parser("match", help="find signature functions in a file")
+    p.add_argument("db")
+    p.add_argument("file")
+    p.set_defaults(func=_cmd_match)
+
+    p = sub.add_parser("simindex", help="build a near duplicate index of files")
+    p.add_argument("db")
+    p.add_argument("paths", nargs="+", help="files or directories")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    p.add_argument("-c", "--chunk", type=int, default=16, help="files per work item")
+    p.add_argument("-t", "--timeout", type=int, default=30, help="seconds per file, 0 for none")
+    p.set_defaults(func=_cmd_simindex)
+
+    p = sub.add_parser("similar", help="list the files most similar to a file")
+    p.add_argument("db")
+    p.add_argument("file")
+    p.add_argument("-k", "--top", type=int, default=10)
+    p.set_defaults(func=_cmd_similar)
+
+    p = sub.add_parser("adf", help="list the hunk files on an ADF disk image")
+    p.add_argument("image")
+    p.set_defaults(func=_cmd_adf)
+
+    p = sub.add_parser("decrunch", help="unpack a crunched file")
+    p.add_argument("file")
+    p.add_argument("output")
+    p.set_defaults(func=_cmd_decrunch)
+
+    p = sub.add_parser("bench", help="time decrunching of synthetic payloads")
+    p.add_argument("-s", "--size", type=int, default=256 * 1024, help="payload bytes")
+    p.add_argument("-n", "--repeat", type=int, default=5)
+    p.set_defaults(func=_cmd_bench)
+
+    p = sub.add_parser("scan", help="parse many files in parallel and write JSON lines")
+    p.add_argument("output")
+    p.add_argument("paths", nargs="+", help="files or directories")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    p.add_argument("-c", "--chunk", type=int, default=16, help="files per work item")
+    p.add_argument("-t", "--timeout", type=int, default=30, help="seconds per file, 0 for none")
+    p.add_argument("-m", "--mem-limit", type=int, default=0, help="MB per worker, 0 for none")
+    p.add_argument("-r", "--resume", action="store_true", help="skip files already in output")
+    p.set_defaults(func=_cmd_scan)
+
+    p = sub.add_parser("index", help="add the symbols of files to a SQLite index")
+    p.add_argument("db")
+    p.add_argument("paths", nargs="+", help="files or directories")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    p.add_argument("-c", "--chunk", type=int, default=16, help="files per work item")
+    p.add_argument("-t", "--timeout", type=int, default=30, help="seconds per file, 0 for none")
+    p.set_defaults(func=_cmd_index)
+
+    p = sub.add_parser("find", help="look up a symbol in a SQLite index")
+    p.add_argument("db")
+    p.add_argument("name")
+    p.add_argument("-p", "--prefix", action="store_true", help="match names starting with name")
+    p.add_argument("-k", "--kind", choices=("sym", "def", "ref", "lib"))
+    p.add_argument("-n", "--limit", type=int, default=None)
+    p.set_defaults(func=_cmd_find)
+
+    args = parser.parse_args(argv)
+    try:
+        ret = args.func(args, sys.stdout.write)
+    except (HunkParseError, EnvironmentError) as e:
+        sys.stderr.write("%s: %s\n" % (args.cmd, e))
+        ret = 1
+    profile.emit(sys.stderr.write)
+    return ret
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import amiga_hunk as ah  # noqa: E402
+
+
+def build_exe(debug=True):
+    """return an executable with CODE, DATA (extra memory attributes) and
+       BSS hunks, relocations in both directions, symbols and line numbers"""
+    code = bytearray(64 * 4)
+    for off in xrange(16, 56, 4):
+        struct.pack_into(">I", code, off, off * 2)
+    data = bytearray(8 * 4)
+    struct.pack_into(">I", data, 0, 8)
+    hdr = ah.HunkHeaderBlock()
+    hdr.setup([64, 16, 1024], [0, 3, 1])
+    hdr.hunk_mem_attrs[1] = 0x12345
+    blks = [hdr,
+            ah.HunkSegmentBlock(ah.HUNK_CODE, str(code), size_longs=64),
+            ah.HunkRelocLongBlock(ah.HUNK_ABSRELOC32, [(0, range(16, 36, 4)), (1, [36, 40]), (2, [44])]),
+            ah.HunkSymbolBlock([("start", 0), ("func", 40)])]
+    if debug:
+        dl = ah.HunkDebugLine("src/main.c", 0)
+        for i in xrange(5):
+            dl.add_entry(i * 8, 10 + i)
+        blks.append(ah.HunkDebugBlock(ah.HunkDebug().encode(dl)))
+    blks += [ah.HunkEndBlock(),
+             ah.HunkSegmentBlock(ah.HUNK_DATA, str(data), size_longs=8),
+             ah.HunkRelocWordBlock(ah.HUNK_RELOC32SHORT, [(0, [0])]),
+             ah.HunkEndBlock(),
+             ah.HunkSegmentBlock(ah.HUNK_BSS, None, size_longs=1024),
+             ah.HunkEndBlock()]
+    return str(ah.HunkBlockFile(blks).encode(is_load_seg=True))
+
+
+def build_object():
+    """return an object file with a unit, a named CODE hunk, definitions,
+       references, short relocations and symbols"""
+    code = bytearray(16 * 4)
+    ext = ah.HunkExtBlock()
+    ext.entries = [ah.HunkExtEntry("_main", ah.EXT_DEF, 0, None, None),
+                   ah.HunkExtEntry("_puts", ah.EXT_ABSREF32, None, None, [8, 12]),
+                   ah.HunkExtEntry("_buf", ah.EXT_ABSCOMMON, None, 64, [16])]
+    unit = ah.HunkUnitBlock()
+    unit.name = "main.o"
+    name = ah.HunkNameBlock()
+    name.name = "text"
+    blks = [unit, name,
+            ah.HunkSegmentBlock(ah.HUNK_CODE, str(code), size_longs=16),
+            ah.HunkRelocWordBlock(ah.HUNK_RELOC32SHORT, [(0, [20, 24])]),
+            ext,
+            ah.HunkSymbolBlock([("_main", 0)]),
+            ah.HunkEndBlock()]
+    return str(ah.HunkBlockFile(blks).encode())
+
+
+def layout(bi):
+    """return the segments of a BinImage as comparable tuples"""
+    res = []
+    for seg in bi.get_segments():
+        relocs = []
+        for to_seg in seg.get_reloc_to_segs():
+            for r in seg.get_reloc(to_seg).get_relocs():
+                relocs.append((to_seg.id, r.offset, r.width, r.addend))
+        symbols = []
+        if seg.get_symtab() is not None:
+            symbols = [(s.offset, s.name) for s in seg.get_symtab().get_symbols()]
+        lines = []
+        if seg.get_debug_line() is not None:
+            for df in seg.get_debug_line().get_files():
+                lines.append((df.src_file, df.dir_name, df.base_offset,
+                              [(e.offset, e.src_line, e.flags) for e in df.get_entries()]))
+        res.append((seg.id, seg.seg_type, seg.size, seg.data_size, seg.flags,
+                    seg.mem_attrs, seg.data, sorted(relocs), symbols, lines))
+    return res
+
+
+@pytest.fixture
+def exe_path(tmpdir):
+    path = tmpdir.join("prog")
+    path.write(build_exe(), "wb")
+    return str(path)
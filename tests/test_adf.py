@@ -0,0 +1,162 @@
+import struct
+
+import pytest
+
+import amiga_hunk as ah
+from conftest import build_exe, build_object
+
+BLOCK = 512
+ROOT = 880
+
+
+def _hash(name):
+    h = len(name)
+    for c in name.upper():
+        h = (h * 13 + ord(c)) & 0x7ff
+    return h % 72
+
+
+def build_adf(files, ffs):
+    """return an OFS or FFS disk image with the given (path, data) files"""
+    img = bytearray(1760 * BLOCK)
+    img[0:4] = "DOS" + chr(1 if ffs else 0)
+    free = [ROOT + 2]
+
+    def alloc():
+        free[0] += 1
+        return free[0] - 1
+
+    def put(blk, off, value):
+        struct.pack_into(">I", img, blk * BLOCK + off, value & 0xffffffff)
+
+    def header(blk, name, sec_type, parent):
+        put(blk, 0, 2)
+        put(blk, 4, blk)
+        put(blk, 500, parent)
+        put(blk, 508, sec_type)
+        img[blk * BLOCK + 432] = len(name)
+        img[blk * BLOCK + 433:blk * BLOCK + 433 + len(name)] = name
+        if parent:
+            # prepend to the hash chain of the directory
+            slot = parent * BLOCK + 24 + _hash(name) * 4
+            img[blk * BLOCK + 496:blk * BLOCK + 500] = img[slot:slot + 4]
+            put(parent, 24 + _hash(name) * 4, blk)
+
+    header(ROOT, "disk", 1, 0)
+    put(ROOT, 12, 72)
+    dirs = {"": ROOT}
+    for path, data in files:
+        parts = path.split("/")
+        parent = ""
+        for part in parts[:-1]:
+            name = parent + part + "/"
+            if name not in dirs:
+                dirs[name] = alloc()
+                header(dirs[name], part, 2, dirs[parent])
+            parent = name
+        blk = alloc()
+        header(blk, parts[-1], -3, dirs[parent])
+        put(blk, 324, len(data))
+        size = BLOCK if ffs else BLOCK - 24
+        data_blocks = []
+        for seq, pos in enumerate(xrange(0, len(data), size)):
+            chunk = data[pos:pos + size]
+            key = alloc()
+            data_blocks.append(key)
+            if ffs:
+                img[key * BLOCK:key * BLOCK + len(chunk)] = chunk
+            else:
+                put(key, 0, 8)
+                put(key, 4, blk)
+                put(key, 8, seq + 1)
+                put(key, 12, len(chunk))
+                img[key * BLOCK + 24:key * BLOCK + 24 + len(chunk)] = chunk
+        # 72 data blocks per header, the rest in extension blocks
+        cur = blk
+        while True:
+            part, data_blocks = data_blocks[:72], data_blocks[72:]
+            put(cur, 8, len(part))
+            for i, key in enumerate(part):
+                put(cur, 24 + (71 - i) * 4, key)
+            if not data_blocks:
+                break
+            ext = alloc()
+            put(ext, 0, 16)
+            put(cur, 504, ext)
+            cur = ext
+    return str(img)
+
+
+@pytest.fixture(params=[False, True], ids=["ofs", "ffs"])
+def adf(request):
+    big = "".join(chr(i & 0xff) for i in xrange(40000))
+    files = [("c/prog", build_exe()), ("libs/sub/main.o", build_object()),
+             ("readme", "hello\n"), ("big", big)]
+    return ah.AdfImage(build_adf(files, request.param)), dict(files)
+
+
+def test_walk(adf):
+    img, files = adf
+    assert [name for name, key in img.walk()] == ["big", "c/prog", "libs/sub/main.o", "readme"]
+
+
+def test_read_files(adf):
+    img, files = adf
+    for name, data in files.items():
+        f = img.open(name.upper())
+        assert f.size() == len(data)
+        assert f.read(len(data)) == data
+    # a file with extension blocks read in parts
+    f = img.open("big")
+    f.seek(36000)
+    assert f.read(1000) == files["big"][36000:37000]
+
+
+def test_hunk_files(adf):
+    img, files = adf
+    assert img.get_hunk_files() == [("c/prog", ah.TYPE_LOADSEG), ("libs/sub/main.o", ah.TYPE_UNIT)]
+    bi = ah.BinFmtHunk().load_image_fobj(img.open("c/prog"))
+    assert len(bi.get_segments()) == 3
+
+
+def test_missing_file(adf):
+    img, files = adf
+    with pytest.raises(IOError):
+        img.open("c/none")
+
+
+def test_no_disk_image():
+    with pytest.raises(ah.HunkParseError):
+        ah.AdfImage("\0" * 901120)
+
+
+class _CountingFile(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.num = 0
+
+    def seek(self, pos, whence=0):
+        self.pos = pos
+
+    def read(self, n):
+        self.num += n
+        self.pos += n
+        return self.data[self.pos - n:self.pos]
+
+
+def test_read_blocks():
+    files = [("c/prog", build_exe()), ("big", "\xaa" * 100000)]
+    f = _CountingFile(build_adf(files, False))
+    img = ah.AdfImage.from_fobj(f, len(f.data))
+    assert img.get_hunk_files() == [("c/prog", ah.TYPE_LOADSEG)]
+    assert img.open("c/prog").read() == files[0][1]
+    # directory and file blocks only, not the whole image
+    assert f.num < 20 * BLOCK
+
+
+def test_no_root_block():
+    data = bytearray(build_adf([], False))
+    data[ROOT * BLOCK] = 0xff
+    with pytest.raises(ah.HunkParseError):
+        ah.AdfImage(str(data))
@@ -0,0 +1,84 @@
+import struct
+import StringIO
+
+import pytest
+
+import amiga_hunk as ah
+from conftest import build_exe, build_object, layout
+
+
+def _read(data, is_load_seg):
+    bf = ah.HunkBlockFile()
+    bf.read(StringIO.StringIO(data), is_load_seg=is_load_seg)
+    return bf
+
+
+def test_exe_round_trip():
+    data = build_exe()
+    bf = _read(data, True)
+    assert bf.get_size() == len(data)
+    assert str(bf.encode(is_load_seg=True)) == data
+    out = StringIO.StringIO()
+    bf.write(out, is_load_seg=True)
+    assert out.getvalue() == data
+
+
+def test_object_round_trip():
+    data = build_object()
+    bf = _read(data, False)
+    assert [blk.blk_id for blk in bf.get_blocks()] == [
+        ah.HUNK_UNIT, ah.HUNK_NAME, ah.HUNK_CODE, ah.HUNK_RELOC32SHORT,
+        ah.HUNK_EXT, ah.HUNK_SYMBOL, ah.HUNK_END]
+    assert str(bf.encode()) == data
+
+
+def test_raw_block_ids_are_kept():
+    hdr = ah.HunkHeaderBlock()
+    hdr.setup([2])
+    data = struct.pack(">I", ah.HUNK_HEADER) + str(ah.HunkBlockFile([hdr]).encode())[4:]
+    # chip memory flag in the block id and a V37 HUNK_DREL32 table
+    data += struct.pack(">II8s", ah.HUNK_CODE | (1 << 30), 2, "\0" * 8)
+    data += struct.pack(">IHHHH", ah.HUNK_DREL32, 1, 0, 4, 0)
+    data += struct.pack(">I", ah.HUNK_END)
+    bf = _read(data, True)
+    assert bf.get_blocks()[2].blk_id == ah.HUNK_RELOC32SHORT
+    assert str(bf.encode(is_load_seg=True)) == data
+
+
+def test_relocs_split_into_short_and_long_tables():
+    seg = ah.HunkSegment()
+    short = range(4, 100, 4)
+    seg.setup_relocs([(0, [0x10000] + short[::-1]), (1, [12]), (1, [12, 0x20000])])
+    blks = seg.reloc_blks
+    assert [blk.blk_id for blk in blks] == [ah.HUNK_ABSRELOC32, ah.HUNK_RELOC32SHORT]
+    assert blks[0].relocs == [(0, [0x10000]), (1, [0x20000])]
+    assert blks[1].relocs == [(0, short), (1, [12])]
+
+    seg.setup_relocs([(0, [4, 8])], force_long=True)
+    assert [(blk.blk_id, blk.relocs) for blk in seg.reloc_blks] == [(ah.HUNK_ABSRELOC32, [(0, [4, 8])])]
+
+
+def test_relocs_single_long_table_if_smaller():
+    seg = ah.HunkSegment()
+    seg.setup_relocs([(0, [4, 0x10000])])
+    assert [(blk.blk_id, blk.relocs) for blk in seg.reloc_blks] == \
+        [(ah.HUNK_ABSRELOC32, [(0, [4, 0x10000])])]
+
+
+def test_save_image_round_trip():
+    bf = ah.BinFmtHunk()
+    bi = bf.load_image_fobj(StringIO.StringIO(build_exe()))
+    out = StringIO.StringIO()
+    bf.save_image_fobj(out, bi)
+    saved = bf.load_image_fobj(StringIO.StringIO(out.getvalue()))
+    # the DATA hunk keeps its alloc size beyond the data and its attributes
+    assert saved.get_segments()[1].size == 64
+    assert saved.get_segments()[1].flags == 3
+    assert layout(saved) == layout(bi)
+
+
+def test_skipped_segment_data_is_not_written():
+    bf = ah.HunkBlockFile()
+    bf.read(StringIO.StringIO(build_exe()), is_load_seg=True, skip_data=True)
+    with pytest.raises(ah.HunkParseError):
+        bf.encode(is_load_seg=True)
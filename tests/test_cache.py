@@ -0,0 +1,37 @@
+import amiga_hunk as ah
+from conftest import layout
+
+
+def test_cache_hit_matches_cold_parse(exe_path, tmpdir):
+    cold = ah.BinFmtHunk().load_image(exe_path)
+    cache = ah.ParseCache(str(tmpdir.join("cache")))
+    ah.BinFmtHunk().load_image(exe_path, cache=cache)
+    with open(exe_path, "rb") as f:
+        assert cache.get(cache.get_key(f)) is not None
+    hit = ah.BinFmtHunk().load_image(exe_path, cache=cache)
+    assert hit.get_file_data() is None
+    assert layout(hit) == layout(cold)
+    assert [seg.data_offset for seg in hit.get_segments()] == \
+        [seg.data_offset for seg in cold.get_segments()]
+    assert cold.get_segments()[1].mem_attrs == 0x12345
+
+
+def test_cache_skips_unsupported_images(exe_path, tmpdir):
+    bi = ah.BinFmtHunk().load_image(exe_path)
+    seg = bi.get_segments()[0]
+    seg.get_reloc(seg).get_relocs()[0].addend = 4
+    cache = ah.ParseCache(str(tmpdir.join("cache")))
+    assert not cache.put("key", bi)
+    assert cache.get("key") is None
+
+
+def test_cache_store_errors_do_not_fail_loads(exe_path, tmpdir, monkeypatch):
+    def rename(src, dst):
+        raise OSError(13, "Permission denied")
+
+    cache_dir = tmpdir.join("cache")
+    cache = ah.ParseCache(str(cache_dir))
+    monkeypatch.setattr(ah.os, "rename", rename)
+    bi = ah.BinFmtHunk().load_image(exe_path, cache=cache)
+    assert len(bi.get_segments()) == 3
+    assert cache_dir.listdir() == []
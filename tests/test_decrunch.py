@@ -0,0 +1,50 @@
+import random
+import StringIO
+
+import pytest
+
+import amiga_hunk as ah
+from conftest import build_exe
+
+
+@pytest.mark.parametrize("data", ["a", "abc" * 1000, "\0" * 4096, "hello world\n" * 50])
+def test_pp20_round_trip(data):
+    packed = ah.pp20_crunch(data)
+    assert ah.Decruncher.detect(packed) == "PowerPacker"
+    assert ah.Decruncher().decrunch(packed) == data
+
+
+def test_pp20_round_trip_mixed():
+    rnd = random.Random(5)
+    data = "".join(rnd.choice(("move.l ", "d0,", "(a0)+", "\n", "rts ")) for i in xrange(3000))
+    data += str(bytearray(rnd.getrandbits(8) for i in xrange(5000)))
+    dec = ah.Decruncher()
+    packed = ah.pp20_crunch(data)
+    assert len(packed) < len(data)
+    assert dec.decrunch(packed) == data
+    # the reused buffer doesn't leak into later results
+    assert dec.decrunch(ah.pp20_crunch("short")) == "short"
+
+
+def test_open_crunched_file():
+    exe = build_exe()
+    mf = ah.Decruncher().open(StringIO.StringIO(ah.pp20_crunch(exe)))
+    assert isinstance(mf, ah.MemFile)
+    assert mf.read(mf.size()) == exe
+    assert ah.Decruncher().open(StringIO.StringIO(exe)) is None
+
+
+def test_unsupported_cruncher():
+    with pytest.raises(ah.HunkParseError):
+        ah.Decruncher().decrunch("IMP!" + "\0" * 64)
+    with pytest.raises(ah.HunkParseError):
+        ah.Decruncher().decrunch(build_exe())
+
+
+def test_accept_crunched_file():
+    exe = build_exe()
+    res = ah.accept_file(ah.MemFile(ah.pp20_crunch(exe)), "prog")
+    assert res["format"] == "Amiga PowerPacker crunched hunk file"
+    # crunched data that is no hunk file and unsupported crunchers
+    assert ah.accept_file(ah.MemFile(ah.pp20_crunch("hello world\n" * 50)), "text") == 0
+    assert ah.accept_file(ah.MemFile("IMP!" + "\0" * 64), "imp") == 0
@@ -0,0 +1,88 @@
+import struct
+import StringIO
+
+import amiga_hunk as ah
+from conftest import build_exe
+
+
+def _load(data):
+    return ah.BinFmtHunk().load_image_fobj(StringIO.StringIO(data))
+
+
+def _changed(bi, changes, relocs=None, symbols=None):
+    """return the image with bytes of the CODE segment changed"""
+    code = bi.get_segments()[0]
+    data = bytearray(code.data)
+    for off, value in changes:
+        struct.pack_into(">I", data, off, value)
+    code.data = str(data)
+    if relocs is not None:
+        code.get_reloc(code).entries.extend(ah.Reloc(off) for off in relocs)
+    if symbols is not None:
+        code.get_symtab().symbols = [ah.Symbol(off, name) for name, off in symbols]
+    return bi
+
+
+def test_diff_equal():
+    data = build_exe()
+    assert all(d.is_equal() for d in ah.diff_images(_load(data), _load(data)))
+
+
+def test_diff_changes():
+    data = build_exe()
+    new = _changed(_load(data), [(100, 0x4e75), (16, 0x1234), (60, 0x99)], relocs=[60],
+                   symbols=[("start", 0), ("func", 44), ("other", 8)])
+    diffs = ah.diff_images(_load(data), new)
+    assert [d.is_equal() for d in diffs] == [False, True, True]
+    d = diffs[0]
+    # the changed relocated long and the new site are not content changes
+    assert d.ranges == [(102, 2)]
+    assert d.relocs_added == [(0, 60)]
+    assert d.relocs_changed == [(0, 16, 32, 0x1234)]
+    assert d.symbols_added == [("other", 8)]
+    assert d.symbols_moved == [("func", 40, 44)]
+
+
+def test_diff_command(exe_path):
+    assert ah.main(["diff", exe_path, exe_path]) == 0
+
+
+def test_command_os_error(exe_path, monkeypatch):
+    def fail(*args):
+        raise OSError(13, "Permission denied")
+    monkeypatch.setattr(ah, "_open_input", fail)
+    assert ah.main(["diff", exe_path, exe_path]) == 1
+
+
+def test_patch_in_place(exe_path):
+    with open(exe_path, "rb") as f:
+        old = f.read()
+    with open(exe_path, "r+b") as f:
+        hp = ah.HunkPatcher(f)
+        hp.write_data(1, 4, "\x12\x34")
+        assert hp.rename_symbol("func", "call") == 1
+        hp.flush()
+    with open(exe_path, "rb") as f:
+        new = f.read()
+    assert len(new) == len(old)
+    assert sum(1 for a, b in zip(old, new) if a != b) == 6
+    bi = ah.BinFmtHunk().load_image(exe_path)
+    assert bi.get_segments()[1].data[4:6] == "\x12\x34"
+    assert [s.name for s in bi.get_segments()[0].get_symtab().get_symbols()] == ["start", "call"]
+
+
+def test_patch_moves_blocks(exe_path):
+    before = ah.BinFmtHunk().load_image(exe_path)
+    with open(exe_path, "r+b") as f:
+        hp = ah.HunkPatcher(f)
+        hp.rename_symbol("func", "a_much_longer_function_name")
+        hp.set_symbols(1, [("table", 4)])
+        hp.flush()
+        # offsets of the rewritten blocks are updated for further patches
+        hp.write_data(1, 0, "\xab")
+    bi = ah.BinFmtHunk().load_image(exe_path)
+    segs = bi.get_segments()
+    assert [s.name for s in segs[0].get_symtab().get_symbols()] == ["start", "a_much_longer_function_name"]
+    assert [(s.name, s.offset) for s in segs[1].get_symtab().get_symbols()] == [("table", 4)]
+    assert segs[0].data == before.get_segments()[0].data
+    assert segs[1].data == "\xab" + before.get_segments()[1].data[1:]
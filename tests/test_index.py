@@ -0,0 +1,105 @@
+import random
+import struct
+import StringIO
+
+import amiga_hunk as ah
+from conftest import build_exe, build_object
+
+
+def _image(seed, relocated=0):
+    """return the test executable with random code, relocated longs get
+       the value relocated"""
+    bi = ah.BinFmtHunk().load_image_fobj(StringIO.StringIO(build_exe()))
+    code = bi.get_segments()[0]
+    rnd = random.Random(seed)
+    data = bytearray(rnd.getrandbits(8) for i in xrange(code.size))
+    for to_seg in code.get_reloc_to_segs():
+        for r in code.get_reloc(to_seg).get_relocs():
+            struct.pack_into(">I", data, r.offset, relocated)
+    code.data = str(data)
+    return bi
+
+
+def test_signatures(tmpdir):
+    db = ah.SignatureDB()
+    assert db.add_image(_image(1)) == 2
+    path = str(tmpdir.join("sigs"))
+    db.save(path)
+    for sigs in (db, ah.SignatureDB.load(path)):
+        # the same code linked elsewhere matches
+        code = _image(1, relocated=0x21f000).get_segments()[0]
+        assert sigs.match_segment(code) == [(0, 40, "start"), (40, 216, "func")]
+        assert sigs.match_segment(_image(2).get_segments()[0]) == []
+
+
+def test_signature_cache(tmpdir):
+    import os
+    db = ah.SignatureDB()
+    db.add_image(_image(1))
+    path = str(tmpdir.join("sigs"))
+    db.save(path)
+    first = ah._load_signatures(path)
+    assert ah._load_signatures(path) is first
+    # a rewritten file is parsed again
+    db.add_image(_image(2))
+    db.save(path)
+    os.utime(path, (0, 0))
+    second = ah._load_signatures(path)
+    assert second is not first
+    assert second.num == db.num
+
+
+def test_minhash(tmpdir):
+    sigs = ah.MinHashIndex.image_signatures
+    idx = ah.MinHashIndex()
+    idx.add("a", sigs(_image(1)))
+    idx.add("b", sigs(_image(2)))
+    path = str(tmpdir.join("sim"))
+    idx.save(path)
+    # a relinked copy of a with a changed long
+    query = _image(1, relocated=0x21f000)
+    code = query.get_segments()[0]
+    code.data = code.data[:100] + "\xff\xff\xff\xff" + code.data[104:]
+    for index in (idx, ah.MinHashIndex.load(path)):
+        res = index.query(sigs(query))
+        assert res[0][1] == "a"
+        assert res[0][0] > 0.8
+        assert all(sim < 0.5 for sim, name in res[1:])
+
+
+def test_symbol_index(tmpdir):
+    idx = ah.SymbolIndex(str(tmpdir.join("index.db")))
+    for path, data in (("prog", build_exe()), ("main.o", build_object())):
+        bf = ah.HunkBlockFile()
+        f = StringIO.StringIO(data)
+        bf.read(f, is_load_seg=bf.peek_type(f) == ah.TYPE_LOADSEG)
+        symbols = []
+        ah._collect_symbols(bf.get_blocks(), symbols)
+        idx.update(path, 1.0, len(data), "hash", symbols)
+    idx.commit()
+    assert idx.find("func") == [(u"func", u"sym", 0, 40, u"prog")]
+    assert [row[:2] for row in idx.find("_", prefix=True)] == [
+        (u"_buf", u"ref"), (u"_main", u"def"), (u"_main", u"sym"), (u"_puts", u"ref")]
+    assert idx.find("_main", kind="def") == [(u"_main", u"def", 0, 0, u"main.o")]
+    assert idx.find("s", prefix=True, limit=1) == [(u"start", u"sym", 0, 0, u"prog")]
+    idx.remove("prog")
+    assert idx.find("func") == []
+    assert list(idx.get_files()) == [u"main.o"]
+    idx.close()
+
+
+def test_scan_non_ascii(tmpdir):
+    import json
+    tmpdir.join("caf\xe9").write(build_exe().replace("LINE", "L\xc9NE"), mode="wb")
+    tmpdir.join("bad\xff").write("\x00\x00\x03\xf3", mode="wb")
+    output = str(tmpdir.join("scan.json"))
+    assert ah.main(["scan", "-j", "1", output, str(tmpdir)]) == 0
+    with open(output) as f:
+        recs = sorted((json.loads(line) for line in f), key=lambda rec: rec["path"])
+    assert [rec["path"][-4:] for rec in recs] == [u"bad\xff", u"caf\xe9"]
+    assert "error" in recs[0]
+    assert recs[1]["debug"] == [u"L\xc9NE"]
+    # resumed scans find the recorded names
+    assert ah.main(["scan", "-j", "1", "-r", output, str(tmpdir)]) == 0
+    with open(output) as f:
+        assert len(f.readlines()) == 2
@@ -0,0 +1,104 @@
+import random
+import struct
+import StringIO
+
+import pytest
+
+import amiga_hunk as ah
+from conftest import build_exe, build_object
+
+
+def _build_program(num_hunks, seed=1):
+    rnd = random.Random(seed)
+    types = [ah.HUNK_CODE] + [rnd.choice((ah.HUNK_CODE, ah.HUNK_DATA, ah.HUNK_BSS))
+                              for i in xrange(num_hunks - 1)]
+    sizes = [rnd.randint(1, 64) for i in xrange(num_hunks)]
+    flags = [rnd.choice((0, 0, 1, 2)) for i in xrange(num_hunks)]
+    hdr = ah.HunkHeaderBlock()
+    hdr.setup(sizes, flags)
+    blks = [hdr]
+    for i in xrange(num_hunks):
+        if types[i] == ah.HUNK_BSS:
+            blks.append(ah.HunkSegmentBlock(ah.HUNK_BSS, None, size_longs=sizes[i]))
+        else:
+            # data may be shorter than the hunk
+            num_longs = rnd.randint(1, sizes[i])
+            data = "".join(struct.pack(">I", rnd.getrandbits(20)) for j in xrange(num_longs))
+            blks.append(ah.HunkSegmentBlock(types[i], data, size_longs=num_longs))
+            relocs = {}
+            for off in rnd.sample(xrange(num_longs), min(num_longs, 8)):
+                relocs.setdefault(rnd.randrange(num_hunks), []).append(off * 4)
+            if relocs:
+                blks.append(ah.HunkRelocLongBlock(ah.HUNK_ABSRELOC32, sorted(relocs.items())))
+            blks.append(ah.HunkSymbolBlock([("s%d" % i, 0)]))
+        blks.append(ah.HunkEndBlock())
+    data = str(ah.HunkBlockFile(blks).encode(is_load_seg=True))
+    return ah.BinFmtHunk().load_image_fobj(StringIO.StringIO(data))
+
+
+def _merged_addrs(bi, merged_addrs):
+    """addresses of the original segments inside the merged ones"""
+    groups = []
+    pos = {}
+    addrs = []
+    for seg in bi.get_segments():
+        key = (seg.seg_type, seg.flags)
+        if key not in pos:
+            pos[key] = 0
+            groups.append(key)
+        addrs.append(merged_addrs[groups.index(key)] + pos[key])
+        pos[key] += seg.size
+    return addrs
+
+
+def test_merge_relocation_math():
+    bi = _build_program(200)
+    merged = ah.merge_segments(bi)
+    out = StringIO.StringIO()
+    ah.BinFmtHunk().save_image_fobj(out, merged)
+    loaded = ah.BinFmtHunk().load_image_fobj(StringIO.StringIO(out.getvalue()))
+    segs = loaded.get_segments()
+    assert len(set((seg.seg_type, seg.flags) for seg in bi.get_segments())) == len(segs)
+    assert segs[0].seg_type == ah.SEGMENT_TYPE_CODE and segs[0].flags == bi.get_segments()[0].flags
+
+    merged_addrs = [0x100000 * (i + 1) for i in xrange(len(segs))]
+    merged_datas = ah.Relocate(loaded).relocate(merged_addrs)
+    addrs = _merged_addrs(bi, merged_addrs)
+    datas = ah.Relocate(bi).relocate(addrs)
+    symbols = {}
+    for seg in segs:
+        for sym in seg.get_symtab().get_symbols() if seg.get_symtab() else ():
+            symbols[sym.name] = merged_addrs[seg.id] + sym.offset
+    for seg in bi.get_segments():
+        for i, addr in enumerate(merged_addrs):
+            if addr <= addrs[seg.id] < addr + segs[i].size:
+                off = addrs[seg.id] - addr
+                assert merged_datas[i][off:off + seg.size] == datas[seg.id]
+        if seg.seg_type != ah.SEGMENT_TYPE_BSS:
+            assert symbols["s%d" % seg.id] == addrs[seg.id]
+
+
+def test_add_to_longs():
+    data = struct.pack(">III", 1, 0xfffffffe, 3)
+    assert ah._add_to_longs(data, [(0, 4), (4, 3)]) == struct.pack(">III", 5, 1, 3)
+    assert ah._add_to_longs(data, []) == data
+    with pytest.raises(ah.HunkParseError):
+        ah._add_to_longs(data, [(0, 1), (2, 1)])
+    with pytest.raises(ah.HunkParseError):
+        ah._add_to_longs(data, [(10, 1)])
+
+
+def test_merge_rejects_object_files():
+    bi = ah.BinFmtHunk().load_object_fobj(StringIO.StringIO(build_object()))
+    with pytest.raises(ah.HunkParseError):
+        ah.merge_segments(bi)
+
+
+def test_relocate_buffers():
+    bi = ah.BinFmtHunk().load_image_fobj(StringIO.StringIO(build_exe()))
+    rel = ah.Relocate(bi)
+    addrs = rel.get_seq_addrs(0x1000)
+    assert [len(d) for d in rel.relocate(addrs)] == [256, 64, 4096]
+    init = rel.relocate(addrs, init_only=True)
+    assert [len(d) for d in init] == [256, 32, 0]
+    assert init[0] == rel.relocate(addrs)[0]
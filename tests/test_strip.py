@@ -0,0 +1,96 @@
+import struct
+import StringIO
+
+import pytest
+
+import amiga_hunk as ah
+from conftest import build_exe, build_object
+
+
+def _strip(data):
+    out = StringIO.StringIO()
+    hs = ah.HunkStripper()
+    num = hs.strip(StringIO.StringIO(data), out)
+    return num, out.getvalue()
+
+
+def _expected(data, is_load_seg):
+    bf = ah.HunkBlockFile()
+    bf.read(StringIO.StringIO(data), is_load_seg=is_load_seg)
+    blocks = [blk for blk in bf.get_blocks() if blk.blk_id not in (ah.HUNK_SYMBOL, ah.HUNK_DEBUG)]
+    return str(ah.HunkBlockFile(blocks).encode(is_load_seg=is_load_seg))
+
+
+def test_strip_exe():
+    data = build_exe()
+    num, out = _strip(data)
+    assert num == 2
+    assert out == _expected(data, True)
+    bi = ah.BinFmtHunk().load_image_fobj(StringIO.StringIO(out))
+    assert all(seg.get_symtab() is None and seg.get_debug_line() is None for seg in bi.get_segments())
+
+
+def test_strip_object():
+    data = build_object()
+    num, out = _strip(data)
+    assert num == 1
+    assert out == _expected(data, False)
+
+
+def test_strip_without_debug_blocks_copies_file():
+    data = build_exe(debug=False)
+    assert _strip(_expected(data, True)) == (0, _expected(data, True))
+
+
+def test_strip_crunched_file():
+    with pytest.raises(ah.HunkParseError):
+        _strip(ah.pp20_crunch(build_exe()))
+
+
+def test_strip_truncated_file():
+    with pytest.raises(ah.HunkParseError):
+        _strip(build_exe()[:-10])
+
+
+def test_strip_command(exe_path, tmpdir):
+    output = str(tmpdir.join("stripped"))
+    assert ah.main(["strip", exe_path, output]) == 0
+    with open(exe_path, "rb") as f:
+        expected = _expected(f.read(), True)
+    with open(output, "rb") as f:
+        assert f.read() == expected
+
+
+class _Pipe(object):
+    """a file object that can't seek"""
+
+    def __init__(self, data):
+        self.f = StringIO.StringIO(data)
+
+    def read(self, n):
+        return self.f.read(n)
+
+
+def _overlaid_exe():
+    return build_exe() + struct.pack(">III", ah.HUNK_OVERLAY, 1, 0)
+
+
+def test_strip_overlaid_file():
+    out = StringIO.StringIO()
+    with pytest.raises(ah.HunkParseError):
+        ah.HunkStripper().strip(StringIO.StringIO(_overlaid_exe()), out)
+    # checked before copying
+    assert out.getvalue() == ""
+    with pytest.raises(ah.HunkParseError):
+        ah.HunkStripper().strip(_Pipe(_overlaid_exe()), StringIO.StringIO())
+    # nothing to drop before the overlay table
+    data = _expected(build_exe(), True) + struct.pack(">III", ah.HUNK_OVERLAY, 1, 0)
+    assert _strip(data) == (0, data)
+
+
+def test_strip_command_error(tmpdir):
+    path = tmpdir.join("prog")
+    path.write(_overlaid_exe(), mode="wb")
+    output = tmpdir.join("stripped")
+    assert ah.main(["strip", str(path), str(output)]) == 1
+    assert sorted(p.basename for p in tmpdir.listdir()) == ["prog"]